@@ -0,0 +1,73 @@
+import hmac
+import json
+import os
+from functools import lru_cache
+from typing import Dict
+
+from fastapi import Header, HTTPException
+
+from app.config.logger import get_logger
+
+LOGGER = get_logger("usage_service.auth")
+
+# Producer ID of USAGE_SERVICE_INTERNAL_KEY, and of every caller when auth is off.
+DEFAULT_PRODUCER = "default"
+
+
+def is_auth_required() -> bool:
+    return bool(internal_key() or os.getenv("USAGE_SERVICE_PRODUCER_KEYS", "").strip())
+
+
+def internal_key() -> str | None:
+    return os.getenv("USAGE_SERVICE_INTERNAL_KEY")
+
+
+def producer_keys() -> Dict[str, str]:
+    """`USAGE_SERVICE_PRODUCER_KEYS`: a JSON object of internal key to producer ID."""
+
+    return _parse_producer_keys(os.getenv("USAGE_SERVICE_PRODUCER_KEYS", ""))
+
+
+@lru_cache(maxsize=4)
+def _parse_producer_keys(raw: str) -> Dict[str, str]:
+    if not raw.strip():
+        return {}
+    try:
+        entries = json.loads(raw)
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"Invalid USAGE_SERVICE_PRODUCER_KEYS: {exc}") from exc
+    if not isinstance(entries, dict) or not all(isinstance(v, str) and v for v in entries.values()):
+        raise ValueError("USAGE_SERVICE_PRODUCER_KEYS must be a JSON object of key to producer ID")
+    return {str(key): producer for key, producer in entries.items() if key}
+
+
+def producer_for_key(header_key: str | None) -> str | None:
+    """Producer ID an X-Internal-Key belongs to, or None if it matches no key."""
+
+    if not is_auth_required():
+        return DEFAULT_PRODUCER
+    if header_key is None:
+        return None
+    producer = None
+    expected = internal_key()
+    if expected and hmac.compare_digest(header_key, expected):
+        producer = DEFAULT_PRODUCER
+    # Compare against every key so timing does not reveal which one matched.
+    for key, key_producer in producer_keys().items():
+        if hmac.compare_digest(header_key, key):
+            producer = key_producer
+    return producer
+
+
+def is_valid_internal_key(header_key: str | None) -> bool:
+    return producer_for_key(header_key) is not None
+
+
+def require_internal_key(
+    x_internal_key: str | None = Header(default=None, alias="X-Internal-Key"),
+) -> None:
+    """FastAPI dependency enforcing X-Internal-Key on internal endpoints."""
+
+    if is_auth_required() and not is_valid_internal_key(x_internal_key):
+        LOGGER.warning("Internal endpoint unauthorized")
+        raise HTTPException(status_code=401, detail="Unauthorized")
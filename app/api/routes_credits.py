@@ -0,0 +1,109 @@
+from dataclasses import asdict
+
+from fastapi import APIRouter, Depends, HTTPException
+
+from app.api.auth import require_internal_key
+from app.config.logger import get_logger
+from app.core.credits import DEFAULT_LEDGER, grant_credits, read_credits
+from app.db.partitions import PartitionRouter, get_partition_router
+from app.schemas.credits import (
+    CreditCommitRequest,
+    CreditGrantRequest,
+    CreditReleaseRequest,
+    CreditReserveRequest,
+)
+from app.schemas.responses import (
+    CreditBalanceResponse,
+    CreditCommitResponse,
+    CreditGrantResponse,
+    CreditReleaseResponse,
+    CreditReservationResponse,
+)
+
+router = APIRouter()
+LOGGER = get_logger("usage_service.routes.credits")
+
+# Sync handlers: a reservation may need a Firestore transaction, so FastAPI
+# runs these in its threadpool.
+
+
+@router.post(
+    "/v1/credits/reserve",
+    response_model=CreditReservationResponse,
+    response_model_exclude_none=True,
+    dependencies=[Depends(require_internal_key)],
+)
+def reserve_credits(
+    payload: CreditReserveRequest,
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> CreditReservationResponse:
+    reservation = DEFAULT_LEDGER.reserve(
+        partitions.client_for_user(payload.userId),
+        payload.userId,
+        payload.amountUsd,
+        reservation_id=payload.reservationId,
+        ttl_seconds=payload.ttlSeconds,
+    )
+    if not reservation.ok:
+        LOGGER.info(
+            "Credit reservation refused",
+            extra={"userId": payload.userId, "amountUsd": payload.amountUsd, "reason": reservation.reason},
+        )
+    return CreditReservationResponse(**asdict(reservation))
+
+
+@router.post(
+    "/v1/credits/commit",
+    response_model=CreditCommitResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def commit_credits(
+    payload: CreditCommitRequest,
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> CreditCommitResponse:
+    charged = DEFAULT_LEDGER.commit(
+        partitions.client_for_user(payload.userId), payload.userId, payload.reservationId, payload.actualUsd
+    )
+    return CreditCommitResponse(ok=True, reservationId=payload.reservationId, chargedUsd=round(charged, 6))
+
+
+@router.post(
+    "/v1/credits/release",
+    response_model=CreditReleaseResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def release_credits(payload: CreditReleaseRequest) -> CreditReleaseResponse:
+    return CreditReleaseResponse(ok=True, released=DEFAULT_LEDGER.release(payload.userId, payload.reservationId))
+
+
+@router.get(
+    "/v1/credits/{userId}",
+    response_model=CreditBalanceResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def get_credits(
+    userId: str,
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> CreditBalanceResponse:
+    credits = read_credits(partitions.client_for_user(userId), userId)
+    if credits is None:
+        raise HTTPException(status_code=404, detail="No credit account for user")
+    return CreditBalanceResponse(userId=userId, local=DEFAULT_LEDGER.local_state(userId), **credits)
+
+
+@router.post(
+    "/v1/credits/{userId}/grant",
+    response_model=CreditGrantResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def grant_user_credits(
+    userId: str,
+    payload: CreditGrantRequest,
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> CreditGrantResponse:
+    applied, balance = grant_credits(partitions.client_for_user(userId), userId, payload.amountUsd, payload.grantId)
+    LOGGER.info(
+        "Credits granted",
+        extra={"userId": userId, "amountUsd": payload.amountUsd, "grantId": payload.grantId, "applied": applied},
+    )
+    return CreditGrantResponse(ok=True, applied=applied, balanceUsd=round(balance, 6))
@@ -1,12 +1,57 @@
-from fastapi import APIRouter
+import os
+import time
+
+from fastapi import APIRouter, Response
+from fastapi.responses import JSONResponse
 
 from app.config.logger import get_logger
+from app.core.dedup import count_live_dedup_keys
+from app.core.warmup import READINESS
+from app.db.partitions import get_partition_router
+from app.utils.metrics import render_prometheus
 
 router = APIRouter()
 LOGGER = get_logger("usage_service.routes.health")
 
+DEDUP_METRICS_REFRESH_SECONDS = float(os.getenv("DEDUP_METRICS_REFRESH_SECONDS", "300"))
+_last_dedup_refresh = 0.0
+
 
 @router.get("/health")
 async def health_check() -> dict:
-    LOGGER.info("Health check requested")
+    LOGGER.debug("Health check requested")
     return {"ok": True}
+
+
+@router.get("/ready")
+async def readiness_check() -> JSONResponse:
+    """200 once warmup (client, channel, pricing/FX caches) has finished."""
+
+    status = READINESS.status()
+    return JSONResponse(content=status, status_code=200 if status["ready"] else 503)
+
+
+@router.get("/metrics")
+def metrics() -> Response:
+    _refresh_dedup_gauge()
+    return Response(content=render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+def _refresh_dedup_gauge() -> None:
+    # The live-key count is an aggregation query billed per index entry
+    # batch, so it is refreshed at most every DEDUP_METRICS_REFRESH_SECONDS.
+    global _last_dedup_refresh
+    if DEDUP_METRICS_REFRESH_SECONDS <= 0:
+        return
+    now = time.monotonic()
+    if _last_dedup_refresh and now - _last_dedup_refresh < DEDUP_METRICS_REFRESH_SECONDS:
+        return
+    _last_dedup_refresh = now
+    try:
+        partitions = get_partition_router()
+        if partitions.is_partitioned():
+            partitions.fan_out(lambda name, db: count_live_dedup_keys(db, partition=name))
+        else:
+            count_live_dedup_keys(partitions.primary())
+    except Exception as exc:  # noqa: BLE001
+        LOGGER.warning("Dedup live key count failed: %s", exc)
@@ -0,0 +1,73 @@
+import datetime as dt
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+
+from app.api.auth import require_internal_key
+from app.config.logger import get_logger
+from app.core.orgs import DEFAULT_ORG_ROLLUP, read_org_usage, remove_user_org, set_user_org
+from app.db.partitions import PartitionRouter, get_partition_router
+from app.schemas.responses import OrgMemberResponse, OrgUsageResponse
+
+router = APIRouter()
+LOGGER = get_logger("usage_service.routes.orgs")
+
+# Sync handlers: each makes one blocking Firestore call, so FastAPI runs
+# them in its threadpool.
+
+
+@router.get(
+    "/v1/orgs/{orgId}/usage",
+    response_model=OrgUsageResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def get_org_usage(
+    orgId: str,
+    period: str = Query("month", regex="^(day|month)$"),
+    key: str | None = Query(None, description="YYYYMMDD or YYYYMM (UTC); defaults to the current period"),
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> OrgUsageResponse:
+    now = dt.datetime.now(dt.timezone.utc)
+    key = key or (now.strftime("%Y%m") if period == "month" else now.strftime("%Y%m%d"))
+    body = read_org_usage(partitions.primary(), orgId, period, key)
+    if body is None:
+        raise HTTPException(status_code=404, detail="No usage for org in period")
+    return OrgUsageResponse(
+        **{
+            **body,
+            "orgId": orgId,
+            "period": period,
+            "key": key,
+            "stalenessBoundSeconds": DEFAULT_ORG_ROLLUP.staleness_bound_seconds,
+        }
+    )
+
+
+@router.put(
+    "/v1/orgs/{orgId}/members/{userId}",
+    response_model=OrgMemberResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def add_org_member(
+    orgId: str,
+    userId: str,
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> OrgMemberResponse:
+    set_user_org(partitions.client_for_user(userId), userId, orgId)
+    LOGGER.info("Org member set", extra={"orgId": orgId, "userId": userId})
+    return OrgMemberResponse(ok=True, userId=userId, orgId=orgId)
+
+
+@router.delete(
+    "/v1/orgs/{orgId}/members/{userId}",
+    response_model=OrgMemberResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def remove_org_member(
+    orgId: str,
+    userId: str,
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> OrgMemberResponse:
+    if not remove_user_org(partitions.client_for_user(userId), userId, orgId):
+        raise HTTPException(status_code=404, detail="User is not a member of this org")
+    LOGGER.info("Org member removed", extra={"orgId": orgId, "userId": userId})
+    return OrgMemberResponse(ok=True, userId=userId)
@@ -0,0 +1,58 @@
+import hmac
+import os
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+
+from app.config.logger import get_logger
+from app.core.revenuecat_mapper import map_revenuecat_event
+from app.core.user_plans import store_user_plan
+from app.db.partitions import PartitionRouter, get_partition_router
+from app.schemas.responses import RevenueCatWebhookResponse
+from app.schemas.revenuecat import RevenueCatWebhook
+
+router = APIRouter()
+LOGGER = get_logger("usage_service.routes.revenuecat")
+
+# Sync handler: storing the plan is a Firestore transaction, so FastAPI runs
+# it in its threadpool.
+
+
+@router.post("/v1/revenuecat/webhook", response_model=RevenueCatWebhookResponse)
+def revenuecat_webhook(
+    payload: RevenueCatWebhook,
+    authorization: str | None = Header(default=None),
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> RevenueCatWebhookResponse:
+    if not os.getenv("REVENUECAT_WEBHOOK_AUTH") and not _allow_unauthenticated():
+        LOGGER.error("RevenueCat webhook rejected: REVENUECAT_WEBHOOK_AUTH is not set")
+        raise HTTPException(status_code=503, detail="Webhook auth is not configured")
+    if not _is_valid_webhook_auth(authorization):
+        LOGGER.warning("RevenueCat webhook unauthorized")
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    event = payload.event
+    user_id = event.get("app_user_id") or event.get("original_app_user_id")
+    if not user_id:
+        raise HTTPException(status_code=422, detail="event.app_user_id is required")
+
+    plan = map_revenuecat_event(event)
+    stored = store_user_plan(partitions.client_for_user(user_id), user_id, plan)
+    LOGGER.info(
+        "RevenueCat webhook processed",
+        extra={"userId": user_id, "eventType": event.get("type"), "stored": stored},
+    )
+    return RevenueCatWebhookResponse(ok=True, userId=user_id, stored=stored)
+
+
+def _allow_unauthenticated() -> bool:
+    # Local development only: the webhook sets user plans and is internet-facing.
+    return os.getenv("REVENUECAT_WEBHOOK_ALLOW_UNAUTHENTICATED", "false").lower() in ("1", "true", "yes", "on")
+
+
+def _is_valid_webhook_auth(header_value: str | None) -> bool:
+    expected = os.getenv("REVENUECAT_WEBHOOK_AUTH")
+    if not expected:
+        return _allow_unauthenticated()
+    if header_value is None:
+        return False
+    return hmac.compare_digest(header_value, expected)
@@ -0,0 +1,38 @@
+from fastapi import APIRouter, Depends
+
+from app.api.auth import require_internal_key
+from app.config.logger import get_logger
+from app.core.throttling import DEFAULT_ENGINE
+from app.db.partitions import PartitionRouter, get_partition_router
+from app.schemas.responses import ThrottleDecisionResponse
+from app.schemas.throttle import ThrottleCheckRequest
+
+router = APIRouter()
+LOGGER = get_logger("usage_service.routes.throttle")
+
+# Sync handler: the first check of a user each day reads their aggregates
+# from Firestore, so FastAPI runs it in its threadpool.
+
+
+@router.post(
+    "/v1/throttle/check",
+    response_model=ThrottleDecisionResponse,
+    response_model_exclude_none=True,
+    dependencies=[Depends(require_internal_key)],
+)
+def check_throttle(
+    payload: ThrottleCheckRequest,
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> ThrottleDecisionResponse:
+    decision = DEFAULT_ENGINE.check(
+        payload.userId,
+        payload.action,
+        cost=payload.cost,
+        consume=payload.consume,
+        db=partitions.client_for_user(payload.userId),
+    )
+    LOGGER.debug(
+        "Throttle decision evaluated",
+        extra={"userId": payload.userId, "action": payload.action, "decision": decision.get("decision")},
+    )
+    return ThrottleDecisionResponse(**decision)
@@ -1,14 +1,46 @@
-import hmac
+import datetime as dt
 import os
+from typing import Any, Dict
 
-from fastapi import APIRouter, Depends, Header, HTTPException, Request
-from google.cloud import firestore
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 
+from app.api.auth import producer_for_key, require_internal_key
 from app.config.logger import get_logger
-from app.core.usage_tracker import log_event, update_aggregates
+from app.core.usage_tracker import log_event, read_event, update_aggregates
+from app.core.admission import DEFAULT_ADMISSION
+from app.core.analytics import ANALYTICS_SNAPSHOT_PATH, CohortQueryError, run_cohort_query
+from app.core.cardinality import ALL_DIMENSION, DEFAULT_CARDINALITY
 from app.core.event_builder import enrich_usage_event
-from app.db.firestore import get_firestore_client
-from app.schemas.responses import UsageIngestResponse
+from app.core.fallback import DEFAULT_FALLBACK
+from app.core.export import (
+    EXPORT_SPECS,
+    ExportCursor,
+    ExportCursorError,
+    iter_export,
+    range_bounds,
+    render_csv,
+    render_ndjson,
+)
+from app.core.latency import DEFAULT_LATENCY
+from app.core.leaderboard import DEFAULT_LEADERBOARD
+from app.core.orgs import get_user_org
+from app.core.resilience import StorageUnavailable, deadline_scope, request_deadline
+from app.core.rollups import read_month_to_date
+from app.core.streams import DEFAULT_STREAMS
+from app.core.throttling import DEFAULT_ENGINE
+from app.core.user_plans import get_user_plan
+from app.db.partitions import PartitionRouter, get_partition_router
+from app.schemas.responses import (
+    CardinalityResponse,
+    CohortQueryResponse,
+    LatencyResponse,
+    MonthToDateResponse,
+    TopUserEntry,
+    TopUsersResponse,
+    UsageIngestResponse,
+)
 from app.schemas.usage_event import UsageEvent
 
 router = APIRouter()
@@ -19,7 +51,9 @@ LOGGER = get_logger("usage_service.routes.usage")
 async def ingest_usage_event(
     payload: UsageEvent,
     x_internal_key: str | None = Header(default=None, alias="X-Internal-Key"),
-    db: firestore.Client = Depends(get_firestore_client),
+    x_request_timeout_ms: str | None = Header(default=None, alias="X-Request-Timeout-Ms"),
+    x_ingest_lane: str | None = Header(default=None, alias="X-Ingest-Lane"),
+    partitions: PartitionRouter = Depends(get_partition_router),
     request: Request = None,
 ) -> UsageIngestResponse:
     # Exclude unset so enrich_usage_event can backfill from rawUsage
@@ -56,26 +90,36 @@ async def ingest_usage_event(
         },
     )
 
-    if _is_auth_required() and not _is_valid_internal_key(x_internal_key):
+    producer = producer_for_key(x_internal_key)
+    if producer is None:
         LOGGER.warning(
             "Usage ingest unauthorized",
             extra={"requestId": event.get("requestId")},
         )
         raise HTTPException(status_code=401, detail="Unauthorized")
-    updated = update_aggregates(db, event)
-    LOGGER.info(
-        "Usage ingest aggregate update result",
-        extra={
-            "requestId": event.get("requestId"),
-            "updated": updated,
-            "writeRawEvents": _write_raw_events(),
-        },
-    )
-    if updated and _write_raw_events():
-        log_event(db, event)
-        LOGGER.info(
-            "Usage ingest raw event logged",
-            extra={"requestId": event.get("requestId"), "eventId": event.get("eventId")},
+    event["producerId"] = producer
+    lane = DEFAULT_ADMISSION.lane_for(producer, x_ingest_lane)
+    db = partitions.client_for_user(event["userId"])
+    deadline = request_deadline(x_request_timeout_ms)
+    try:
+        # Storage calls block; run them off the event loop so the adaptive
+        # limit sees real concurrency. Admission queues them per producer.
+        async with DEFAULT_ADMISSION.slot(producer, lane, deadline):
+            updated = await run_in_threadpool(_store_usage_event, db, event, deadline)
+    except StorageUnavailable as exc:
+        if not DEFAULT_FALLBACK.enabled:
+            raise
+        DEFAULT_FALLBACK.write(event, exc.reason)
+        LOGGER.warning(
+            "Usage ingest deferred to fallback sink",
+            extra={"requestId": event.get("requestId"), "reason": exc.reason, "error": str(exc)},
+        )
+        return UsageIngestResponse(
+            ok=True,
+            deduped=False,
+            deferred=True,
+            requestId=event["requestId"],
+            eventId=event["eventId"],
         )
     return UsageIngestResponse(
         ok=True,
@@ -85,22 +129,249 @@ async def ingest_usage_event(
     )
 
 
-def _is_auth_required() -> bool:
-    return bool(_internal_key())
+# Sync handlers: the read endpoints below make blocking Firestore calls, so
+# FastAPI runs them in its threadpool.
 
 
-def _internal_key() -> str | None:
-    return os.getenv("USAGE_SERVICE_INTERNAL_KEY")
+@router.get(
+    "/v1/usage/events/{event_id}",
+    dependencies=[Depends(require_internal_key)],
+)
+def get_usage_event(
+    event_id: str,
+    user_id: str | None = Query(None, alias="userId", description="Owner; skips the cross-partition lookup"),
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> Dict[str, Any]:
+    if user_id:
+        event = read_event(partitions.client_for_user(user_id), event_id)
+    else:
+        found = partitions.fan_out(lambda _name, db: read_event(db, event_id))
+        event = next((value for value in found.values() if value is not None), None)
+    if event is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    return event
 
 
-def _is_valid_internal_key(header_key: str | None) -> bool:
-    expected = _internal_key()
-    if not expected:
-        return True
-    if header_key is None:
-        return False
-    return hmac.compare_digest(header_key, expected)
+@router.get(
+    "/v1/usage/top",
+    response_model=TopUsersResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def top_users(
+    period: str = Query("day", regex="^(day|month)$"),
+    metric: str = Query("costUsd", regex="^(costUsd|tokens)$"),
+    key: str | None = Query(None, description="YYYYMMDD or YYYYMM (UTC); defaults to the current period"),
+    limit: int = Query(100, ge=1, le=1000),
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> TopUsersResponse:
+    key = key or _current_period_key(period)
+    entries = DEFAULT_LEADERBOARD.top(partitions.primary(), period, key, metric, limit)
+    return TopUsersResponse(
+        period=period,
+        key=key,
+        metric=metric,
+        users=[TopUserEntry(userId=user_id, value=value, maxError=error) for user_id, value, error in entries],
+    )
+
+
+@router.get(
+    "/v1/usage/cardinality",
+    response_model=CardinalityResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def distinct_users(
+    dimension: str = Query(ALL_DIMENSION, regex="^(all|action|model|endpoint)$"),
+    value: str | None = Query(None, description="Single dimension value; omit for all values"),
+    day: str | None = Query(None, regex="^[0-9]{8}$", description="YYYYMMDD (UTC); defaults to today"),
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> CardinalityResponse:
+    day = day or _current_period_key("day")
+    estimates = DEFAULT_CARDINALITY.estimate(partitions.primary(), day, dimension, value)
+    return CardinalityResponse(day=day, dimension=dimension, distinctUsers=estimates)
+
+
+@router.get(
+    "/v1/usage/latency",
+    response_model=LatencyResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def latency_percentiles(
+    dimension: str = Query("model", regex="^(model|provider)$"),
+    value: str | None = Query(None, description="Single model/provider; omit for all values"),
+    day: str | None = Query(None, regex="^[0-9]{8}$", description="YYYYMMDD (UTC); defaults to today"),
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> LatencyResponse:
+    day = day or _current_period_key("day")
+    values = DEFAULT_LATENCY.summary(partitions.primary(), day, dimension, value)
+    return LatencyResponse(day=day, dimension=dimension, values=values)
+
+
+@router.get(
+    "/v1/usage/users/{user_id}/month",
+    response_model=MonthToDateResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def month_to_date(
+    user_id: str,
+    month: str | None = Query(None, regex="^[0-9]{6}$", description="YYYYMM (UTC); defaults to the current month"),
+    max_staleness_seconds: float | None = Query(
+        None,
+        alias="maxStalenessSeconds",
+        ge=0,
+        description="Derived monthly mode: below the rollup bound the month is summed from daily docs",
+    ),
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> MonthToDateResponse:
+    month = month or _current_period_key("month")
+    body = read_month_to_date(partitions.client_for_user(user_id), user_id, month, max_staleness_seconds)
+    return MonthToDateResponse(**{**body, "userId": user_id, "month": month})
+
+
+@router.get(
+    "/v1/usage/stream",
+    dependencies=[Depends(require_internal_key)],
+)
+async def stream_usage(
+    userId: str = Query(..., min_length=1),
+    resume: str | None = Query(None, description="Resume token (SSE id); overrides Last-Event-ID"),
+    last_event_id: str | None = Header(default=None, alias="Last-Event-ID"),
+) -> StreamingResponse:
+    if not DEFAULT_STREAMS.has_capacity():
+        raise HTTPException(status_code=503, detail="Too many open usage streams")
+    return StreamingResponse(
+        DEFAULT_STREAMS.stream(userId, resume or last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "/v1/usage/export",
+    dependencies=[Depends(require_internal_key)],
+)
+def export_usage(
+    collection: str = Query(..., regex="^(daily|monthly|events)$"),
+    start: str = Query(..., alias="from", regex="^[0-9]{6}([0-9]{2})?$", description="YYYYMMDD (YYYYMM for monthly)"),
+    end: str = Query(..., alias="to", regex="^[0-9]{6}([0-9]{2})?$", description="Inclusive, same format as from"),
+    export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"),
+    cursor: str | None = Query(None, description="`_cursor` of the last record received, to resume"),
+    page_size: int = Query(500, alias="pageSize", ge=1, le=1000),
+    partitions: PartitionRouter = Depends(get_partition_router),
+) -> StreamingResponse:
+    spec = EXPORT_SPECS[collection]
+    try:
+        bounds = range_bounds(spec, start, end)
+        resume = ExportCursor.decode(cursor, spec.collection) if cursor else None
+        if resume is not None and resume.partition not in {p.name for p in partitions.partitions}:
+            raise ExportCursorError("Export cursor refers to an unknown partition")
+    except ExportCursorError as exc:
+        raise HTTPException(status_code=400, detail=str(exc)) from exc
+    except ValueError as exc:
+        raise HTTPException(status_code=422, detail=f"Invalid from/to for {collection}: {exc}") from exc
+    LOGGER.info(
+        "Usage export started",
+        extra={"collection": collection, "from": start, "to": end, "format": export_format, "resumed": bool(cursor)},
+    )
+    rows = iter_export(partitions.clients(), spec, bounds[0], bounds[1], resume, page_size)
+    if export_format == "csv":
+        body, media_type = render_csv(rows, spec), "text/csv"
+    else:
+        body, media_type = render_ndjson(rows), "application/x-ndjson"
+    filename = f"usage_{collection}_{start}_{end}.{export_format}"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.get(
+    "/v1/usage/cohorts",
+    response_model=CohortQueryResponse,
+    dependencies=[Depends(require_internal_key)],
+)
+def usage_cohorts(
+    by: str = Query("plan", regex="^[a-z]+(,[a-z]+)*$", description="Comma-separated: plan, country, premium, month, action"),
+    start: int | None = Query(None, alias="from", ge=100001, le=999912, description="YYYYMM (inclusive)"),
+    end: int | None = Query(None, alias="to", ge=100001, le=999912, description="YYYYMM (inclusive)"),
+    plan: str | None = Query(None),
+    country: str | None = Query(None),
+    premium: int | None = Query(None, ge=0, le=1),
+    action: str | None = Query(None),
+) -> CohortQueryResponse:
+    if not ANALYTICS_SNAPSHOT_PATH or not os.path.exists(ANALYTICS_SNAPSHOT_PATH):
+        raise HTTPException(status_code=503, detail="Analytics snapshot not available")
+    filters = {
+        name: str(value)
+        for name, value in (("plan", plan), ("country", country), ("premium", premium), ("action", action))
+        if value is not None
+    }
+    try:
+        result = run_cohort_query(ANALYTICS_SNAPSHOT_PATH, by.split(","), start, end, filters)
+    except CohortQueryError as exc:
+        raise HTTPException(status_code=422, detail=str(exc)) from exc
+    return CohortQueryResponse(**result)
+
+
+def _store_usage_event(db: Any, event: Dict[str, Any], deadline: float) -> bool:
+    with deadline_scope(deadline):
+        if _attach_user_plans() and not event.get("plan"):
+            plan = get_user_plan(db, event["userId"])
+            if plan:
+                event["plan"] = plan
+        if _attach_user_orgs() and not event.get("orgId"):
+            org_id = get_user_org(db, event["userId"])
+            if org_id:
+                event["orgId"] = org_id
+        if _fill_throttling_decision() and not event.get("throttlingDecision"):
+            event["throttlingDecision"] = DEFAULT_ENGINE.check(
+                event["userId"],
+                event["action"],
+                consume=False,
+                db=db,
+            )
+        updated = update_aggregates(db, event)
+        LOGGER.info(
+            "Usage ingest aggregate update result",
+            extra={
+                "requestId": event.get("requestId"),
+                "updated": updated,
+                "writeRawEvents": _write_raw_events(),
+            },
+        )
+        if updated and _write_raw_events():
+            try:
+                logged = log_event(db, event)
+            except StorageUnavailable as exc:
+                # Aggregates are committed; the debug copy is best-effort.
+                LOGGER.warning(
+                    "Usage ingest raw event skipped",
+                    extra={"requestId": event.get("requestId"), "reason": exc.reason, "error": str(exc)},
+                )
+                return updated
+            LOGGER.info(
+                "Usage ingest raw event logged" if logged else "Usage ingest raw event sampled out",
+                extra={"requestId": event.get("requestId"), "eventId": event.get("eventId")},
+            )
+        return updated
+
+
+def _current_period_key(period: str) -> str:
+    now = dt.datetime.now(dt.timezone.utc)
+    return now.strftime("%Y%m") if period == "month" else now.strftime("%Y%m%d")
 
 
 def _write_raw_events() -> bool:
     return os.getenv("WRITE_RAW_EVENTS", "").lower() in ("1", "true", "yes", "on")
+
+
+def _attach_user_plans() -> bool:
+    return os.getenv("ATTACH_USER_PLANS", "").lower() in ("1", "true", "yes", "on")
+
+
+def _attach_user_orgs() -> bool:
+    return os.getenv("ATTACH_USER_ORGS", "").lower() in ("1", "true", "yes", "on")
+
+
+def _fill_throttling_decision() -> bool:
+    return os.getenv("THROTTLE_FILL_DECISION", "").lower() in ("1", "true", "yes", "on")
@@ -1,20 +1,36 @@
-"""Centralized usage tracking for LLM requests."""
-
-from .usage_tracker import log_event, update_aggregates, enqueue_usage_update
-from .pricing import PricingConfig, calculate_cost_usd
-from .fx import FxRateCache
-from .revenuecat_mapper import map_revenuecat_event
-from .event_builder import build_base_event, finalize_event, parse_gemini_usage
-
-__all__ = [
-    "log_event",
-    "update_aggregates",
-    "enqueue_usage_update",
-    "PricingConfig",
-    "calculate_cost_usd",
-    "FxRateCache",
-    "map_revenuecat_event",
-    "build_base_event",
-    "finalize_event",
-    "parse_gemini_usage",
-]
+"""Centralized usage tracking for LLM requests.
+
+Submodules are imported on first attribute access so that importing a
+single helper does not pull in Firestore and every other subsystem.
+"""
+
+import importlib
+from typing import Any
+
+_EXPORTS = {
+    "log_event": ".usage_tracker",
+    "update_aggregates": ".usage_tracker",
+    "enqueue_usage_update": ".usage_tracker",
+    "PricingConfig": ".pricing",
+    "calculate_cost_usd": ".pricing",
+    "FxRateCache": ".fx",
+    "map_revenuecat_event": ".revenuecat_mapper",
+    "build_base_event": ".event_builder",
+    "finalize_event": ".event_builder",
+    "parse_gemini_usage": ".event_builder",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list:
+    return sorted(set(globals()) | set(__all__))
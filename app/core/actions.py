@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from typing import Any, Collection, Dict, FrozenSet, Optional
+
+from app.config.logger import get_logger
+from app.utils import metrics
+from .doc_size import document_bytes
+
+LOGGER = get_logger("usage_service.actions")
+
+AGGREGATE_MAX_ACTIONS = int(os.getenv("AGGREGATE_MAX_ACTIONS", "50"))
+AGGREGATE_ALLOWED_ACTIONS = frozenset(
+    action.strip() for action in os.getenv("AGGREGATE_ALLOWED_ACTIONS", "").split(",") if action.strip()
+)
+AGGREGATE_ACTIONS_SPILL = os.getenv("AGGREGATE_ACTIONS_SPILL", "").lower() in ("1", "true", "yes", "on")
+AGGREGATE_DOC_SIZE_WARN_BYTES = int(os.getenv("AGGREGATE_DOC_SIZE_WARN_BYTES", str(256 * 1024)))
+
+# Inline bucket for actions that did not get (or may not have) their own entry.
+OTHER_ACTION = "_other"
+ACTIONS_SUBCOLLECTION = "actions"
+
+ACTION_OVERFLOW = metrics.counter(
+    "usage_aggregate_action_overflow_total", "Aggregate updates whose action was folded into actions._other."
+)
+DOC_BYTES_MAX = metrics.gauge("usage_aggregate_doc_bytes_max", "Largest aggregate doc seen by this process (bytes).")
+LARGE_DOCS = metrics.counter(
+    "usage_aggregate_large_docs_total", "Aggregate doc reads above AGGREGATE_DOC_SIZE_WARN_BYTES."
+)
+
+
+class ActionPolicy:
+    """Keeps the `actions` map of aggregate docs bounded.
+
+    An action gets its own inline entry if it is allowed (any action when
+    the registry is empty) and the doc either already has it or has fewer
+    than `max_actions` inline entries. Everything else is added to
+    `actions._other`, and with `spill` also to the doc's `actions`
+    subcollection, which then holds the breakdown of the folded actions.
+    Inline slots go to the first actions of each day/month; derived
+    monthly docs are rebuilt with the true top-K (`cap`).
+    """
+
+    def __init__(
+        self,
+        max_actions: int = AGGREGATE_MAX_ACTIONS,
+        allowed: FrozenSet[str] = AGGREGATE_ALLOWED_ACTIONS,
+        spill: bool = AGGREGATE_ACTIONS_SPILL,
+    ) -> None:
+        self.max_actions = max_actions
+        self.allowed = allowed
+        self.spill = spill
+
+    def is_allowed(self, action: str) -> bool:
+        return action != OTHER_ACTION and (not self.allowed or action in self.allowed)
+
+    def inline_key(self, action: str, existing: Collection[str]) -> str:
+        """Key in `actions` this event increments, given the doc's current keys."""
+
+        if not self.is_allowed(action):
+            return OTHER_ACTION
+        if action in existing:
+            return action
+        inline = len(existing) - (1 if OTHER_ACTION in existing else 0)
+        if self.max_actions > 0 and inline >= self.max_actions:
+            return OTHER_ACTION
+        return action
+
+    def cap(self, actions: Dict[str, Any]) -> Dict[str, Any]:
+        """Keep the `max_actions` allowed actions with the most requests; fold the rest into `_other`."""
+
+        ranked = sorted(
+            (
+                (name, breakdown)
+                for name, breakdown in actions.items()
+                if self.is_allowed(name) and isinstance(breakdown, dict)
+            ),
+            key=lambda item: (-float(item[1].get("count") or 0), item[0]),
+        )
+        keep = ranked if self.max_actions <= 0 else ranked[: self.max_actions]
+        capped = dict(keep)
+        folded = [breakdown for name, breakdown in actions.items() if name not in capped and isinstance(breakdown, dict)]
+        if folded:
+            other: Dict[str, Any] = {}
+            for breakdown in folded:
+                for field, value in breakdown.items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        other[field] = other.get(field, 0) + value
+            capped[OTHER_ACTION] = other
+        return capped
+
+
+def spill_doc_id(action: str) -> str:
+    """Subcollection doc ID for an action (free-form names are not valid doc IDs)."""
+
+    return hashlib.blake2b(action.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def existing_actions(snapshot: Optional[Any]) -> Collection[str]:
+    if snapshot is None or not snapshot.exists:
+        return ()
+    actions = (snapshot.to_dict() or {}).get("actions")
+    return actions.keys() if isinstance(actions, dict) else ()
+
+
+def observe_doc_size(collection: str, snapshot: Optional[Any]) -> None:
+    """Record the stored size of an aggregate doc read in the ingest transaction."""
+
+    if snapshot is None or not snapshot.exists:
+        return
+    size = document_bytes(collection, snapshot.id, snapshot.to_dict() or {})
+    if size > DOC_BYTES_MAX.value(collection=collection):
+        DOC_BYTES_MAX.set(size, collection=collection)
+    if size >= AGGREGATE_DOC_SIZE_WARN_BYTES:
+        LARGE_DOCS.inc(collection=collection)
+        LOGGER.warning("Large aggregate document", extra={"collection": collection, "docId": snapshot.id, "bytes": size})
+
+
+DEFAULT_ACTION_POLICY = ActionPolicy()
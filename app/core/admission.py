@@ -0,0 +1,334 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Deque, Dict, Optional
+
+from app.config.logger import get_logger
+from app.utils import metrics
+
+LOGGER = get_logger("usage_service.admission")
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+LANES = (INTERACTIVE, BULK)
+
+INGEST_MAX_CONCURRENCY = int(os.getenv("INGEST_MAX_CONCURRENCY", "32"))
+INGEST_BULK_MAX_CONCURRENCY = int(os.getenv("INGEST_BULK_MAX_CONCURRENCY", "8"))
+INGEST_BULK_SHARE = float(os.getenv("INGEST_BULK_SHARE", "0.1"))
+INGEST_PRODUCER_MAX_QUEUE = int(os.getenv("INGEST_PRODUCER_MAX_QUEUE", "1000"))
+
+ADMISSION_ADMITTED = metrics.counter("usage_admission_admitted_total", "Ingest requests admitted to storage work.")
+ADMISSION_WAIT = metrics.counter("usage_admission_wait_seconds_total", "Seconds admitted requests spent queued.")
+ADMISSION_REJECTED = metrics.counter("usage_admission_rejected_total", "Ingest requests refused by admission control.")
+ADMISSION_QUEUED = metrics.gauge("usage_admission_queue_depth", "Ingest requests waiting for admission.")
+ADMISSION_INFLIGHT = metrics.gauge("usage_admission_inflight", "Admitted ingest requests still running.")
+
+
+class AdmissionRejected(Exception):
+    """The producer's queue is full or its deadline passed while queued; answer 429."""
+
+    def __init__(self, message: str, reason: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+@dataclass(frozen=True)
+class ProducerPolicy:
+    weight: float = 1.0
+    max_concurrency: int = 0  # 0: only the global limit applies
+    rate_per_second: float = 0.0  # 0: unlimited
+    burst: float = 0.0  # token bucket size; defaults to one second of rate
+    max_queue: int = INGEST_PRODUCER_MAX_QUEUE
+    lane: str = INTERACTIVE  # lane used when the request does not pick one
+
+    @property
+    def bucket_size(self) -> float:
+        return self.burst if self.burst > 0 else max(1.0, self.rate_per_second)
+
+
+def policies_from_env(raw: Optional[str] = None) -> Dict[str, ProducerPolicy]:
+    """Parse `INGEST_PRODUCER_POLICIES`.
+
+    A JSON object of producerId to `{"weight", "maxConcurrency",
+    "ratePerSecond", "burst", "maxQueue", "lane"}`; the `*` entry applies
+    to producers without their own.
+    """
+
+    raw = os.getenv("INGEST_PRODUCER_POLICIES", "") if raw is None else raw
+    if not raw.strip():
+        return {}
+    try:
+        entries = json.loads(raw)
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"Invalid INGEST_PRODUCER_POLICIES: {exc}") from exc
+    if not isinstance(entries, dict):
+        raise ValueError("INGEST_PRODUCER_POLICIES must be a JSON object")
+    policies = {}
+    for producer, entry in entries.items():
+        lane = str(entry.get("lane", INTERACTIVE))
+        if lane not in LANES:
+            raise ValueError(f"INGEST_PRODUCER_POLICIES[{producer}].lane must be one of {', '.join(LANES)}")
+        policies[str(producer)] = ProducerPolicy(
+            weight=max(0.01, float(entry.get("weight", 1.0))),
+            max_concurrency=max(0, int(entry.get("maxConcurrency", 0))),
+            rate_per_second=max(0.0, float(entry.get("ratePerSecond", 0.0))),
+            burst=max(0.0, float(entry.get("burst", 0.0))),
+            max_queue=max(0, int(entry.get("maxQueue", INGEST_PRODUCER_MAX_QUEUE))),
+            lane=lane,
+        )
+    return policies
+
+
+@dataclass(eq=False)
+class _Waiter:
+    future: asyncio.Future
+    producer: str
+    lane: str
+    enqueued_at: float
+
+
+@dataclass(eq=False)
+class _Producer:
+    policy: ProducerPolicy
+    tokens: float
+    refilled_at: float
+    inflight: int = 0
+    queues: Dict[str, Deque[_Waiter]] = field(default_factory=lambda: {lane: deque() for lane in LANES})
+    # Stride-scheduling pass per lane: lowest pass goes next.
+    passes: Dict[str, float] = field(default_factory=lambda: {lane: 0.0 for lane in LANES})
+
+
+class AdmissionScheduler:
+    """Weighted fair admission of ingest storage work, per producer.
+
+    At most `max_concurrency` requests run storage work at once. Waiting
+    requests queue per producer and lane; slots go to the lane, then the
+    producer, with the lowest stride pass, where each admission advances
+    the pass by 1/weight. Interactive and bulk lanes split slots
+    (1 - bulk_share) : bulk_share while both have waiters, and bulk never
+    holds more than `bulk_max_concurrency` slots, so interactive requests
+    find a free slot within one storage call even during a backfill.
+    Producers at their concurrency cap or out of rate tokens are skipped
+    until a slot frees or tokens refill.
+
+    Runs on the event loop; state is only touched from there. Limits are
+    per process.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = INGEST_MAX_CONCURRENCY,
+        bulk_max_concurrency: int = INGEST_BULK_MAX_CONCURRENCY,
+        bulk_share: float = INGEST_BULK_SHARE,
+        policies: Optional[Dict[str, ProducerPolicy]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        self.bulk_max_concurrency = max(1, min(bulk_max_concurrency, self.max_concurrency))
+        share = min(max(bulk_share, 0.0), 1.0)
+        # A zero weight makes the lane's stride infinite: strict priority.
+        self._lane_strides = {
+            INTERACTIVE: 1.0 / (1.0 - share) if share < 1.0 else math.inf,
+            BULK: 1.0 / share if share > 0.0 else math.inf,
+        }
+        self._policies = policies_from_env() if policies is None else policies
+        self._clock = clock
+        self._producers: Dict[str, _Producer] = {}
+        self._lane_passes = {lane: 0.0 for lane in LANES}
+        self._lane_vtime = {lane: 0.0 for lane in LANES}
+        self._lane_inflight = {lane: 0 for lane in LANES}
+        self._inflight = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def policy(self, producer: str) -> ProducerPolicy:
+        return self._policies.get(producer) or self._policies.get("*") or ProducerPolicy()
+
+    def lane_for(self, producer: str, requested: Optional[str]) -> str:
+        """Lane of a request: the producer's default, or `bulk` when asked for.
+
+        A producer whose default lane is bulk cannot promote itself.
+        """
+
+        if requested == BULK:
+            return BULK
+        return self.policy(producer).lane
+
+    @asynccontextmanager
+    async def slot(self, producer: str, lane: str, deadline: Optional[float] = None) -> AsyncIterator[None]:
+        await self.acquire(producer, lane, deadline)
+        try:
+            yield
+        finally:
+            self.release(producer, lane)
+
+    async def acquire(self, producer: str, lane: str, deadline: Optional[float] = None) -> None:
+        """Wait for a slot. Raises AdmissionRejected if the queue is full or `deadline` passes first."""
+
+        state = self._state(producer)
+        queue = state.queues[lane]
+        future = asyncio.get_running_loop().create_future()
+        waiter = _Waiter(future, producer, lane, self._clock())
+        if not queue:
+            # Rejoining producers start at the lane's virtual time, not with banked credit.
+            state.passes[lane] = max(state.passes[lane], self._lane_vtime[lane])
+        if not self._lane_waiting(lane):
+            self._lane_passes[lane] = max(self._lane_passes[lane], self._min_active_lane_pass())
+        queue.append(waiter)
+        self._dispatch()
+        # maxQueue bounds requests that would wait: one admitted right away
+        # never counts, so maxQueue 0 means "run now or 429".
+        if not future.done() and len(queue) > state.policy.max_queue:
+            self._remove(waiter)
+            ADMISSION_REJECTED.inc(producer=producer, lane=lane, reason="queue_full")
+            raise AdmissionRejected(
+                f"Admission queue full for producer {producer}", "queue_full", self._retry_after(state)
+            )
+        timeout = None if deadline is None else max(0.0, deadline - self._clock())
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if future.done():
+                return
+            self._remove(waiter)
+            ADMISSION_REJECTED.inc(producer=producer, lane=lane, reason="deadline")
+            raise AdmissionRejected(
+                f"Deadline passed while queued for producer {producer}", "deadline", self._retry_after(state)
+            ) from None
+        except asyncio.CancelledError:
+            # Client went away: give back a slot granted in the meantime.
+            if future.done():
+                self.release(producer, lane)
+            else:
+                self._remove(waiter)
+            raise
+
+    def release(self, producer: str, lane: str) -> None:
+        state = self._producers[producer]
+        state.inflight -= 1
+        self._lane_inflight[lane] -= 1
+        self._inflight -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        now = self._clock()
+        while self._inflight < self.max_concurrency:
+            candidates = [lane for lane in LANES if self._lane_inflight[lane] < self._lane_cap(lane)]
+            state = None
+            for lane in sorted(candidates, key=lambda lane: self._lane_passes[lane]):
+                state = self._pick_producer(lane, now)
+                if state is not None:
+                    break
+            if state is None:
+                self._schedule_refill(now)
+                return
+            waiter = state.queues[lane].popleft()
+            state.passes[lane] += 1.0 / state.policy.weight
+            self._lane_vtime[lane] = state.passes[lane]
+            self._lane_passes[lane] += self._lane_strides[lane]
+            if state.policy.rate_per_second > 0:
+                state.tokens -= 1.0
+            state.inflight += 1
+            self._lane_inflight[lane] += 1
+            self._inflight += 1
+            waited = now - waiter.enqueued_at
+            ADMISSION_ADMITTED.inc(producer=waiter.producer, lane=lane)
+            ADMISSION_WAIT.inc(waited, producer=waiter.producer, lane=lane)
+            waiter.future.set_result(None)
+
+    def _pick_producer(self, lane: str, now: float) -> Optional[_Producer]:
+        best = None
+        for state in self._producers.values():
+            if not state.queues[lane]:
+                continue
+            policy = state.policy
+            if policy.max_concurrency and state.inflight >= policy.max_concurrency:
+                continue
+            if policy.rate_per_second > 0:
+                self._refill(state, now)
+                if state.tokens < 1.0:
+                    continue
+            if best is None or state.passes[lane] < best.passes[lane]:
+                best = state
+        return best
+
+    def _schedule_refill(self, now: float) -> None:
+        # Waiters held back only by rate limits need a wake-up: nothing
+        # else calls _dispatch until a slot frees.
+        wait = None
+        for state in self._producers.values():
+            policy = state.policy
+            if policy.rate_per_second <= 0 or state.tokens >= 1.0 or not any(state.queues.values()):
+                continue
+            if policy.max_concurrency and state.inflight >= policy.max_concurrency:
+                continue
+            needed = (1.0 - state.tokens) / policy.rate_per_second
+            wait = needed if wait is None else min(wait, needed)
+        if wait is None or self._timer is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._timer = loop.call_later(wait, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def _refill(self, state: _Producer, now: float) -> None:
+        policy = state.policy
+        state.tokens = min(policy.bucket_size, state.tokens + (now - state.refilled_at) * policy.rate_per_second)
+        state.refilled_at = now
+
+    def _lane_cap(self, lane: str) -> int:
+        return self.bulk_max_concurrency if lane == BULK else self.max_concurrency
+
+    def _lane_waiting(self, lane: str) -> bool:
+        return any(state.queues[lane] for state in self._producers.values())
+
+    def _min_active_lane_pass(self) -> float:
+        active = [self._lane_passes[lane] for lane in LANES if self._lane_waiting(lane)]
+        finite = [value for value in active if value != math.inf]
+        return min(finite) if finite else 0.0
+
+    def _state(self, producer: str) -> _Producer:
+        state = self._producers.get(producer)
+        if state is None:
+            policy = self.policy(producer)
+            state = self._producers[producer] = _Producer(policy, policy.bucket_size, self._clock())
+        return state
+
+    def _remove(self, waiter: _Waiter) -> None:
+        queue = self._producers[waiter.producer].queues[waiter.lane]
+        try:
+            queue.remove(waiter)
+        except ValueError:
+            pass
+
+    def _retry_after(self, state: _Producer) -> float:
+        if state.policy.rate_per_second > 0:
+            return (sum(len(queue) for queue in state.queues.values()) + 1) / state.policy.rate_per_second
+        return 1.0
+
+    def queue_samples(self) -> Dict[metrics.LabelKey, float]:
+        return {
+            metrics.labels(producer=producer, lane=lane): float(len(queue))
+            for producer, state in list(self._producers.items())
+            for lane, queue in state.queues.items()
+        }
+
+    def inflight_samples(self) -> Dict[metrics.LabelKey, float]:
+        return {metrics.labels(producer=producer): float(state.inflight) for producer, state in list(self._producers.items())}
+
+
+DEFAULT_ADMISSION = AdmissionScheduler()
+ADMISSION_QUEUED.set_callback(DEFAULT_ADMISSION.queue_samples)
+ADMISSION_INFLIGHT.set_callback(DEFAULT_ADMISSION.inflight_samples)
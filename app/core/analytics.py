@@ -0,0 +1,330 @@
+from __future__ import annotations
+
+import datetime as dt
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from app.config.logger import get_logger
+
+LOGGER = get_logger("usage_service.analytics")
+
+ANALYTICS_SNAPSHOT_PATH = os.getenv("ANALYTICS_SNAPSHOT_PATH", "")
+ANALYTICS_WATERMARK_OVERLAP_SECONDS = float(os.getenv("ANALYTICS_WATERMARK_OVERLAP_SECONDS", "60"))
+
+_EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dictionary (
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (kind, id),
+    UNIQUE (kind, value)
+);
+CREATE TABLE IF NOT EXISTS monthly (
+    user_id INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    plan_id INTEGER NOT NULL,
+    country_id INTEGER NOT NULL,
+    premium INTEGER NOT NULL,
+    requests INTEGER NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    cost_usd REAL NOT NULL,
+    cost_try REAL NOT NULL,
+    PRIMARY KEY (user_id, month)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS monthly_month ON monthly (month, plan_id, country_id);
+CREATE TABLE IF NOT EXISTS monthly_actions (
+    user_id INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    action_id INTEGER NOT NULL,
+    requests INTEGER NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    cost_usd REAL NOT NULL,
+    cost_try REAL NOT NULL,
+    PRIMARY KEY (user_id, month, action_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS watermarks (
+    partition TEXT PRIMARY KEY,
+    updated_at TEXT NOT NULL
+);
+"""
+
+# Group-by dimensions: (column, dictionary kind or None for raw values).
+COHORT_DIMENSIONS: Dict[str, Tuple[str, Optional[str]]] = {
+    "plan": ("m.plan_id", "plan"),
+    "country": ("m.country_id", "country"),
+    "premium": ("m.premium", None),
+    "month": ("m.month", None),
+    "action": ("a.action_id", "action"),
+}
+
+
+class CohortQueryError(ValueError):
+    pass
+
+
+def plan_label(plan: Any) -> str:
+    """Cohort label of a planSnapshot: event `tier`, RevenueCat `productId`, else free/premium."""
+
+    if not isinstance(plan, dict):
+        return "none"
+    for key in ("tier", "productId"):
+        if plan.get(key):
+            return str(plan[key])
+    return "premium" if plan.get("isPremium") else "free"
+
+
+class AnalyticsSnapshot:
+    """Local SQLite copy of `usage_monthly` for cohort group-bys.
+
+    Users, plan labels, countries and actions are dictionary-encoded to
+    integer columns, so a group-by scans narrow integer/real rows instead
+    of reading one Firestore doc per user-month. `sync` pulls only docs
+    whose `updatedAt` is past the per-partition watermark (minus
+    ANALYTICS_WATERMARK_OVERLAP_SECONDS; rows are upserted, so re-reading
+    a doc is harmless). Docs deleted in Firestore stay in the snapshot.
+    """
+
+    def __init__(self, path: str, read_only: bool = False) -> None:
+        if read_only:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self._conn = sqlite3.connect(path)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+        self._read_only = read_only
+        self._codes: Dict[str, Dict[str, int]] = {}
+        self._values: Dict[str, Dict[int, str]] = {}
+        self._load_dictionary()
+
+    def close(self) -> None:
+        self._conn.close()
+
+    def _load_dictionary(self) -> None:
+        self._codes.clear()
+        self._values.clear()
+        # Queries never decode user codes; skip the largest dictionary when read-only.
+        sql = "SELECT kind, id, value FROM dictionary" + (" WHERE kind != 'user'" if self._read_only else "")
+        for kind, code, value in self._conn.execute(sql):
+            self._codes.setdefault(kind, {})[value] = code
+            self._values.setdefault(kind, {})[code] = value
+
+    # -- sync ---------------------------------------------------------
+
+    def watermarks(self) -> Dict[str, str]:
+        return dict(self._conn.execute("SELECT partition, updated_at FROM watermarks"))
+
+    def sync(
+        self,
+        clients: Iterable[Tuple[str, Any]],
+        page_size: int = 500,
+        overlap_seconds: float = ANALYTICS_WATERMARK_OVERLAP_SECONDS,
+    ) -> Dict[str, int]:
+        """Upsert monthly docs updated since the last run. Returns docs read per partition."""
+
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        marks = self.watermarks()
+        read: Dict[str, int] = {}
+        for name, db in clients:
+            since = _EPOCH
+            if name in marks:
+                since = dt.datetime.fromisoformat(marks[name]) - dt.timedelta(seconds=overlap_seconds)
+            query = (
+                db.collection("usage_monthly")
+                .where(filter=FieldFilter("updatedAt", ">", since))
+                .order_by("updatedAt")
+                .order_by("__name__")
+                .limit(page_size)
+            )
+            read[name] = 0
+            page = list(query.stream())
+            while page:
+                watermark = self._upsert_page(name, page)
+                read[name] += len(page)
+                LOGGER.debug(
+                    "Analytics snapshot page stored",
+                    extra={"partition": name, "docs": len(page), "watermark": watermark},
+                )
+                if len(page) < page_size:
+                    break
+                page = list(query.start_after(page[-1]).stream())
+            LOGGER.info("Analytics snapshot synced", extra={"partition": name, "docs": read[name]})
+        return read
+
+    def _upsert_page(self, partition: str, page: Sequence[Any]) -> Optional[str]:
+        """Store one page and advance the watermark in the same SQLite transaction."""
+
+        watermark: Optional[dt.datetime] = None
+        try:
+            with self._conn:
+                for snapshot in page:
+                    data = snapshot.to_dict() or {}
+                    updated_at = data.get("updatedAt")
+                    if isinstance(updated_at, dt.datetime) and (watermark is None or updated_at > watermark):
+                        watermark = updated_at
+                    if not data.get("userId") or not data.get("month"):
+                        continue
+                    self._upsert_doc(data)
+                if watermark is not None:
+                    self._conn.execute(
+                        "INSERT INTO watermarks (partition, updated_at) VALUES (?, ?) "
+                        "ON CONFLICT (partition) DO UPDATE SET updated_at = MAX(updated_at, excluded.updated_at)",
+                        (partition, watermark.astimezone(dt.timezone.utc).isoformat()),
+                    )
+        except Exception:
+            # Codes assigned in the rolled-back transaction are gone from the file.
+            self._load_dictionary()
+            raise
+        return watermark.isoformat() if watermark is not None else None
+
+    def _upsert_doc(self, data: Dict[str, Any]) -> None:
+        user = self._code("user", str(data["userId"]))
+        month = int(data["month"])
+        plan = data.get("planSnapshot")
+        country = plan.get("countryCode") if isinstance(plan, dict) else None
+        actions = data.get("actions") or {}
+        self._conn.execute(
+            "INSERT OR REPLACE INTO monthly VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                user,
+                month,
+                self._code("plan", plan_label(plan)),
+                self._code("country", str(country).upper() if country else "unknown"),
+                1 if isinstance(plan, dict) and plan.get("isPremium") else 0,
+                sum(int((breakdown or {}).get("count") or 0) for breakdown in actions.values()),
+                int(data.get("totalInputTokens") or 0),
+                int(data.get("totalOutputTokens") or 0),
+                float(data.get("totalCostUsd") or 0.0),
+                float(data.get("totalCostTry") or 0.0),
+            ),
+        )
+        self._conn.execute("DELETE FROM monthly_actions WHERE user_id = ? AND month = ?", (user, month))
+        self._conn.executemany(
+            "INSERT INTO monthly_actions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    user,
+                    month,
+                    self._code("action", str(action)),
+                    int(breakdown.get("count") or 0),
+                    int(breakdown.get("tokensIn") or 0),
+                    int(breakdown.get("tokensOut") or 0),
+                    float(breakdown.get("costUsd") or 0.0),
+                    float(breakdown.get("costTry") or 0.0),
+                )
+                for action, breakdown in actions.items()
+                if isinstance(breakdown, dict)
+            ],
+        )
+
+    def _code(self, kind: str, value: str) -> int:
+        codes = self._codes.setdefault(kind, {})
+        code = codes.get(value)
+        if code is None:
+            code = len(codes) + 1
+            self._conn.execute("INSERT INTO dictionary (kind, id, value) VALUES (?, ?, ?)", (kind, code, value))
+            codes[value] = code
+            self._values.setdefault(kind, {})[code] = value
+        return code
+
+    # -- query --------------------------------------------------------
+
+    def group_by(
+        self,
+        dimensions: Sequence[str],
+        month_from: Optional[int] = None,
+        month_to: Optional[int] = None,
+        filters: Optional[Dict[str, str]] = None,
+    ) -> List[Dict[str, Any]]:
+        """Aggregate user-months by `dimensions`, optionally filtered by dimension values.
+
+        Per group: users (distinct), userMonths, requests, token and cost
+        sums, and avgCostUsd (mean cost per user-month). With the `action`
+        dimension the sums are the per-action breakdowns.
+        """
+
+        unknown = [name for name in list(dimensions) + list(filters or {}) if name not in COHORT_DIMENSIONS]
+        if unknown:
+            raise CohortQueryError(f"Unknown dimension(s): {', '.join(unknown)}")
+        by_action = "action" in dimensions or "action" in (filters or {})
+        facts = "a" if by_action else "m"
+        where: List[str] = []
+        params: List[Any] = []
+        if month_from is not None:
+            where.append("m.month >= ?")
+            params.append(month_from)
+        if month_to is not None:
+            where.append("m.month <= ?")
+            params.append(month_to)
+        for name, value in (filters or {}).items():
+            column, kind = COHORT_DIMENSIONS[name]
+            if kind is None:
+                try:
+                    code = int(value)
+                except ValueError:
+                    raise CohortQueryError(f"{name} filter must be an integer") from None
+            else:
+                code = self._codes.get(kind, {}).get(value.upper() if name == "country" else value)
+                if code is None:
+                    return []
+            where.append(f"{column} = ?")
+            params.append(code)
+
+        columns = [COHORT_DIMENSIONS[name][0] for name in dimensions]
+        sql = (
+            "SELECT "
+            + "".join(f"{column}, " for column in columns)
+            + f"COUNT(DISTINCT m.user_id), COUNT(*), SUM({facts}.requests), SUM({facts}.input_tokens), "
+            + f"SUM({facts}.output_tokens), SUM({facts}.cost_usd), SUM({facts}.cost_try), AVG({facts}.cost_usd) "
+            + ("FROM monthly_actions a JOIN monthly m USING (user_id, month)" if by_action else "FROM monthly m")
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + (" GROUP BY " + ", ".join(columns) + " ORDER BY " + ", ".join(columns) if columns else "")
+        )
+        rows = []
+        for record in self._conn.execute(sql, params):
+            if record[len(columns)] == 0:
+                continue
+            row: Dict[str, Any] = {}
+            for name, value in zip(dimensions, record):
+                kind = COHORT_DIMENSIONS[name][1]
+                row[name] = self._values.get(kind, {}).get(value) if kind else value
+            users, user_months, requests, tokens_in, tokens_out, cost_usd, cost_try, avg_cost = record[len(columns) :]
+            row.update(
+                {
+                    "users": users,
+                    "userMonths": user_months,
+                    "requests": requests or 0,
+                    "inputTokens": tokens_in or 0,
+                    "outputTokens": tokens_out or 0,
+                    "costUsd": round(cost_usd or 0.0, 6),
+                    "costTry": round(cost_try or 0.0, 6),
+                    "avgCostUsd": round(avg_cost or 0.0, 6),
+                }
+            )
+            rows.append(row)
+        return rows
+
+
+def run_cohort_query(
+    path: str,
+    dimensions: Sequence[str],
+    month_from: Optional[int] = None,
+    month_to: Optional[int] = None,
+    filters: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    """Open the snapshot read-only and run one group-by; includes watermarks and timing."""
+
+    started = time.perf_counter()
+    snapshot = AnalyticsSnapshot(path, read_only=True)
+    try:
+        rows = snapshot.group_by(dimensions, month_from, month_to, filters)
+        watermarks = snapshot.watermarks()
+    finally:
+        snapshot.close()
+    return {"rows": rows, "watermarks": watermarks, "elapsedMs": round((time.perf_counter() - started) * 1000, 3)}
@@ -0,0 +1,214 @@
+from __future__ import annotations
+
+import datetime as dt
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Mapping, Optional
+
+from app.config.logger import get_logger
+from app.utils import metrics
+from app.utils.periodic import worker_id
+
+LOGGER = get_logger("usage_service.capture")
+
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "")
+CAPTURE_PATHS = tuple(
+    path.strip() for path in os.getenv("CAPTURE_PATHS", "/v1/usage/events").split(",") if path.strip()
+)
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", str(64 * 1024 * 1024)))
+CAPTURE_ROTATE_SECONDS = float(os.getenv("CAPTURE_ROTATE_SECONDS", "3600"))
+CAPTURE_MAX_FILES = int(os.getenv("CAPTURE_MAX_FILES", "24"))
+CAPTURE_QUEUE_SIZE = int(os.getenv("CAPTURE_QUEUE_SIZE", "10000"))
+CAPTURE_PSEUDONYMIZE_USERS = os.getenv("CAPTURE_PSEUDONYMIZE_USERS", "true").lower() in ("1", "true", "yes", "on")
+
+REDACTED = "[redacted]"
+# Header names containing any of these are replaced with REDACTED.
+_SECRET_HEADER_MARKERS = ("auth", "key", "token", "secret", "cookie", "signature")
+
+CAPTURED = metrics.counter("usage_capture_records_total", "Requests written to capture files.")
+CAPTURE_DROPPED = metrics.counter("usage_capture_dropped_total", "Requests not captured because the queue was full.")
+
+
+def redact_headers(headers: Mapping[str, str]) -> Dict[str, str]:
+    return {
+        name: REDACTED if any(marker in name.lower() for marker in _SECRET_HEADER_MARKERS) else value
+        for name, value in headers.items()
+    }
+
+
+def pseudonymize_user(user_id: str) -> str:
+    """Stable opaque ID: the same user maps to the same value, so skew survives."""
+
+    return "cap_" + hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def sanitize_body(body: Any, pseudonymize: bool = CAPTURE_PSEUDONYMIZE_USERS) -> Any:
+    if pseudonymize and isinstance(body, dict) and isinstance(body.get("userId"), str):
+        body = {**body, "userId": pseudonymize_user(body["userId"])}
+    return body
+
+
+class TrafficCapture:
+    """Append sanitised requests to rotating NDJSON files off the request path.
+
+    `record` only enqueues; a daemon thread serialises and writes. Each
+    worker writes its own files (`{prefix}-{worker}-{UTC start}.ndjson`),
+    rotated by size or age, keeping the newest `max_files` per worker. When
+    the queue is full the request is dropped from the capture, not delayed.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        paths: Iterable[str] = CAPTURE_PATHS,
+        max_bytes: int = CAPTURE_MAX_BYTES,
+        rotate_seconds: float = CAPTURE_ROTATE_SECONDS,
+        max_files: int = CAPTURE_MAX_FILES,
+        queue_size: int = CAPTURE_QUEUE_SIZE,
+        prefix: str = "ingest",
+    ) -> None:
+        self.directory = Path(directory) if directory else None
+        self.paths = frozenset(paths)
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.max_files = max_files
+        self._name = prefix
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_bytes = 0
+        self._file_opened = 0.0
+
+    @property
+    def _prefix(self) -> str:
+        # Per process, not per instance: with preload_app the sink is built in
+        # the gunicorn master, and _prune must only see this worker's files.
+        return f"{self._name}-{worker_id()}"
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def wants(self, path: str) -> bool:
+        return self.directory is not None and path in self.paths
+
+    def record(
+        self,
+        received_at: float,
+        method: str,
+        path: str,
+        query: str,
+        headers: Mapping[str, str],
+        body: bytes,
+        status: int,
+        duration_ms: float,
+    ) -> None:
+        if not self.wants(path):
+            return
+        self._ensure_started()
+        entry = {
+            "ts": received_at,
+            "method": method,
+            "path": path,
+            "query": query,
+            "headers": dict(headers),
+            "body": body,
+            "status": status,
+            "durationMs": round(duration_ms, 3),
+        }
+        try:
+            self._queue.put_nowait(entry)
+        except queue.Full:
+            CAPTURE_DROPPED.inc()
+
+    def close(self) -> None:
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._queue.put(None)
+        thread.join(timeout=5)
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                self._thread = threading.Thread(target=self._run, name="usage-capture", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            try:
+                self._write(_serialize(entry))
+            except Exception as exc:  # noqa: BLE001
+                LOGGER.warning("Capture write failed: %s", exc)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, line: bytes) -> None:
+        now = time.time()
+        if self._file is not None and (
+            self._file_bytes >= self.max_bytes or now - self._file_opened >= self.rotate_seconds
+        ):
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            stamp = dt.datetime.utcfromtimestamp(now).strftime("%Y%m%dT%H%M%S%f")
+            self._file = open(self.directory / f"{self._prefix}-{stamp}.ndjson", "ab")
+            self._file_bytes = 0
+            self._file_opened = now
+            self._prune()
+        self._file.write(line)
+        self._file.flush()
+        self._file_bytes += len(line)
+        CAPTURED.inc()
+
+    def _prune(self) -> None:
+        files = sorted(self.directory.glob(f"{self._prefix}-*.ndjson"))
+        for stale in files[: max(0, len(files) - self.max_files)]:
+            stale.unlink(missing_ok=True)
+
+
+def _serialize(entry: Dict[str, Any]) -> bytes:
+    raw: bytes = entry["body"]
+    try:
+        body: Any = json.loads(raw) if raw else None
+    except ValueError:
+        body = raw.decode("utf-8", errors="replace")
+    entry["body"] = sanitize_body(body)
+    entry["headers"] = redact_headers(entry["headers"])
+    return (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def load_capture(paths: Iterable[Path]) -> List[Dict[str, Any]]:
+    """Read capture records from files (or directories of them), ordered by arrival.
+
+    Workers write in completion order and each has its own files, so the
+    records are sorted by `ts` after loading.
+    """
+
+    files: List[Path] = []
+    for path in paths:
+        path = Path(path)
+        files.extend(sorted(path.glob("*.ndjson")) if path.is_dir() else [path])
+    records: List[Dict[str, Any]] = []
+    for file in files:
+        with open(file, "rb") as handle:
+            records.extend(json.loads(line) for line in handle if line.strip())
+    records.sort(key=lambda record: record["ts"])
+    return records
+
+
+DEFAULT_CAPTURE = TrafficCapture(CAPTURE_DIR)
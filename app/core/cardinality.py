@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import threading
+import zlib
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from app.config.logger import get_logger
+from app.utils.lazy import lazy_import
+from app.utils.periodic import IntervalGate
+from .usage_tracker import DEFAULT_EXECUTOR, _parse_timestamp
+
+firestore = lazy_import("google.cloud.firestore")
+LOGGER = get_logger("usage_service.cardinality")
+
+DIMENSIONS = ("action", "model", "endpoint")
+ALL_DIMENSION = "all"
+_ENCODING_VERSION = 1
+
+
+class HyperLogLog:
+    """Dense HyperLogLog distinct counter with max-register merging.
+
+    Standard error is about 1.04 / sqrt(2 ** precision), i.e. ~1.6% at the
+    default precision of 12 (4 KiB of registers).
+    """
+
+    def __init__(self, precision: int = 12, registers: Optional[bytearray] = None) -> None:
+        if not 4 <= precision <= 16:
+            raise ValueError("precision must be between 4 and 16")
+        self.precision = precision
+        self._m = 1 << precision
+        self._value_bits = 64 - precision
+        self.registers = registers if registers is not None else bytearray(self._m)
+
+    def add(self, value: str) -> None:
+        hashed = int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+        index = hashed >> self._value_bits
+        rank = self._value_bits - (hashed & ((1 << self._value_bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        if other.precision != self.precision:
+            raise ValueError("cannot merge sketches with different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self) -> int:
+        # Ertl's improved estimator: no bias-correction tables and accurate
+        # across the small, mid and large ranges.
+        m = self._m
+        q = self._value_bits
+        histogram = [0] * (q + 2)
+        for register in self.registers:
+            histogram[register] += 1
+        z = m * _tau(1.0 - histogram[q + 1] / m)
+        for k in range(q, 0, -1):
+            z = 0.5 * (z + histogram[k])
+        z += m * _sigma(histogram[0] / m)
+        if z == math.inf:
+            return 0
+        return int(round(m * m / (2.0 * math.log(2.0) * z)))
+
+    def to_bytes(self) -> bytes:
+        return bytes((_ENCODING_VERSION, self.precision)) + zlib.compress(bytes(self.registers), 6)
+
+    @classmethod
+    def from_bytes(cls, payload: bytes) -> "HyperLogLog":
+        version, precision = payload[0], payload[1]
+        if version != _ENCODING_VERSION:
+            raise ValueError(f"unsupported HyperLogLog encoding {version}")
+        return cls(precision, bytearray(zlib.decompress(payload[2:])))
+
+
+class CardinalityTracker:
+    """Distinct userId sketches per day and dimension value.
+
+    Sketches are flushed into usage_cardinality/{YYYYMMDD} in a transaction
+    that max-merges with the stored registers, so any number of instances
+    can flush the same day repeatedly without over-counting.
+    """
+
+    def __init__(self, precision: int = 12, flush_seconds: float = 60.0, retained_days: int = 2) -> None:
+        self._precision = precision
+        self._retained = retained_days
+        self._sketches: Dict[Tuple[str, str, str], HyperLogLog] = {}
+        self._dirty: set = set()
+        self._gate = IntervalGate(flush_seconds)
+        self._lock = threading.Lock()
+
+    def observe_event(self, db: firestore.Client, event: Dict[str, Any]) -> None:
+        """Commit listener: add the event's userId to the day's sketches."""
+
+        user_id = event.get("userId")
+        if not user_id:
+            return
+        day_key = _parse_timestamp(event["timestamp"]).strftime("%Y%m%d")
+        with self._lock:
+            for dimension, value in _dimension_values(event):
+                key = (day_key, dimension, value)
+                sketch = self._sketches.get(key)
+                if sketch is None:
+                    sketch = self._sketches[key] = HyperLogLog(self._precision)
+                sketch.add(user_id)
+                self._dirty.add(key)
+        if self._gate.due():
+            DEFAULT_EXECUTOR.submit(self.flush, db)
+
+    def flush(self, db: firestore.Client) -> int:
+        """Merge dirty sketches into Firestore. Returns the number of sketches flushed."""
+
+        with self._lock:
+            dirty = sorted(self._dirty)
+            self._dirty.clear()
+            pending: Dict[str, Dict[Tuple[str, str], bytes]] = {}
+            for day_key, dimension, value in dirty:
+                pending.setdefault(day_key, {})[(dimension, value)] = bytes(
+                    self._sketches[(day_key, dimension, value)].registers
+                )
+            self._prune()
+
+        flushed = 0
+        for day_key, registers in pending.items():
+            try:
+                _merge_day(db, day_key, registers, self._precision)
+                flushed += len(registers)
+            except Exception as exc:  # noqa: BLE001
+                with self._lock:
+                    self._dirty.update((day_key, dimension, value) for dimension, value in registers)
+                LOGGER.warning("Cardinality flush failed", extra={"day": day_key, "error": str(exc)})
+        if flushed:
+            LOGGER.info("Cardinality sketches flushed", extra={"sketches": flushed})
+        return flushed
+
+    def estimate(
+        self,
+        db: Optional[firestore.Client],
+        day_key: str,
+        dimension: str,
+        value: Optional[str] = None,
+    ) -> Dict[str, int]:
+        """Distinct users per value of `dimension` (or just `value`) for a day."""
+
+        merged: Dict[str, HyperLogLog] = {}
+        if db is not None:
+            snapshot = db.collection("usage_cardinality").document(day_key).get()
+            stored = ((snapshot.to_dict() or {}).get("sketches") or {}) if snapshot.exists else {}
+            for stored_value, payload in (stored.get(dimension) or {}).items():
+                if value is None or stored_value == value:
+                    merged[stored_value] = HyperLogLog.from_bytes(payload)
+        with self._lock:
+            for (day, dim, local_value), sketch in self._sketches.items():
+                if day != day_key or dim != dimension or (value is not None and local_value != value):
+                    continue
+                if local_value in merged:
+                    merged[local_value].merge(sketch)
+                else:
+                    merged[local_value] = HyperLogLog(sketch.precision, bytearray(sketch.registers))
+        return {item: sketch.estimate() for item, sketch in sorted(merged.items())}
+
+    def _prune(self) -> None:
+        days = sorted({day for day, _, _ in self._sketches})
+        for stale in days[: -self._retained]:
+            for key in [key for key in self._sketches if key[0] == stale and key not in self._dirty]:
+                del self._sketches[key]
+
+
+def _merge_day(
+    db: firestore.Client,
+    day_key: str,
+    registers: Dict[Tuple[str, str], bytes],
+    precision: int,
+) -> None:
+    doc_ref = db.collection("usage_cardinality").document(day_key)
+
+    @firestore.transactional
+    def _txn(transaction: firestore.Transaction) -> None:
+        snapshot = doc_ref.get(transaction=transaction)
+        stored = ((snapshot.to_dict() or {}).get("sketches") or {}) if snapshot.exists else {}
+        sketches: Dict[str, Dict[str, bytes]] = {}
+        for (dimension, value), local_registers in registers.items():
+            sketch = HyperLogLog(precision, bytearray(local_registers))
+            existing = (stored.get(dimension) or {}).get(value)
+            if existing:
+                sketch.merge(HyperLogLog.from_bytes(existing))
+            sketches.setdefault(dimension, {})[value] = sketch.to_bytes()
+        transaction.set(
+            doc_ref,
+            {"day": day_key, "sketches": sketches, "updatedAt": firestore.SERVER_TIMESTAMP},
+            merge=True,
+        )
+
+    _txn(db.transaction())
+
+
+def _sigma(x: float) -> float:
+    if x == 1.0:
+        return math.inf
+    y = 1.0
+    z = x
+    while True:
+        x *= x
+        previous = z
+        z += x * y
+        y += y
+        if z == previous:
+            return z
+
+
+def _tau(x: float) -> float:
+    if x == 0.0 or x == 1.0:
+        return 0.0
+    y = 1.0
+    z = 1.0 - x
+    while True:
+        x = math.sqrt(x)
+        previous = z
+        y *= 0.5
+        z -= (1.0 - x) ** 2 * y
+        if z == previous:
+            return z / 3.0
+
+
+def _dimension_values(event: Dict[str, Any]) -> Iterable[Tuple[str, str]]:
+    yield ALL_DIMENSION, ALL_DIMENSION
+    for dimension in DIMENSIONS:
+        value = event.get(dimension)
+        if value:
+            yield dimension, str(value)
+
+
+DEFAULT_CARDINALITY = CardinalityTracker(
+    precision=int(os.getenv("CARDINALITY_PRECISION", "12")),
+    flush_seconds=float(os.getenv("CARDINALITY_FLUSH_SECONDS", "60")),
+)
@@ -0,0 +1,513 @@
+from __future__ import annotations
+
+import datetime as dt
+import os
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.config.logger import get_logger
+from app.utils import metrics
+from app.utils.cache import TtlCache
+from app.utils.lazy import lazy_import
+from app.utils.periodic import worker_id
+from .resilience import STORAGE_GUARD, call_options
+
+firestore = lazy_import("google.cloud.firestore")
+LOGGER = get_logger("usage_service.credits")
+
+USER_CREDITS_COLLECTION = "user_credits"
+SETTLED_SUBCOLLECTION = "settled"
+CREDIT_LEASE_BLOCK_USD = float(os.getenv("CREDIT_LEASE_BLOCK_USD", "1.0"))
+CREDIT_LEASE_TTL_SECONDS = float(os.getenv("CREDIT_LEASE_TTL_SECONDS", "600"))
+CREDIT_LEASE_IDLE_SECONDS = float(os.getenv("CREDIT_LEASE_IDLE_SECONDS", "300"))
+CREDIT_RECONCILE_SECONDS = float(os.getenv("CREDIT_RECONCILE_SECONDS", "30"))
+CREDIT_RESERVATION_TTL_SECONDS = float(os.getenv("CREDIT_RESERVATION_TTL_SECONDS", "600"))
+CREDIT_SETTLED_RETENTION_SECONDS = float(os.getenv("CREDIT_SETTLED_RETENTION_SECONDS", "86400"))
+
+# Settlement docs created per write-back transaction (Firestore allows 500 writes).
+_SETTLED_PER_WRITE_BACK = 400
+
+# Amounts below this are treated as zero (float noise from repeated sums).
+_EPSILON_USD = 1e-9
+
+CREDIT_RESERVATIONS = metrics.counter("usage_credit_reservations_total", "Credit reservations by result.")
+CREDIT_LEASES = metrics.counter("usage_credit_lease_transactions_total", "Firestore transactions on user_credits by kind.")
+CREDIT_SETTLED = metrics.counter("usage_credit_settled_usd_total", "USD charged against credit balances.")
+CREDIT_DUPLICATES = metrics.counter(
+    "usage_credit_duplicate_settlements_total", "Settlements dropped at write-back: another worker settled first."
+)
+
+
+@dataclass
+class _Account:
+    """This worker's view of one user's credits.
+
+    `lease` is credit moved out of `balanceUsd` into this worker's lease
+    entry; `spent` is committed spend not yet written back, and `settled`
+    the reservations it includes. Local availability is lease - spent -
+    open reservations.
+    """
+
+    db: Any
+    lease: float = 0.0
+    lease_expires_at: float = 0.0
+    spent: float = 0.0
+    reservations: Dict[str, Tuple[float, float]] = field(default_factory=dict)  # id -> (amountUsd, expires_at)
+    # id -> (USD added to `spent`, USD debited straight from the balance)
+    settled: Dict[str, Tuple[float, float]] = field(default_factory=dict)
+    touched_at: float = 0.0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def reserved(self, now: float) -> float:
+        for reservation_id in [key for key, (_, expires_at) in self.reservations.items() if expires_at <= now]:
+            del self.reservations[reservation_id]
+        return sum(amount for amount, _ in self.reservations.values())
+
+    def available(self, now: float) -> float:
+        return self.lease - self.spent - self.reserved(now)
+
+
+@dataclass(frozen=True)
+class Reservation:
+    ok: bool
+    reservationId: Optional[str] = None
+    amountUsd: float = 0.0
+    availableUsd: Optional[float] = None
+    reason: Optional[str] = None
+
+
+class CreditLedger:
+    """Per-user USD credit balances in `user_credits/{userId}` with local leases.
+
+    Reservations are served from a block leased into this worker
+    (`leases.{worker}` on the user's doc); a Firestore transaction is only
+    needed when the local block runs out. Commits add to local spend, which
+    a background reconciliation writes back by shrinking the lease, and
+    idle leases are returned to `balanceUsd`. Leases carry `expireAt`; any
+    worker returns expired leases of other workers during reconciliation,
+    so a crashed worker's unreported spend (at most one block) is forgiven
+    rather than charged twice.
+
+    Reservations live in the worker that made them. A commit or settlement
+    arriving at another worker charges its own lease, and the original
+    hold lapses after its TTL. Each reservation is charged once: the
+    write-back records it in `user_credits/{userId}/settled/{id}` and drops
+    any settlement another worker already recorded, and commits check that
+    doc first.
+    """
+
+    def __init__(
+        self,
+        lease_block_usd: float = CREDIT_LEASE_BLOCK_USD,
+        lease_ttl_seconds: float = CREDIT_LEASE_TTL_SECONDS,
+        lease_idle_seconds: float = CREDIT_LEASE_IDLE_SECONDS,
+        reconcile_seconds: float = CREDIT_RECONCILE_SECONDS,
+        reservation_ttl_seconds: float = CREDIT_RESERVATION_TTL_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.lease_block_usd = lease_block_usd
+        self.lease_ttl_seconds = lease_ttl_seconds
+        self.lease_idle_seconds = lease_idle_seconds
+        self.reconcile_seconds = reconcile_seconds
+        self.reservation_ttl_seconds = reservation_ttl_seconds
+        self._clock = clock
+        self._accounts: Dict[str, _Account] = {}
+        self._lock = threading.Lock()
+        # Reservation IDs known to be committed or released (retried calls are no-ops).
+        self._closed: TtlCache[float] = TtlCache(max_entries=100_000, ttl_seconds=reservation_ttl_seconds)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def _worker(self) -> str:
+        # Resolved per call, not in __init__: with preload_app the ledger is
+        # built in the gunicorn master and every forked worker needs its own
+        # `leases` entry.
+        return re.sub(r"[^A-Za-z0-9_-]", "_", worker_id())
+
+    # -- producer API -------------------------------------------------
+
+    def reserve(
+        self,
+        db: Any,
+        user_id: str,
+        amount_usd: float,
+        reservation_id: Optional[str] = None,
+        ttl_seconds: Optional[float] = None,
+    ) -> Reservation:
+        reservation_id = reservation_id or uuid.uuid4().hex
+        account = self._account(db, user_id)
+        with account.lock:
+            now = self._clock()
+            account.touched_at = now
+            if reservation_id in account.reservations:
+                return Reservation(True, reservation_id, account.reservations[reservation_id][0])
+            shortfall = amount_usd - account.available(now)
+            if shortfall > _EPSILON_USD:
+                leased, balance = self._lease(account, user_id, shortfall)
+                if leased is None:
+                    CREDIT_RESERVATIONS.inc(result="no_account")
+                    return Reservation(False, reason="no_account")
+                if leased + _EPSILON_USD < shortfall:
+                    CREDIT_RESERVATIONS.inc(result="insufficient_credits")
+                    return Reservation(
+                        False,
+                        reason="insufficient_credits",
+                        availableUsd=round(max(0.0, account.available(now)) + balance, 6),
+                    )
+            ttl = self.reservation_ttl_seconds if ttl_seconds is None else ttl_seconds
+            account.reservations[reservation_id] = (amount_usd, now + ttl)
+            CREDIT_RESERVATIONS.inc(result="local" if shortfall <= _EPSILON_USD else "leased")
+            return Reservation(True, reservation_id, amount_usd, availableUsd=round(account.available(now), 6))
+
+    def commit(self, db: Any, user_id: str, reservation_id: Optional[str], actual_usd: float) -> float:
+        """Charge `actual_usd`, closing the reservation. Returns the charge (0 if already settled)."""
+
+        if reservation_id and self._is_settled(db, user_id, reservation_id):
+            return 0.0
+        account = self._account(db, user_id)
+        with account.lock:
+            account.touched_at = self._clock()
+            if reservation_id:
+                if self._closed.get(reservation_id) is not None:
+                    return 0.0
+                account.reservations.pop(reservation_id, None)
+                self._closed.set(reservation_id, actual_usd)
+            local, debited = max(actual_usd, 0.0), 0.0
+            shortfall = local - account.available(account.touched_at) if local > 0 else 0.0
+            if shortfall > _EPSILON_USD:
+                leased, _ = self._lease(account, user_id, shortfall, allow_partial=True)
+                if leased is None:
+                    return 0.0
+                if leased + _EPSILON_USD < shortfall:
+                    # The usage already happened: charge the rest straight to the balance.
+                    debited = shortfall - leased
+                    self._debit(account, user_id, debited)
+                    local -= debited
+            account.spent += local
+            if reservation_id:
+                account.settled[reservation_id] = (local, debited)
+        if actual_usd <= 0:
+            return 0.0
+        CREDIT_SETTLED.inc(actual_usd)
+        return actual_usd
+
+    def release(self, user_id: str, reservation_id: str) -> bool:
+        self._closed.set(reservation_id, 0.0)
+        with self._lock:
+            account = self._accounts.get(user_id)
+        if account is None:
+            return False
+        with account.lock:
+            return account.reservations.pop(reservation_id, None) is not None
+
+    def observe_event(self, db: Any, event: Dict[str, Any]) -> None:
+        """Commit listener: settle `credits.reservationId` events at their actual costUSD."""
+
+        credits = event.get("credits")
+        if not isinstance(credits, dict) or not credits.get("reservationId"):
+            return
+        charged = self.commit(db, event["userId"], str(credits["reservationId"]), float(event.get("costUSD") or 0.0))
+        LOGGER.info(
+            "Credits settled at ingest",
+            extra={"requestId": event.get("requestId"), "userId": event["userId"], "chargedUsd": charged},
+        )
+
+    def local_state(self, user_id: str) -> Dict[str, float]:
+        with self._lock:
+            account = self._accounts.get(user_id)
+        if account is None:
+            return {"leaseUsd": 0.0, "unreportedSpendUsd": 0.0, "reservedUsd": 0.0}
+        with account.lock:
+            return {
+                "leaseUsd": round(account.lease, 6),
+                "unreportedSpendUsd": round(account.spent, 6),
+                "reservedUsd": round(account.reserved(self._clock()), 6),
+            }
+
+    # -- reconciliation -----------------------------------------------
+
+    def reconcile(self, return_all: bool = False) -> int:
+        """Write local spend back to Firestore and return idle leases. Returns accounts written."""
+
+        with self._lock:
+            accounts = list(self._accounts.items())
+        written = 0
+        for user_id, account in accounts:
+            with account.lock:
+                now = self._clock()
+                idle = now - account.touched_at >= self.lease_idle_seconds and not account.reserved(now)
+                # An unused lease is only renewed before another worker could sweep it.
+                renew = account.lease > _EPSILON_USD and now >= account.lease_expires_at - 2 * self.reconcile_seconds
+                release = return_all or idle
+                if not (account.spent > _EPSILON_USD or account.settled or renew or (release and account.lease > _EPSILON_USD)):
+                    if idle:
+                        self._drop_if_idle(user_id, account)
+                    continue
+                try:
+                    self._write_back(account, user_id, release=release)
+                    while account.settled:
+                        self._write_back(account, user_id, release=release)
+                    written += 1
+                except Exception as exc:  # noqa: BLE001
+                    LOGGER.warning("Credit reconciliation failed", extra={"userId": user_id, "error": str(exc)})
+                    continue
+            if idle or return_all:
+                self._drop_if_idle(user_id, account)
+        return written
+
+    def start(self) -> None:
+        if self._thread is not None or self.reconcile_seconds <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="credit-reconcile", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the thread and hand every lease back to the balances."""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.reconcile_seconds)
+            self._thread = None
+        self.reconcile(return_all=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.reconcile_seconds):
+            try:
+                self.reconcile()
+            except Exception as exc:  # noqa: BLE001
+                LOGGER.warning("Credit reconciliation loop failed", extra={"error": str(exc)})
+
+    def _drop_if_idle(self, user_id: str, account: _Account) -> None:
+        with self._lock:
+            if self._accounts.get(user_id) is account and account.lease <= _EPSILON_USD and not account.settled:
+                del self._accounts[user_id]
+
+    # -- Firestore ----------------------------------------------------
+
+    def _account(self, db: Any, user_id: str) -> _Account:
+        with self._lock:
+            account = self._accounts.get(user_id)
+            if account is None:
+                account = _Account(db=db, touched_at=self._clock())
+                self._accounts[user_id] = account
+            return account
+
+    def _ref(self, account: _Account, user_id: str) -> Any:
+        return account.db.collection(USER_CREDITS_COLLECTION).document(user_id)
+
+    def _is_settled(self, db: Any, user_id: str, reservation_id: str) -> bool:
+        """Whether the reservation was committed or released here, or settled by any worker."""
+
+        if self._closed.get(reservation_id) is not None:
+            return True
+        settled_ref = (
+            db.collection(USER_CREDITS_COLLECTION).document(user_id).collection(SETTLED_SUBCOLLECTION).document(reservation_id)
+        )
+        snapshot = STORAGE_GUARD.run("credits_settled", settled_ref.get, **call_options())
+        if not snapshot.exists:
+            return False
+        self._closed.set(reservation_id, float((snapshot.to_dict() or {}).get("amountUsd") or 0.0))
+        return True
+
+    def _lease(
+        self, account: _Account, user_id: str, needed: float, allow_partial: bool = False
+    ) -> Tuple[Optional[float], float]:
+        """Move at least `needed` (a block if possible) from balanceUsd into this worker's lease.
+
+        Returns (leased, balance left); leased is None without a credits doc.
+        Without `allow_partial`, nothing is leased unless `needed` is covered.
+        Caller holds `account.lock`.
+        """
+
+        ref = self._ref(account, user_id)
+        wall_now = dt.datetime.now(dt.timezone.utc)
+
+        @firestore.transactional
+        def _txn(transaction: Any) -> Tuple[Optional[float], float]:
+            snapshot = ref.get(transaction=transaction, **call_options())
+            if not snapshot.exists:
+                return None, 0.0
+            data = snapshot.to_dict() or {}
+            balance = float(data.get("balanceUsd") or 0.0)
+            if balance + _EPSILON_USD < needed and not allow_partial:
+                return 0.0, balance
+            grant = max(0.0, min(balance, max(needed, self.lease_block_usd)))
+            current = float(((data.get("leases") or {}).get(self._worker) or {}).get("amountUsd") or 0.0)
+            transaction.set(
+                ref,
+                {
+                    "balanceUsd": balance - grant,
+                    "leases": {
+                        self._worker: {
+                            "amountUsd": current + grant,
+                            "expireAt": wall_now + dt.timedelta(seconds=self.lease_ttl_seconds),
+                        }
+                    },
+                    "updatedAt": firestore.SERVER_TIMESTAMP,
+                },
+                merge=True,
+            )
+            return grant, balance - grant
+
+        leased, balance = STORAGE_GUARD.run("credits_lease", _txn, account.db.transaction())
+        CREDIT_LEASES.inc(kind="lease")
+        if leased:
+            account.lease += leased
+            account.lease_expires_at = self._clock() + self.lease_ttl_seconds
+        return leased, balance
+
+    def _debit(self, account: _Account, user_id: str, amount: float) -> None:
+        ref = self._ref(account, user_id)
+        STORAGE_GUARD.run(
+            "credits_debit",
+            ref.update,
+            {
+                "balanceUsd": firestore.Increment(-amount),
+                "spentUsd": firestore.Increment(amount),
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+            },
+            **call_options(),
+        )
+        CREDIT_LEASES.inc(kind="debit")
+
+    def _write_back(self, account: _Account, user_id: str, release: bool) -> None:
+        """Shrink this worker's lease by local spend; optionally return the rest.
+
+        Records up to _SETTLED_PER_WRITE_BACK settled reservations; one that
+        another worker already recorded is not charged again (its debit goes
+        back to the balance). Also returns other workers' expired leases. If
+        this worker's own lease was already swept as expired, the spend is
+        charged to the balance directly and the local lease is dropped.
+        Caller holds `account.lock`.
+        """
+
+        ref = self._ref(account, user_id)
+        wall_now = dt.datetime.now(dt.timezone.utc)
+        settled = dict(list(account.settled.items())[:_SETTLED_PER_WRITE_BACK])
+        # Spend of settlements left for the next write-back stays local.
+        spent = account.spent - sum(local for rid, (local, _) in account.settled.items() if rid not in settled)
+        keep = 0.0 if release else max(0.0, account.lease - spent)
+        settled_refs = {rid: ref.collection(SETTLED_SUBCOLLECTION).document(rid) for rid in settled}
+
+        @firestore.transactional
+        def _txn(transaction: Any) -> Tuple[float, int]:
+            snapshot = ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return keep, 0
+            fresh = []
+            duplicate_local = duplicate_debit = 0.0
+            for rid, settled_ref in settled_refs.items():
+                if settled_ref.get(transaction=transaction).exists:
+                    duplicate_local += settled[rid][0]
+                    duplicate_debit += settled[rid][1]
+                else:
+                    fresh.append(rid)
+            charged = spent - duplicate_local
+            data = snapshot.to_dict() or {}
+            leases = dict(data.get("leases") or {})
+            balance = float(data.get("balanceUsd") or 0.0) + duplicate_debit
+            own = leases.pop(self._worker, None)
+            kept = keep
+            if own is None:
+                # Swept as expired by another worker: the whole lease is already
+                # back in the balance, so nothing is kept; the next reserve
+                # leases again.
+                balance -= charged
+                kept = 0.0
+            else:
+                balance += float(own.get("amountUsd") or 0.0) - charged - kept
+            for name, lease in list(leases.items()):
+                expire_at = (lease or {}).get("expireAt")
+                if isinstance(expire_at, dt.datetime) and expire_at < wall_now:
+                    balance += float(lease.get("amountUsd") or 0.0)
+                    leases[name] = firestore.DELETE_FIELD
+                else:
+                    del leases[name]
+            if kept > _EPSILON_USD:
+                leases[self._worker] = {
+                    "amountUsd": kept,
+                    "expireAt": wall_now + dt.timedelta(seconds=self.lease_ttl_seconds),
+                }
+            elif own is not None:
+                leases[self._worker] = firestore.DELETE_FIELD
+            update: Dict[str, Any] = {
+                "balanceUsd": balance,
+                "spentUsd": firestore.Increment(charged - duplicate_debit),
+                "reconciledAt": firestore.SERVER_TIMESTAMP,
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+            }
+            if leases:
+                update["leases"] = leases
+            transaction.set(ref, update, merge=True)
+            for rid in fresh:
+                transaction.set(
+                    settled_refs[rid],
+                    {
+                        "amountUsd": sum(settled[rid]),
+                        "settledAt": firestore.SERVER_TIMESTAMP,
+                        "expireAt": wall_now + dt.timedelta(seconds=CREDIT_SETTLED_RETENTION_SECONDS),
+                    },
+                )
+            return kept, len(settled) - len(fresh)
+
+        account.lease, duplicates = _txn(account.db.transaction())
+        CREDIT_LEASES.inc(kind="reconcile")
+        account.spent -= spent
+        for rid in settled:
+            del account.settled[rid]
+        if account.lease > _EPSILON_USD:
+            account.lease_expires_at = self._clock() + self.lease_ttl_seconds
+        if duplicates:
+            CREDIT_DUPLICATES.inc(duplicates)
+            LOGGER.warning("Duplicate credit settlements dropped", extra={"userId": user_id, "count": duplicates})
+
+
+def grant_credits(db: Any, user_id: str, amount_usd: float, grant_id: Optional[str] = None) -> Tuple[bool, float]:
+    """Add to `balanceUsd` (creating the doc). A repeated `grant_id` is a no-op.
+
+    Returns (applied, balanceUsd after the transaction).
+    """
+
+    ref = db.collection(USER_CREDITS_COLLECTION).document(user_id)
+    grant_ref = ref.collection("grants").document(grant_id) if grant_id else None
+
+    @firestore.transactional
+    def _txn(transaction: Any) -> Tuple[bool, float]:
+        snapshot = ref.get(transaction=transaction, **call_options())
+        balance = float((snapshot.to_dict() or {}).get("balanceUsd") or 0.0) if snapshot.exists else 0.0
+        if grant_ref is not None and grant_ref.get(transaction=transaction, **call_options()).exists:
+            return False, balance
+        transaction.set(
+            ref,
+            {"userId": user_id, "balanceUsd": balance + amount_usd, "updatedAt": firestore.SERVER_TIMESTAMP},
+            merge=True,
+        )
+        if grant_ref is not None:
+            transaction.set(grant_ref, {"amountUsd": amount_usd, "createdAt": firestore.SERVER_TIMESTAMP})
+        return True, balance + amount_usd
+
+    return STORAGE_GUARD.run("credits_grant", _txn, db.transaction())
+
+
+def read_credits(db: Any, user_id: str) -> Optional[Dict[str, Any]]:
+    snapshot = STORAGE_GUARD.run(
+        "credits_read", db.collection(USER_CREDITS_COLLECTION).document(user_id).get, **call_options()
+    )
+    if not snapshot.exists:
+        return None
+    data = snapshot.to_dict() or {}
+    leases: List[Dict[str, Any]] = list((data.get("leases") or {}).values())
+    return {
+        "balanceUsd": round(float(data.get("balanceUsd") or 0.0), 6),
+        "leasedUsd": round(sum(float((lease or {}).get("amountUsd") or 0.0) for lease in leases), 6),
+        "spentUsd": round(float(data.get("spentUsd") or 0.0), 6),
+    }
+
+
+DEFAULT_LEDGER = CreditLedger()
@@ -1,40 +1,200 @@
-from typing import Dict
+from __future__ import annotations
 
-from google.cloud import firestore
+import datetime as dt
+import os
+import time
+from typing import Callable, Dict, Iterator, List, Optional
 
 from app.config.logger import get_logger
+from app.utils import metrics
+from app.utils.lazy import lazy_import
+from .resilience import STORAGE_GUARD, call_options
 
+firestore = lazy_import("google.cloud.firestore")
 LOGGER = get_logger("usage_service.dedup")
 
-def acquire_request_lock(
+DEDUP_COLLECTION = "request_dedup"
+DEDUP_WINDOW_SECONDS = int(os.getenv("DEDUP_WINDOW_SECONDS", str(7 * 24 * 3600)))
+DEDUP_BUCKETED_LAYOUT = os.getenv("DEDUP_BUCKETED_LAYOUT", "").lower() in ("1", "true", "yes", "on")
+
+DEDUP_LOCKS = metrics.counter("usage_dedup_locks_total", "Dedup lock attempts by result.")
+DEDUP_DELETED = metrics.counter("usage_dedup_deleted_total", "Expired request_dedup docs deleted by cleanup.")
+DEDUP_LIVE_KEYS = metrics.gauge("usage_dedup_live_keys", "request_dedup docs whose expireAt is in the future.")
+
+
+def dedup_doc_id(request_id: str, bucket: Optional[str] = None) -> str:
+    """Doc ID for a requestId; `{bucket}_{requestId}` in the bucketed layout.
+
+    The bucket is derived from the event timestamp (YYYYMMDD), so retries of
+    the same event always map to the same doc.
+    """
+
+    if DEDUP_BUCKETED_LAYOUT and bucket:
+        return f"{bucket}_{request_id}"
+    return request_id
+
+
+def claim_request(
+    transaction: firestore.Transaction,
     db: firestore.Client,
     request_id: str,
     metadata: Dict,
-) -> bool:
-    """Atomically create request_dedup/{requestId}.
+    bucket: Optional[str] = None,
+) -> Optional[Callable[[], None]]:
+    """Read request_dedup/{requestId} inside the caller's transaction.
 
-    Returns:
-        True if the lock was acquired (first request).
-        False if the requestId already exists.
+    Called before the transaction's other reads. Returns None if the
+    requestId already exists, otherwise a callable that writes the doc in
+    the same transaction, so the lock commits (or fails) together with the
+    writes it guards. The doc carries `expireAt` (now +
+    DEDUP_WINDOW_SECONDS) for Firestore TTL policies; an existing doc past
+    its `expireAt` counts as absent.
     """
 
+    doc_ref = db.collection(DEDUP_COLLECTION).document(dedup_doc_id(request_id, bucket))
+    now = dt.datetime.now(dt.timezone.utc)
+    snapshot = doc_ref.get(transaction=transaction, **call_options())
+    if snapshot.exists and not _is_expired(snapshot, now):
+        LOGGER.info("Dedup lock exists; skipping", extra={"requestId": request_id})
+        return None
+    payload = dict(metadata)
+    payload["expireAt"] = now + dt.timedelta(seconds=DEDUP_WINDOW_SECONDS)
+    return lambda: transaction.set(doc_ref, payload)
+
+
+def record_lock_result(request_id: str, acquired: bool) -> None:
+    DEDUP_LOCKS.inc(result="acquired" if acquired else "duplicate")
+    LOGGER.info("Dedup lock result", extra={"requestId": request_id, "acquired": acquired})
+
+
+def cleanup_expired_dedup(
+    db: firestore.Client,
+    *,
+    now: Optional[dt.datetime] = None,
+    page_size: int = 500,
+    max_ops_per_second: int = 500,
+    max_deletes: Optional[int] = None,
+) -> int:
+    """Delete request_dedup docs past `expireAt` for backends without native TTL.
+
+    Docs written before `expireAt` existed are deleted once their
+    `createdAt` is older than DEDUP_WINDOW_SECONDS. Deletes go through a
+    BulkWriter capped at `max_ops_per_second`. Returns the number of docs
+    deleted, never more than `max_deletes`.
+    """
+
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    now = now or dt.datetime.now(dt.timezone.utc)
+    collection = db.collection(DEDUP_COLLECTION)
+    writer = _bulk_writer(db, max_ops_per_second)
+    deleted = 0
+    started = time.monotonic()
+    try:
+        for field, cutoff, legacy in (
+            ("expireAt", now, False),
+            ("createdAt", now - dt.timedelta(seconds=DEDUP_WINDOW_SECONDS), True),
+        ):
+            remaining = None if max_deletes is None else max_deletes - deleted
+            query = collection.where(filter=FieldFilter(field, "<", cutoff)).order_by(field)
+            # The createdAt pass skips docs that have expireAt, so its pages
+            # are not cut to the remaining budget; the deletes are.
+            for page in _pages(query, page_size, None if legacy else remaining):
+                doomed = [snapshot for snapshot in page if not legacy or "expireAt" not in (snapshot.to_dict() or {})]
+                if max_deletes is not None:
+                    doomed = doomed[: max_deletes - deleted]
+                for snapshot in doomed:
+                    writer.delete(snapshot.reference)
+                writer.flush()
+                deleted += len(doomed)
+                DEDUP_DELETED.inc(len(doomed))
+                if max_deletes is not None and deleted >= max_deletes:
+                    break
+            if max_deletes is not None and deleted >= max_deletes:
+                break
+    finally:
+        writer.close()
     LOGGER.info(
-        "Dedup lock attempt",
-        extra={"requestId": request_id, "metadata": metadata},
+        "Dedup cleanup finished",
+        extra={"deleted": deleted, "elapsedSeconds": round(time.monotonic() - started, 3)},
+    )
+    return deleted
+
+
+def backfill_dedup_expire_at(db: firestore.Client, *, page_size: int = 500, max_ops_per_second: int = 500) -> int:
+    """Set `expireAt` (createdAt + DEDUP_WINDOW_SECONDS) on docs written without it.
+
+    One-off full scan so a Firestore TTL policy can expire legacy docs.
+    Returns the number of docs updated.
+    """
+
+    writer = _bulk_writer(db, max_ops_per_second)
+    updated = 0
+    now = dt.datetime.now(dt.timezone.utc)
+    try:
+        for page in _pages(db.collection(DEDUP_COLLECTION).order_by("__name__"), page_size, None):
+            for snapshot in page:
+                data = snapshot.to_dict() or {}
+                if "expireAt" in data:
+                    continue
+                created_at = data.get("createdAt")
+                base = created_at if isinstance(created_at, dt.datetime) else now
+                writer.update(snapshot.reference, {"expireAt": base + dt.timedelta(seconds=DEDUP_WINDOW_SECONDS)})
+                updated += 1
+            writer.flush()
+    finally:
+        writer.close()
+    LOGGER.info("Dedup expireAt backfill finished", extra={"updated": updated})
+    return updated
+
+
+def count_live_dedup_keys(
+    db: firestore.Client,
+    now: Optional[dt.datetime] = None,
+    partition: Optional[str] = None,
+) -> int:
+    """Count unexpired dedup docs with an aggregation query and update the gauge.
+
+    With `partition` set the gauge sample is labelled with it.
+    """
+
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    now = now or dt.datetime.now(dt.timezone.utc)
+    query = db.collection(DEDUP_COLLECTION).where(filter=FieldFilter("expireAt", ">=", now))
+    results = query.count(alias="live").get()
+    live = int(results[0][0].value) if results and results[0] else 0
+    DEDUP_LIVE_KEYS.set(live, **({"partition": partition} if partition else {}))
+    return live
+
+
+def _bulk_writer(db: firestore.Client, max_ops_per_second: int):
+    from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
+
+    options = BulkWriterOptions(
+        initial_ops_per_second=min(max_ops_per_second, 500),
+        max_ops_per_second=max_ops_per_second,
     )
-    doc_ref = db.collection("request_dedup").document(request_id)
-
-    @firestore.transactional
-    def _txn(transaction: firestore.Transaction) -> bool:
-        snapshot = doc_ref.get(transaction=transaction)
-        if snapshot.exists:
-            LOGGER.info("Dedup lock exists; skipping", extra={"requestId": request_id})
-            return False
-        transaction.set(doc_ref, metadata, merge=True)
-        LOGGER.info("Dedup lock acquired", extra={"requestId": request_id})
-        return True
-
-    transaction = db.transaction()
-    result = _txn(transaction)
-    LOGGER.info("Dedup lock result", extra={"requestId": request_id, "acquired": result})
-    return result
+    return db.bulk_writer(options=options)
+
+
+def _pages(query, page_size: int, budget: Optional[int]) -> Iterator[List[firestore.DocumentSnapshot]]:
+    """Page through `query` with a cursor; the last page is cut to `budget` docs."""
+
+    last = None
+    while budget is None or budget > 0:
+        limit = page_size if budget is None else min(page_size, budget)
+        page = list((query.start_after(last) if last is not None else query).limit(limit).stream())
+        if not page:
+            return
+        yield page
+        if budget is not None:
+            budget -= len(page)
+        if len(page) < limit:
+            return
+        last = page[-1]
+
+
+def _is_expired(snapshot: firestore.DocumentSnapshot, now: dt.datetime) -> bool:
+    expire_at = (snapshot.to_dict() or {}).get("expireAt")
+    return expire_at is not None and expire_at < now
@@ -0,0 +1,78 @@
+import datetime as dt
+from typing import Any, Dict, Iterable
+
+# Firestore storage size rules:
+# https://firebase.google.com/docs/firestore/storage-size
+_FIXED_SIZE = 8
+
+
+def field_bytes(name: str, value: Any) -> int:
+    """Storage size of one field: name (UTF-8 + 1) plus its value."""
+
+    return len(name.encode("utf-8")) + 1 + value_bytes(value)
+
+
+def value_bytes(value: Any) -> int:
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float, dt.datetime)):
+        return _FIXED_SIZE
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return map_bytes(value)
+    if isinstance(value, (list, tuple)):
+        return sum(value_bytes(item) for item in value)
+    # Sentinels and transforms (SERVER_TIMESTAMP, Increment, ...) resolve to
+    # 8-byte numbers or timestamps.
+    return _FIXED_SIZE
+
+
+def map_bytes(payload: Dict[str, Any]) -> int:
+    return sum(field_bytes(str(name), value) for name, value in payload.items())
+
+
+def document_bytes(collection: str, doc_id: str, payload: Dict[str, Any]) -> int:
+    """Approximate stored size of a top-level document with `payload`."""
+
+    name_size = len(collection.encode("utf-8")) + 1 + len(doc_id.encode("utf-8")) + 1 + 16
+    return name_size + map_bytes(payload) + 32
+
+
+def single_field_index_bytes(
+    collection: str,
+    doc_id: str,
+    payload: Dict[str, Any],
+    exempt: Iterable[str] = (),
+) -> int:
+    """Approximate size of the automatic single-field index entries for a doc.
+
+    Every scalar leaf (nested map fields included) gets an ascending and a
+    descending entry; arrays get one array-contains entry per element.
+    Top-level fields in `exempt` have index exemptions and add nothing.
+    """
+
+    doc_name = len(collection.encode("utf-8")) + 1 + len(doc_id.encode("utf-8")) + 1 + 16
+    parent = len(collection.encode("utf-8")) + 1
+    skipped = set(exempt)
+    total = 0
+    for path, value in _leaves(payload):
+        if path.split(".", 1)[0] in skipped:
+            continue
+        entry = doc_name + parent + len(path.encode("utf-8")) + 1 + 32
+        if isinstance(value, (list, tuple)):
+            total += sum(entry + value_bytes(item) for item in value)
+        else:
+            total += 2 * (entry + value_bytes(value))
+    return total
+
+
+def _leaves(payload: Dict[str, Any], prefix: str = ""):
+    for name, value in payload.items():
+        path = f"{prefix}{name}"
+        if isinstance(value, dict) and value:
+            yield from _leaves(value, f"{path}.")
+        else:
+            yield path, value
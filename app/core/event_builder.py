@@ -8,12 +8,14 @@ from app.config.logger import get_logger
 
 from .fx import FxRateCache
 from .pricing import calculate_cost_usd
+from .usage_parsers import get_usage_parser, parse_usage
 
 DEFAULT_COST_CALCULATION_VERSION = os.getenv("COST_CALCULATION_VERSION", "pricing_v1.2")
 DEFAULT_CURRENCY = "USD"
 DEFAULT_PROVIDER = "gemini"
 
 _FX_CACHE = FxRateCache()
+_BACKFILLED_USAGE_FIELDS = ("inputTokens", "outputTokens", "totalTokens", "cachedTokens", "reasoningTokens")
 LOGGER = get_logger("usage_service.event_builder")
 
 
@@ -22,6 +24,7 @@ def build_base_event(
     request_id: str,
     user_id: str,
     endpoint: str,
+    org_id: Optional[str] = None,
     provider: Optional[str] = None,
     model: Optional[str] = None,
     token_payload: Optional[Dict[str, Any]] = None,
@@ -55,6 +58,7 @@ def build_base_event(
     event: Dict[str, Any] = {
         "requestId": request_id,
         "userId": user_id,
+        "orgId": org_id or payload.get("orgId"),
         "endpoint": endpoint,
         "provider": provider or payload.get("provider") or DEFAULT_PROVIDER,
         "model": model or payload.get("model"),
@@ -144,16 +148,14 @@ def finalize_event(
 
 def parse_gemini_usage(response_json: Dict[str, Any]) -> Dict[str, int]:
     LOGGER.info("Parsing Gemini usage", extra={"payload": response_json})
-    usage = _resolve_usage_payload(response_json)
-    parsed = _parse_token_counts(usage)
+    parsed = parse_usage("gemini", response_json)
     LOGGER.info("Parsed Gemini usage tokens", extra=parsed)
     return parsed
 
 
 def parse_openai_usage(response_json: Dict[str, Any]) -> Dict[str, int]:
     LOGGER.info("Parsing OpenAI usage", extra={"payload": response_json})
-    usage = _resolve_usage_payload(response_json)
-    parsed = _parse_token_counts(usage)
+    parsed = parse_usage("openai", response_json)
     LOGGER.info("Parsed OpenAI usage tokens", extra=parsed)
     return parsed
 
@@ -163,26 +165,28 @@ def enrich_usage_event(event: Dict[str, Any]) -> Dict[str, Any]:
     raw_usage = event.get("rawUsage") or {}
     if not isinstance(raw_usage, dict):
         raw_usage = {}
-    if raw_usage and (event.get("inputTokens") is None or event.get("outputTokens") is None):
-        if provider == "openai":
-            usage = parse_openai_usage(raw_usage)
-        elif provider == "gemini":
-            usage = parse_gemini_usage(raw_usage)
-        else:
-            usage = _parse_token_counts(raw_usage)
-        if usage:
-            event.setdefault("inputTokens", usage.get("inputTokens", 0))
-            event.setdefault("outputTokens", usage.get("outputTokens", 0))
-            event.setdefault("totalTokens", usage.get("totalTokens", 0))
-            LOGGER.info(
-                "Usage tokens backfilled from rawUsage",
-                extra={
-                    "provider": provider,
-                    "inputTokens": event.get("inputTokens"),
-                    "outputTokens": event.get("outputTokens"),
-                    "totalTokens": event.get("totalTokens"),
-                },
-            )
+    missing = [field for field in _BACKFILLED_USAGE_FIELDS if event.get(field) is None]
+    if event.get("inputTokens") is not None and event.get("outputTokens") is not None and "totalTokens" in missing:
+        # The producer's own counts stand; a rawUsage total need not match them.
+        missing.remove("totalTokens")
+    if raw_usage and missing:
+        parser = get_usage_parser(provider)
+        usage = parser.parse(raw_usage)
+        for field in missing:
+            if field in usage:
+                event[field] = usage[field]
+        LOGGER.info(
+            "Usage tokens backfilled from rawUsage",
+            extra={
+                "provider": provider,
+                "parser": parser.name,
+                "inputTokens": event.get("inputTokens"),
+                "outputTokens": event.get("outputTokens"),
+                "totalTokens": event.get("totalTokens"),
+                "cachedTokens": event.get("cachedTokens"),
+                "reasoningTokens": event.get("reasoningTokens"),
+            },
+        )
 
     input_tokens = _to_int(event.get("inputTokens"))
     output_tokens = _to_int(event.get("outputTokens"))
@@ -274,55 +278,6 @@ def _to_int(value: Any) -> int:
         return 0
 
 
-def _resolve_usage_payload(payload: Dict[str, Any]) -> Dict[str, Any]:
-    if any(
-        key in payload
-        for key in (
-            "promptTokenCount",
-            "candidatesTokenCount",
-            "prompt_tokens",
-            "completion_tokens",
-            "inputTokens",
-            "outputTokens",
-            "total_tokens",
-            "totalTokenCount",
-            "totalTokens",
-        )
-    ):
-        return payload
-    usage = payload.get("usageMetadata") or payload.get("usage_metadata") or payload.get("usage") or {}
-    return usage if isinstance(usage, dict) else {}
-
-
-def _parse_token_counts(usage: Dict[str, Any]) -> Dict[str, int]:
-    thoughts_tokens = _to_int(usage.get("thoughtsTokenCount"))
-    input_tokens = _to_int(
-        usage.get("promptTokenCount")
-        or usage.get("prompt_tokens")
-        or usage.get("inputTokens")
-        or usage.get("input_tokens")
-    )
-    output_tokens = _to_int(
-        usage.get("candidatesTokenCount")
-        or usage.get("completionTokenCount")
-        or usage.get("completion_tokens")
-        or usage.get("outputTokens")
-        or usage.get("output_tokens")
-    )
-    output_tokens += thoughts_tokens
-    total_tokens = _to_int(
-        usage.get("totalTokenCount")
-        or usage.get("total_tokens")
-        or usage.get("totalTokens")
-        or input_tokens + output_tokens
-    )
-    return {
-        "inputTokens": input_tokens,
-        "outputTokens": output_tokens,
-        "totalTokens": total_tokens,
-    }
-
-
 def _calculate_cost_try(cost_usd: float) -> float:
     if not cost_usd:
         return 0.0
@@ -0,0 +1,116 @@
+import datetime as dt
+import json
+import os
+import threading
+import zlib
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # optional dependency; json+zlib is used instead
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # optional dependency; json+zlib is used instead
+    zstandard = None
+
+# Fields kept top-level (and indexed) on compact usage_events docs; every
+# other field lives in the compressed blob.
+INDEXED_FIELDS = ("userId", "timestamp", "action", "model")
+ENCODING_FIELD = "enc"
+BLOB_FIELD = "blob"
+
+MSGPACK_ZSTD = "msgpack+zstd"
+JSON_ZLIB = "json+zlib"
+ZSTD_LEVEL = 3
+
+# Codec for new compact docs. json+zlib is the default: usage events leave
+# ~0.6 KB for the blob, where deflate output is ~8% smaller than zstd's
+# (frame overhead); msgpack+zstd encodes about twice as fast and needs the
+# optional packages. Docs in either encoding always decode.
+RAW_EVENT_CODEC = os.getenv("RAW_EVENT_CODEC", JSON_ZLIB).lower()
+if RAW_EVENT_CODEC not in (MSGPACK_ZSTD, JSON_ZLIB):
+    raise ValueError(f"RAW_EVENT_CODEC must be {JSON_ZLIB} or {MSGPACK_ZSTD}, got {RAW_EVENT_CODEC!r}")
+
+_LOCAL = threading.local()
+
+
+def default_encoding() -> str:
+    """RAW_EVENT_CODEC, or json+zlib when msgpack/zstandard are not installed."""
+
+    if RAW_EVENT_CODEC == MSGPACK_ZSTD and msgpack is not None and zstandard is not None:
+        return MSGPACK_ZSTD
+    return JSON_ZLIB
+
+
+def available_encodings() -> Tuple[str, ...]:
+    return (JSON_ZLIB, MSGPACK_ZSTD) if msgpack is not None and zstandard is not None else (JSON_ZLIB,)
+
+
+def encode_event(event: Dict[str, Any], encoding: Optional[str] = None) -> Dict[str, Any]:
+    """Return the compact document for `event`.
+
+    Datetimes inside the blob are stored as ISO-8601 strings.
+    """
+
+    encoding = encoding or default_encoding()
+    doc = {field: event[field] for field in INDEXED_FIELDS if event.get(field) is not None}
+    rest = {key: value for key, value in event.items() if key not in doc}
+    doc[ENCODING_FIELD] = encoding
+    doc[BLOB_FIELD] = _pack(rest, encoding)
+    return doc
+
+
+def decode_event(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Inverse of `encode_event`; docs written without an encoding pass through."""
+
+    encoding = doc.get(ENCODING_FIELD)
+    if not encoding:
+        return dict(doc)
+    event = {key: value for key, value in doc.items() if key not in (ENCODING_FIELD, BLOB_FIELD)}
+    event.update(_unpack(bytes(doc[BLOB_FIELD]), encoding))
+    return event
+
+
+def _pack(payload: Dict[str, Any], encoding: str) -> bytes:
+    if encoding == MSGPACK_ZSTD:
+        packed = msgpack.packb(payload, default=_to_serializable, use_bin_type=True)
+        return _zstd_compressor().compress(packed)
+    if encoding == JSON_ZLIB:
+        packed = json.dumps(payload, default=_to_serializable, separators=(",", ":")).encode("utf-8")
+        return zlib.compress(packed, 6)
+    raise ValueError(f"Unknown event encoding: {encoding}")
+
+
+def _unpack(blob: bytes, encoding: str) -> Dict[str, Any]:
+    if encoding == MSGPACK_ZSTD:
+        if msgpack is None or zstandard is None:
+            raise RuntimeError("msgpack and zstandard are required to decode msgpack+zstd events")
+        return msgpack.unpackb(_zstd_decompressor().decompress(blob), raw=False)
+    if encoding == JSON_ZLIB:
+        return json.loads(zlib.decompress(blob).decode("utf-8"))
+    raise ValueError(f"Unknown event encoding: {encoding}")
+
+
+def _zstd_compressor():
+    # zstandard (de)compressors are not safe to share between threads.
+    compressor = getattr(_LOCAL, "compressor", None)
+    if compressor is None:
+        compressor = _LOCAL.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return compressor
+
+
+def _zstd_decompressor():
+    decompressor = getattr(_LOCAL, "decompressor", None)
+    if decompressor is None:
+        decompressor = _LOCAL.decompressor = zstandard.ZstdDecompressor()
+    return decompressor
+
+
+def _to_serializable(value: Any) -> Any:
+    if isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    return str(value)
@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import base64
+import csv
+import datetime as dt
+import io
+import json
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .event_codec import decode_event
+
+EXPORT_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="usage-export")
+
+
+@dataclass(frozen=True)
+class ExportSpec:
+    collection: str
+    range_field: str
+    key_format: str  # strptime format of the from/to query params
+    csv_columns: Tuple[str, ...]
+
+
+_AGGREGATE_COLUMNS = (
+    "totalInputTokens",
+    "totalOutputTokens",
+    "totalCostUsd",
+    "totalCostTry",
+    "lastEventAt",
+    "updatedAt",
+    "actions",
+)
+EXPORT_SPECS = {
+    "daily": ExportSpec("usage_daily", "day", "%Y%m%d", ("id", "userId", "day") + _AGGREGATE_COLUMNS),
+    "monthly": ExportSpec("usage_monthly", "month", "%Y%m", ("id", "userId", "month") + _AGGREGATE_COLUMNS),
+    "events": ExportSpec(
+        "usage_events",
+        "timestamp",
+        "%Y%m%d",
+        (
+            "id",
+            "requestId",
+            "userId",
+            "timestamp",
+            "action",
+            "endpoint",
+            "provider",
+            "model",
+            "status",
+            "errorCode",
+            "inputTokens",
+            "outputTokens",
+            "totalTokens",
+            "latencyMs",
+            "costUSD",
+            "costTRY",
+            "samplingWeight",
+            "samplingReason",
+        ),
+    ),
+}
+
+
+class ExportCursorError(ValueError):
+    """Raised for a cursor that cannot be decoded or belongs to another export."""
+
+
+@dataclass(frozen=True)
+class ExportCursor:
+    """Resume point: last doc sent from `partition` (earlier partitions are done)."""
+
+    collection: str
+    partition: str
+    doc_id: str
+    value: Any
+
+    def encode(self) -> str:
+        payload = json.dumps([self.collection, self.partition, self.doc_id, self.value], separators=(",", ":"))
+        return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @classmethod
+    def decode(cls, token: str, collection: str) -> "ExportCursor":
+        try:
+            padded = token + "=" * (-len(token) % 4)
+            name, partition, doc_id, value = json.loads(base64.urlsafe_b64decode(padded))
+        except (ValueError, TypeError) as exc:
+            raise ExportCursorError("Invalid export cursor") from exc
+        if name != collection:
+            raise ExportCursorError("Export cursor belongs to another collection")
+        return cls(name, partition, doc_id, value)
+
+
+def range_bounds(spec: ExportSpec, start: str, end: str) -> Tuple[Any, Any]:
+    """Inclusive query bounds for the from/to params (UTC).
+
+    Aggregates compare their period key strings; events compare epoch
+    seconds from the start of `start` to the end of `end`.
+    """
+
+    start_at = dt.datetime.strptime(start, spec.key_format).replace(tzinfo=dt.timezone.utc)
+    end_at = dt.datetime.strptime(end, spec.key_format).replace(tzinfo=dt.timezone.utc)
+    if end_at < start_at:
+        raise ValueError("'to' is before 'from'")
+    if spec.range_field != "timestamp":
+        return start, end
+    return int(start_at.timestamp()), int((end_at + dt.timedelta(days=1)).timestamp()) - 1
+
+
+def iter_export(
+    clients: Sequence[Tuple[str, Any]],
+    spec: ExportSpec,
+    start: Any,
+    end: Any,
+    cursor: Optional[ExportCursor] = None,
+    page_size: int = 500,
+) -> Iterator[Tuple[Dict[str, Any], ExportCursor]]:
+    """Yield (record, cursor-after-record) for every doc in range, partition by partition.
+
+    Pages are read with Firestore cursors ordered by (range field, doc ID);
+    the next page is fetched on EXPORT_EXECUTOR while the current one is
+    consumed, so at most two pages are held in memory.
+    """
+
+    names = [name for name, _ in clients]
+    if cursor is not None and cursor.partition not in names:
+        raise ExportCursorError("Export cursor refers to an unknown partition")
+    skipping = cursor is not None
+    for name, db in clients:
+        if skipping and name != cursor.partition:
+            continue
+        resume = cursor if skipping else None
+        skipping = False
+        for snapshot in _iter_partition(db, spec, start, end, resume, page_size):
+            data = snapshot.to_dict() or {}
+            if spec.collection == "usage_events":
+                data = decode_event(data)
+            record = {"id": snapshot.id, **data}
+            yield record, ExportCursor(spec.collection, name, snapshot.id, _cursor_value(data.get(spec.range_field)))
+
+
+def render_ndjson(rows: Iterator[Tuple[Dict[str, Any], ExportCursor]]) -> Iterator[bytes]:
+    """One JSON object per line; `_cursor` resumes after that line."""
+
+    for record, cursor in rows:
+        record["_cursor"] = cursor.encode()
+        yield (json.dumps(record, default=_json_default, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def render_csv(rows: Iterator[Tuple[Dict[str, Any], ExportCursor]], spec: ExportSpec) -> Iterator[bytes]:
+    """Fixed columns per collection (maps as JSON cells) plus a `_cursor` column."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(spec.csv_columns + ("_cursor",))
+    for record, cursor in rows:
+        writer.writerow([_csv_cell(record.get(column)) for column in spec.csv_columns] + [cursor.encode()])
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _iter_partition(
+    db: Any,
+    spec: ExportSpec,
+    start: Any,
+    end: Any,
+    resume: Optional[ExportCursor],
+    page_size: int,
+) -> Iterator[Any]:
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    base = (
+        db.collection(spec.collection)
+        .where(filter=FieldFilter(spec.range_field, ">=", start))
+        .where(filter=FieldFilter(spec.range_field, "<=", end))
+        .order_by(spec.range_field)
+        .order_by("__name__")
+        .limit(page_size)
+    )
+    skip_through: Optional[Tuple[Any, str]] = None
+    if resume is None:
+        query = base
+    else:
+        anchor = db.collection(spec.collection).document(resume.doc_id).get()
+        if anchor.exists:
+            query = base.start_after(anchor)
+        else:
+            # The last exported doc is gone: restart at its range value and
+            # drop docs at or before it in (value, doc ID) order.
+            query = base.start_at({spec.range_field: resume.value})
+            skip_through = (resume.value, resume.doc_id)
+
+    pending: Future = EXPORT_EXECUTOR.submit(_fetch_page, query)
+    while True:
+        page: List[Any] = pending.result()
+        if len(page) == page_size:
+            pending = EXPORT_EXECUTOR.submit(_fetch_page, base.start_after(page[-1]))
+        for snapshot in page:
+            if skip_through is not None:
+                if (_cursor_value((snapshot.to_dict() or {}).get(spec.range_field)), snapshot.id) <= skip_through:
+                    continue
+                skip_through = None
+            yield snapshot
+        if len(page) < page_size:
+            return
+
+
+def _fetch_page(query: Any) -> List[Any]:
+    return list(query.stream())
+
+
+def _cursor_value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, dt.datetime) else value
+
+
+def _csv_cell(value: Any) -> Any:
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=_json_default, separators=(",", ":"))
+    if isinstance(value, dt.datetime):
+        return value.isoformat()
+    return value
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (dt.datetime, dt.date)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode("ascii")
+    return str(value)
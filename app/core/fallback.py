@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import datetime as dt
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from app.config.logger import get_logger
+from app.utils import metrics
+from app.utils.periodic import worker_id
+
+LOGGER = get_logger("usage_service.fallback")
+
+STORAGE_FALLBACK_DIR = os.getenv("STORAGE_FALLBACK_DIR", "")
+
+DEFERRED_EVENTS = metrics.counter("usage_ingest_deferred_total", "Ingest events spilled to the fallback sink.")
+
+
+class FallbackSink:
+    """Append-only NDJSON spill for enriched events Firestore could not take.
+
+    One file per worker and UTC hour (`deferred-{worker}-{YYYYMMDDHH}.ndjson`);
+    `app.jobs.replay_deferred` feeds them back through `update_aggregates`,
+    whose requestId dedup makes a replay safe to repeat: the dedup doc
+    commits in the aggregate transaction, so only applied events are skipped.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = Path(directory) if directory else None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def write(self, event: Dict[str, Any], reason: str) -> None:
+        if self.directory is None:
+            raise RuntimeError("Fallback sink is not configured")
+        line = json.dumps({"reason": reason, "event": event}, default=str, separators=(",", ":")) + "\n"
+        hour = dt.datetime.now(dt.timezone.utc).strftime("%Y%m%d%H")
+        path = self.directory / f"deferred-{worker_id()}-{hour}.ndjson"
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with open(path, "a", encoding="utf-8") as handle:
+                handle.write(line)
+        DEFERRED_EVENTS.inc(reason=reason)
+
+
+def pending_files(directory: str, before_hour: Optional[str] = None) -> List[Path]:
+    """Spill files not replayed yet; `before_hour` (YYYYMMDDHH) skips files still being written."""
+
+    files = sorted(Path(directory).glob("deferred-*.ndjson"))
+    if before_hour is None:
+        return files
+    return [path for path in files if path.stem.rsplit("-", 1)[-1] < before_hour]
+
+
+def read_deferred(path: Path) -> Iterator[Dict[str, Any]]:
+    with open(path, encoding="utf-8") as handle:
+        for line in handle:
+            if line.strip():
+                yield json.loads(line)["event"]
+
+
+DEFAULT_FALLBACK = FallbackSink(STORAGE_FALLBACK_DIR)
@@ -3,6 +3,7 @@ from dataclasses import dataclass
 from typing import Dict, Optional
 
 from app.config.logger import get_logger
+from .shared_state import get_shared_state
 
 LOGGER = get_logger("usage_service.fx")
 
@@ -27,6 +28,8 @@ class FxRateCache:
     def get_rate(self, base: str, quote: str) -> Optional[FxRate]:
         key = self._key(base, quote)
         rate = self._rates.get(key)
+        if not rate or dt.datetime.utcnow() - rate.updated_at > self._ttl:
+            rate = self._shared_rate(base, quote) or rate
         if not rate:
             LOGGER.info("FX rate cache miss", extra={"base": base, "quote": quote})
             return None
@@ -39,9 +42,32 @@ class FxRateCache:
     def set_rate(self, base: str, quote: str, rate: float) -> FxRate:
         fx = FxRate(base=base, quote=quote, rate=rate, updated_at=dt.datetime.utcnow())
         self._rates[self._key(base, quote)] = fx
+        shared = get_shared_state()
+        if shared is not None:
+            updated_at = fx.updated_at.replace(tzinfo=dt.timezone.utc).timestamp()
+            shared.fx_rates.put(self._key(base, quote), (rate, updated_at))
         LOGGER.info("FX rate cached", extra={"base": base, "quote": quote, "rate": rate})
         return fx
 
+    def _shared_rate(self, base: str, quote: str) -> Optional[FxRate]:
+        """Rate another worker fetched, when running with shared memory."""
+
+        shared = get_shared_state()
+        if shared is None:
+            return None
+        values = shared.fx_rates.get(self._key(base, quote))
+        if values is None:
+            return None
+        rate, updated_at = values
+        fx = FxRate(
+            base=base,
+            quote=quote,
+            rate=rate,
+            updated_at=dt.datetime.utcfromtimestamp(updated_at),
+        )
+        self._rates[self._key(base, quote)] = fx
+        return fx
+
     def get_or_fetch(self, base: str, quote: str) -> FxRate:
         """Fetch the latest rate if cache is stale.
 
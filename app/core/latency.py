@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import math
+import os
+import struct
+import threading
+import zlib
+from array import array
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from app.config.logger import get_logger
+from app.utils.lazy import lazy_import
+from app.utils.periodic import IntervalGate, worker_id
+from .usage_tracker import DEFAULT_EXECUTOR, _parse_timestamp
+
+firestore = lazy_import("google.cloud.firestore")
+LOGGER = get_logger("usage_service.latency")
+
+DIMENSIONS = ("model", "provider")
+QUANTILES = (0.5, 0.95, 0.99)
+_HEADER = struct.Struct("<BdQdd")
+_ENCODING_VERSION = 1
+
+
+class DDSketch:
+    """DDSketch quantile sketch with relative-error guarantees.
+
+    Every quantile is within `relative_accuracy` of the true value. Sketches
+    with the same accuracy merge by adding bucket counts.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01) -> None:
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float) -> None:
+        if value <= 0:
+            self.zero_count += 1
+        else:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "DDSketch") -> None:
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("cannot merge sketches with different accuracy")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                value = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_bytes(self) -> bytes:
+        indexes = array("i", sorted(self.bins))
+        counts = array("I", (self.bins[index] for index in indexes))
+        header = _HEADER.pack(
+            _ENCODING_VERSION,
+            self.relative_accuracy,
+            self.zero_count,
+            self.min if self.count else 0.0,
+            self.max if self.count else 0.0,
+        )
+        return header + zlib.compress(indexes.tobytes() + counts.tobytes(), 6)
+
+    @classmethod
+    def from_bytes(cls, payload: bytes) -> "DDSketch":
+        version, accuracy, zero_count, minimum, maximum = _HEADER.unpack_from(payload)
+        if version != _ENCODING_VERSION:
+            raise ValueError(f"unsupported DDSketch encoding {version}")
+        sketch = cls(accuracy)
+        body = zlib.decompress(payload[_HEADER.size:])
+        half = len(body) // 2
+        indexes = array("i")
+        indexes.frombytes(body[:half])
+        counts = array("I")
+        counts.frombytes(body[half:])
+        sketch.bins = dict(zip(indexes, counts))
+        sketch.zero_count = zero_count
+        sketch.count = zero_count + sum(counts)
+        if sketch.count:
+            sketch.min, sketch.max = minimum, maximum
+        return sketch
+
+
+class _LatencyStats:
+    __slots__ = ("sketch", "requests", "errors")
+
+    def __init__(self, relative_accuracy: float) -> None:
+        self.sketch = DDSketch(relative_accuracy)
+        self.requests = 0
+        self.errors: Dict[str, int] = {}
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"sketch": self.sketch.to_bytes(), "requests": self.requests, "errors": dict(self.errors)}
+
+
+class LatencyTracker:
+    """Per-day latency sketches and error counters by model and provider.
+
+    Each worker checkpoints its cumulative state into its own slot of
+    usage_latency/{YYYYMMDD} (`workers.{workerId}`); readers merge all slots,
+    so flushes are idempotent and instances never overwrite each other.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, flush_seconds: float = 60.0, retained_days: int = 2) -> None:
+        self._accuracy = relative_accuracy
+        self._retained = retained_days
+        self._stats: Dict[Tuple[str, str, str], _LatencyStats] = {}
+        self._dirty: set = set()
+        self._gate = IntervalGate(flush_seconds)
+        self._lock = threading.Lock()
+
+    @property
+    def _worker_id(self) -> str:
+        # Not captured in __init__: with preload_app this singleton is built
+        # in the gunicorn master, before the workers fork.
+        return worker_id()
+
+    def observe_event(self, db: firestore.Client, event: Dict[str, Any]) -> None:
+        """Commit listener: record latencyMs and status/errorCode of the event."""
+
+        latency_ms = event.get("latencyMs")
+        error_code = _error_code(event)
+        if latency_ms is None and error_code is None:
+            return
+        day_key = _parse_timestamp(event["timestamp"]).strftime("%Y%m%d")
+        with self._lock:
+            for dimension, value in _dimension_values(event):
+                key = (day_key, dimension, value)
+                stats = self._stats.get(key)
+                if stats is None:
+                    stats = self._stats[key] = _LatencyStats(self._accuracy)
+                stats.requests += 1
+                if latency_ms is not None:
+                    stats.sketch.add(float(latency_ms))
+                if error_code is not None:
+                    stats.errors[error_code] = stats.errors.get(error_code, 0) + 1
+                self._dirty.add(day_key)
+        if self._gate.due():
+            DEFAULT_EXECUTOR.submit(self.flush, db)
+
+    def flush(self, db: firestore.Client) -> int:
+        """Write this worker's state for dirty days. Returns the number of docs written."""
+
+        with self._lock:
+            dirty = sorted(self._dirty)
+            self._dirty.clear()
+            payloads: Dict[str, Dict[str, Dict[str, Any]]] = {}
+            for (day_key, dimension, value), stats in self._stats.items():
+                if day_key in dirty:
+                    payloads.setdefault(day_key, {}).setdefault(dimension, {})[value] = stats.to_dict()
+            self._prune()
+
+        for day_key, dimensions in payloads.items():
+            try:
+                db.collection("usage_latency").document(day_key).set(
+                    {
+                        "day": day_key,
+                        "workers": {self._worker_id: dict(dimensions, updatedAt=firestore.SERVER_TIMESTAMP)},
+                        "updatedAt": firestore.SERVER_TIMESTAMP,
+                    },
+                    merge=True,
+                )
+            except Exception as exc:  # noqa: BLE001
+                with self._lock:
+                    self._dirty.add(day_key)
+                LOGGER.warning("Latency flush failed", extra={"day": day_key, "error": str(exc)})
+        if payloads:
+            LOGGER.info("Latency sketches flushed", extra={"docs": len(payloads)})
+        return len(payloads)
+
+    def summary(
+        self,
+        db: Optional[firestore.Client],
+        day_key: str,
+        dimension: str,
+        value: Optional[str] = None,
+    ) -> Dict[str, Dict[str, Any]]:
+        """p50/p95/p99, request count and error breakdown per dimension value."""
+
+        merged: Dict[str, _LatencyStats] = {}
+
+        def _add(item: str, sketch: DDSketch, requests: int, errors: Dict[str, int]) -> None:
+            stats = merged.get(item)
+            if stats is None:
+                stats = merged[item] = _LatencyStats(sketch.relative_accuracy)
+            stats.sketch.merge(sketch)
+            stats.requests += requests
+            for code, count in errors.items():
+                stats.errors[code] = stats.errors.get(code, 0) + count
+
+        if db is not None:
+            with self._lock:
+                has_local = any(day == day_key for day, _, _ in self._stats)
+            snapshot = db.collection("usage_latency").document(day_key).get()
+            workers = ((snapshot.to_dict() or {}).get("workers") or {}) if snapshot.exists else {}
+            for slot, dimensions in workers.items():
+                # Local state supersedes the stored own slot, until the day is
+                # pruned from memory.
+                if slot == self._worker_id and has_local:
+                    continue
+                for item, payload in (dimensions.get(dimension) or {}).items():
+                    if value is None or item == value:
+                        _add(
+                            item,
+                            DDSketch.from_bytes(payload["sketch"]),
+                            int(payload.get("requests") or 0),
+                            payload.get("errors") or {},
+                        )
+        with self._lock:
+            for (day, dim, item), stats in self._stats.items():
+                if day == day_key and dim == dimension and (value is None or item == value):
+                    _add(item, stats.sketch, stats.requests, stats.errors)
+
+        result: Dict[str, Dict[str, Any]] = {}
+        for item, stats in sorted(merged.items()):
+            error_total = sum(stats.errors.values())
+            result[item] = {
+                "requests": stats.requests,
+                "samples": stats.sketch.count,
+                **{f"p{int(q * 100)}": stats.sketch.quantile(q) for q in QUANTILES},
+                "errorRate": round(error_total / stats.requests, 6) if stats.requests else 0.0,
+                "errors": stats.errors,
+            }
+        return result
+
+    def _prune(self) -> None:
+        days = sorted({day for day, _, _ in self._stats})
+        for stale in days[: -self._retained]:
+            for key in [key for key in self._stats if key[0] == stale]:
+                del self._stats[key]
+
+
+def _error_code(event: Dict[str, Any]) -> Optional[str]:
+    if event.get("errorCode"):
+        return str(event["errorCode"])
+    status = event.get("status")
+    if status and status != "success":
+        return str(status)
+    return None
+
+
+def _dimension_values(event: Dict[str, Any]) -> Iterable[Tuple[str, str]]:
+    for dimension in DIMENSIONS:
+        value = event.get(dimension)
+        if value:
+            yield dimension, str(value)
+
+
+DEFAULT_LATENCY = LatencyTracker(
+    relative_accuracy=float(os.getenv("LATENCY_SKETCH_ACCURACY", "0.01")),
+    flush_seconds=float(os.getenv("LATENCY_FLUSH_SECONDS", "60")),
+)
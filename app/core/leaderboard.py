@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import datetime as dt
+import heapq
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.config.logger import get_logger
+from app.utils.lazy import lazy_import
+from app.utils.periodic import IntervalGate, worker_id
+from .usage_tracker import DEFAULT_EXECUTOR, _parse_timestamp
+
+firestore = lazy_import("google.cloud.firestore")
+LOGGER = get_logger("usage_service.leaderboard")
+
+METRICS = ("costUsd", "tokens")
+PERIODS = ("day", "month")
+# Slot holding the merged summaries of workers that stopped checkpointing.
+RETIRED_SLOT = "_retired"
+
+
+class SpaceSaving:
+    """Space-Saving heavy-hitters summary with weighted updates.
+
+    Keeps at most `capacity` counters. Every reported count overestimates
+    the true value by at most its `error`. Summaries are mergeable, so each
+    worker can checkpoint its own and readers combine them.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self._counts: Dict[str, float] = {}
+        self._errors: Dict[str, float] = {}
+        self._heap: List[Tuple[float, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def add(self, key: str, weight: float) -> None:
+        if weight <= 0:
+            return
+        if key in self._counts:
+            self._counts[key] += weight
+        elif len(self._counts) < self.capacity:
+            self._counts[key] = weight
+            self._errors[key] = 0.0
+        else:
+            min_key, min_count = self._pop_min()
+            del self._counts[min_key]
+            del self._errors[min_key]
+            self._counts[key] = min_count + weight
+            self._errors[key] = min_count
+        heapq.heappush(self._heap, (self._counts[key], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count, k) for k, count in self._counts.items()]
+            heapq.heapify(self._heap)
+
+    def min_count(self) -> float:
+        if len(self._counts) < self.capacity or not self._counts:
+            return 0.0
+        min_key, min_count = self._pop_min()
+        heapq.heappush(self._heap, (min_count, min_key))
+        return min_count
+
+    def top(self, limit: int) -> List[Tuple[str, float, float]]:
+        items = heapq.nlargest(limit, self._counts.items(), key=lambda item: item[1])
+        return [(key, count, self._errors[key]) for key, count in items]
+
+    def merge(self, other: "SpaceSaving") -> "SpaceSaving":
+        """Return a new summary combining both (mergeable summaries rule)."""
+
+        self_min = self.min_count()
+        other_min = other.min_count()
+        merged = SpaceSaving(max(self.capacity, other.capacity))
+        combined: List[Tuple[str, float, float]] = []
+        for key in set(self._counts) | set(other._counts):
+            count = self._counts.get(key, self_min) + other._counts.get(key, other_min)
+            error = self._errors.get(key, self_min) + other._errors.get(key, other_min)
+            combined.append((key, count, error))
+        for key, count, error in heapq.nlargest(merged.capacity, combined, key=lambda item: item[1]):
+            merged._counts[key] = count
+            merged._errors[key] = error
+        merged._heap = [(count, key) for key, count in merged._counts.items()]
+        heapq.heapify(merged._heap)
+        return merged
+
+    def to_dict(self) -> Dict[str, Any]:
+        # Parallel arrays: Firestore does not allow nested arrays and per-user
+        # map keys would create one indexed field per user.
+        keys = list(self._counts)
+        return {
+            "capacity": self.capacity,
+            "keys": keys,
+            "counts": [self._counts[key] for key in keys],
+            "errors": [self._errors[key] for key in keys],
+        }
+
+    @classmethod
+    def from_dict(cls, payload: Dict[str, Any]) -> "SpaceSaving":
+        summary = cls(int(payload.get("capacity") or 0) or len(payload.get("keys") or []) or 1)
+        for key, count, error in zip(payload.get("keys") or [], payload.get("counts") or [], payload.get("errors") or []):
+            summary._counts[key] = float(count)
+            summary._errors[key] = float(error)
+        summary._heap = [(count, key) for key, count in summary._counts.items()]
+        heapq.heapify(summary._heap)
+        return summary
+
+    def _pop_min(self) -> Tuple[str, float]:
+        while self._heap:
+            count, key = heapq.heappop(self._heap)
+            if self._counts.get(key) == count:
+                return key, count
+        raise IndexError("empty summary")
+
+
+class LeaderboardTracker:
+    """Per-period heavy-hitter summaries fed by committed ingest events.
+
+    Summaries are checkpointed to usage_leaderboard/{YYYYMMDD|YYYYMM} under
+    `workers.{workerId}`. Each worker overwrites only its own slot with its
+    cumulative state, so repeated checkpoints never double count.
+
+    A worker rewrites the slots of periods it still holds at least every
+    `slot_ttl_seconds / 2`. Slots not written for `slot_ttl_seconds` belong
+    to dead or restarted workers; the next checkpoint of that doc merges
+    them into `workers._retired` and deletes them, so the doc holds one
+    slot per live worker plus one.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 300,
+        checkpoint_seconds: float = 60.0,
+        retained_periods: int = 2,
+        slot_ttl_seconds: float = 6 * 3600,
+    ) -> None:
+        self._capacity = capacity
+        self._retained = retained_periods
+        self._slot_ttl = slot_ttl_seconds
+        self._summaries: Dict[Tuple[str, str, str], SpaceSaving] = {}
+        self._dirty: set = set()
+        # (period, key) -> monotonic time of this worker's last slot write.
+        self._written: Dict[Tuple[str, str], float] = {}
+        self._gate = IntervalGate(checkpoint_seconds)
+        self._lock = threading.Lock()
+
+    @property
+    def _worker_id(self) -> str:
+        # Not captured in __init__: with preload_app this singleton is built
+        # in the gunicorn master, before the workers fork.
+        return worker_id()
+
+    def observe_event(self, db: firestore.Client, event: Dict[str, Any]) -> None:
+        """Commit listener: add a committed event to the day/month summaries."""
+
+        user_id = event.get("userId")
+        if not user_id:
+            return
+        timestamp = _parse_timestamp(event["timestamp"])
+        values = {
+            "costUsd": float(event.get("costUSD") or 0.0),
+            "tokens": float((event.get("inputTokens") or 0) + (event.get("outputTokens") or 0)),
+        }
+        with self._lock:
+            for period, key in (("day", timestamp.strftime("%Y%m%d")), ("month", timestamp.strftime("%Y%m"))):
+                for metric, value in values.items():
+                    summary_key = (period, key, metric)
+                    summary = self._summaries.get(summary_key)
+                    if summary is None:
+                        summary = self._summaries[summary_key] = SpaceSaving(self._capacity)
+                    summary.add(user_id, value)
+                self._dirty.add((period, key))
+        if self._gate.due():
+            DEFAULT_EXECUTOR.submit(self.checkpoint, db)
+
+    def checkpoint(self, db: firestore.Client) -> int:
+        """Write this worker's dirty summaries. Returns the number of docs written."""
+
+        with self._lock:
+            now = time.monotonic()
+            refresh = {
+                period_key for period_key, written_at in self._written.items() if now - written_at >= self._slot_ttl / 2
+            }
+            dirty = sorted(self._dirty | refresh)
+            self._dirty.clear()
+            payloads = {
+                (period, key): {
+                    metric: self._summaries[(period, key, metric)].to_dict()
+                    for metric in METRICS
+                    if (period, key, metric) in self._summaries
+                }
+                for period, key in dirty
+            }
+            self._prune()
+        for (period, key), summaries in payloads.items():
+            if not summaries:
+                continue
+            try:
+                retired = self._write_slot(db, period, key, summaries)
+            except Exception as exc:  # noqa: BLE001
+                with self._lock:
+                    self._dirty.add((period, key))
+                LOGGER.warning(
+                    "Leaderboard checkpoint failed",
+                    extra={"period": period, "key": key, "error": str(exc)},
+                )
+                continue
+            with self._lock:
+                if any((period, key, metric) in self._summaries for metric in METRICS):
+                    self._written[(period, key)] = now
+            if retired:
+                LOGGER.info("Leaderboard slots retired", extra={"key": key, "slots": retired})
+        if payloads:
+            LOGGER.info("Leaderboard checkpoint written", extra={"docs": len(payloads)})
+        return len(payloads)
+
+    def _write_slot(self, db: firestore.Client, period: str, key: str, summaries: Dict[str, Any]) -> List[str]:
+        """Write this worker's slot and fold expired slots into RETIRED_SLOT, in one transaction."""
+
+        ref = db.collection("usage_leaderboard").document(key)
+        own = self._worker_id
+
+        @firestore.transactional
+        def _txn(transaction: firestore.Transaction) -> List[str]:
+            snapshot = ref.get(transaction=transaction)
+            workers = (snapshot.to_dict() or {}).get("workers", {}) if snapshot.exists else {}
+            cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=self._slot_ttl)
+            expired = [
+                slot
+                for slot, payload in workers.items()
+                if slot not in (own, RETIRED_SLOT) and _slot_expired(payload, cutoff)
+            ]
+            slots: Dict[str, Any] = {own: dict(summaries, updatedAt=firestore.SERVER_TIMESTAMP)}
+            if expired:
+                folded = [workers.get(RETIRED_SLOT) or {}] + [workers[slot] for slot in expired]
+                retired: Dict[str, Any] = {
+                    metric: _merge_all(
+                        SpaceSaving.from_dict(payload[metric]) for payload in folded if metric in payload
+                    ).to_dict()
+                    for metric in METRICS
+                    if any(metric in payload for payload in folded)
+                }
+                slots[RETIRED_SLOT] = dict(retired, updatedAt=firestore.SERVER_TIMESTAMP)
+                for slot in expired:
+                    slots[slot] = firestore.DELETE_FIELD
+            transaction.set(
+                ref,
+                {"period": period, "key": key, "workers": slots, "updatedAt": firestore.SERVER_TIMESTAMP},
+                merge=True,
+            )
+            return expired
+
+        return _txn(db.transaction())
+
+    def top(
+        self,
+        db: Optional[firestore.Client],
+        period: str,
+        key: str,
+        metric: str,
+        limit: int = 100,
+    ) -> List[Tuple[str, float, float]]:
+        """Top users for a period, merging every worker's checkpoint with local state."""
+
+        summaries: List[SpaceSaving] = []
+        with self._lock:
+            local = self._summaries.get((period, key, metric))
+            if local is not None:
+                summaries.append(SpaceSaving.from_dict(local.to_dict()))
+        if db is not None:
+            snapshot = db.collection("usage_leaderboard").document(key).get()
+            workers = (snapshot.to_dict() or {}).get("workers", {}) if snapshot.exists else {}
+            for slot, payload in workers.items():
+                # The stored own slot is older than local state, but it is all
+                # there is once the period has been pruned from memory.
+                if (slot == self._worker_id and local is not None) or metric not in payload:
+                    continue
+                summaries.append(SpaceSaving.from_dict(payload[metric]))
+        return _merge_all(summaries).top(limit)
+
+    def _prune(self) -> None:
+        for period in PERIODS:
+            keys = sorted({key for p, key, _ in self._summaries if p == period})
+            for stale in keys[: -self._retained]:
+                for metric in METRICS:
+                    self._summaries.pop((period, stale, metric), None)
+                self._written.pop((period, stale), None)
+
+
+def _slot_expired(payload: Any, cutoff: dt.datetime) -> bool:
+    updated_at = payload.get("updatedAt") if isinstance(payload, dict) else None
+    # A slot without a readable timestamp (pending server write) is kept.
+    return isinstance(updated_at, dt.datetime) and updated_at < cutoff
+
+
+def _merge_all(summaries: Iterable[SpaceSaving]) -> SpaceSaving:
+    merged: Optional[SpaceSaving] = None
+    for summary in summaries:
+        merged = summary if merged is None else merged.merge(summary)
+    return merged or SpaceSaving(1)
+
+
+DEFAULT_LEADERBOARD = LeaderboardTracker(
+    capacity=int(os.getenv("LEADERBOARD_CAPACITY", "300")),
+    checkpoint_seconds=float(os.getenv("LEADERBOARD_CHECKPOINT_SECONDS", "60")),
+    slot_ttl_seconds=float(os.getenv("LEADERBOARD_SLOT_TTL_SECONDS", str(6 * 3600))),
+)
@@ -0,0 +1,333 @@
+from __future__ import annotations
+
+import datetime as dt
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from app.config.logger import get_logger
+from app.utils import metrics
+from app.utils.cache import TtlCache
+from app.utils.lazy import lazy_import
+from .actions import DEFAULT_ACTION_POLICY
+from .resilience import STORAGE_GUARD, call_options
+from .usage_tracker import _parse_timestamp, _resolved_cost_try
+
+firestore = lazy_import("google.cloud.firestore")
+LOGGER = get_logger("usage_service.orgs")
+
+USER_ORGS_COLLECTION = "user_orgs"
+ORG_DAILY_COLLECTION = "usage_org_daily"
+ORG_MONTHLY_COLLECTION = "usage_org_monthly"
+
+ORG_ROLLUP_FLUSH_SECONDS = float(os.getenv("ORG_ROLLUP_FLUSH_SECONDS", "5"))
+# Firestore rejects batches with more than 500 writes.
+_BATCH_LIMIT = 500
+_RETAINED_PERIODS = 2
+
+_ORG_CACHE: TtlCache[str] = TtlCache(
+    max_entries=int(os.getenv("USER_ORG_CACHE_SIZE", "50000")),
+    ttl_seconds=float(os.getenv("USER_ORG_CACHE_TTL_SECONDS", "300")),
+)
+
+ORG_ROLLUP_EVENTS = metrics.counter("usage_org_rollup_events_total", "Committed events folded into org deltas.")
+ORG_ROLLUP_WRITES = metrics.counter("usage_org_rollup_writes_total", "Org aggregate doc writes by result.")
+ORG_ROLLUP_PENDING = metrics.gauge("usage_org_rollup_pending_docs", "Org aggregate docs with unflushed deltas.")
+
+_FIELDS = ("totalInputTokens", "totalOutputTokens", "totalCostTry", "totalCostUsd", "requestCount")
+_BREAKDOWN_FIELDS = ("tokensIn", "tokensOut", "costTry", "costUsd", "count")
+
+DocKey = Tuple[str, str, str]  # (collection, orgId, YYYYMMDD|YYYYMM)
+
+
+def get_user_org(db: firestore.Client, user_id: str) -> Optional[str]:
+    """Return the user's orgId through the in-process cache."""
+
+    def _load() -> Optional[str]:
+        doc_ref = db.collection(USER_ORGS_COLLECTION).document(user_id)
+        snapshot = STORAGE_GUARD.run("user_org", doc_ref.get, **call_options())
+        if not snapshot.exists:
+            return None
+        return (snapshot.to_dict() or {}).get("orgId")
+
+    return _ORG_CACHE.get_or_load(user_id, _load)
+
+
+def set_user_org(db: firestore.Client, user_id: str, org_id: Optional[str]) -> None:
+    """Write (or with `org_id=None` delete) user_orgs/{userId}.
+
+    Only this process's cache is updated; other workers pick the change up
+    within USER_ORG_CACHE_TTL_SECONDS. Already committed usage stays with
+    the org it was attributed to.
+    """
+
+    doc_ref = db.collection(USER_ORGS_COLLECTION).document(user_id)
+    if org_id is None:
+        STORAGE_GUARD.run("user_org", doc_ref.delete, **call_options())
+    else:
+        STORAGE_GUARD.run(
+            "user_org",
+            doc_ref.set,
+            {"userId": user_id, "orgId": org_id, "updatedAt": firestore.SERVER_TIMESTAMP},
+            **call_options(),
+        )
+    _ORG_CACHE.set(user_id, org_id)
+
+
+def remove_user_org(db: firestore.Client, user_id: str, org_id: str) -> bool:
+    """Delete user_orgs/{userId} if it still names `org_id`.
+
+    Returns:
+        True if the membership was deleted.
+        False if the user has no org or belongs to another one.
+    """
+
+    doc_ref = db.collection(USER_ORGS_COLLECTION).document(user_id)
+
+    @firestore.transactional
+    def _txn(transaction: firestore.Transaction) -> Tuple[bool, Optional[str]]:
+        snapshot = doc_ref.get(transaction=transaction)
+        stored = (snapshot.to_dict() or {}).get("orgId") if snapshot.exists else None
+        if stored != org_id:
+            return False, stored
+        transaction.delete(doc_ref)
+        return True, None
+
+    removed, current = _txn(db.transaction())
+    _ORG_CACHE.set(user_id, current)
+    return removed
+
+
+def org_doc_id(org_id: str, period_key: str) -> str:
+    return f"{org_id}_{period_key}"
+
+
+def read_org_usage(db: firestore.Client, org_id: str, period: str, period_key: str) -> Optional[Dict[str, Any]]:
+    """Single-doc read of usage_org_daily or usage_org_monthly."""
+
+    collection = ORG_MONTHLY_COLLECTION if period == "month" else ORG_DAILY_COLLECTION
+    doc_ref = db.collection(collection).document(org_doc_id(org_id, period_key))
+    snapshot = STORAGE_GUARD.run("org_usage", doc_ref.get, **call_options())
+    if not snapshot.exists:
+        return None
+    return snapshot.to_dict() or {}
+
+
+class _Delta:
+    __slots__ = ("db", "totals", "actions", "last_event_at", "last_event_ts", "marked_at")
+
+    def __init__(self, db: Any, marked_at: float) -> None:
+        self.db = db
+        self.totals = [0.0] * len(_FIELDS)
+        self.actions: Dict[str, List[float]] = {}
+        self.last_event_at: Any = None
+        self.last_event_ts: Optional[dt.datetime] = None
+        self.marked_at = marked_at
+
+    def add(self, values: Tuple[float, ...], action: Optional[str], event_at: Any, event_ts: dt.datetime) -> None:
+        for index, value in enumerate(values):
+            self.totals[index] += value
+        if action is not None:
+            breakdown = self.actions.setdefault(action, [0.0] * len(_BREAKDOWN_FIELDS))
+            for index, value in enumerate(values):
+                breakdown[index] += value
+        if self.last_event_ts is None or event_ts >= self.last_event_ts:
+            self.last_event_at, self.last_event_ts = event_at, event_ts
+
+    def merge(self, other: "_Delta") -> None:
+        for index, value in enumerate(other.totals):
+            self.totals[index] += value
+        for action, values in other.actions.items():
+            breakdown = self.actions.setdefault(action, [0.0] * len(_BREAKDOWN_FIELDS))
+            for index, value in enumerate(values):
+                breakdown[index] += value
+        if other.last_event_ts is not None and (self.last_event_ts is None or other.last_event_ts > self.last_event_ts):
+            self.last_event_at, self.last_event_ts = other.last_event_at, other.last_event_ts
+        self.marked_at = min(self.marked_at, other.marked_at)
+
+    def update(self, org_id: str, period_field: str, period_key: str) -> Dict[str, Any]:
+        update: Dict[str, Any] = {
+            "orgId": org_id,
+            period_field: period_key,
+            "lastEventAt": self.last_event_at,
+            "updatedAt": firestore.SERVER_TIMESTAMP,
+        }
+        for field, value in zip(_FIELDS, self.totals):
+            update[field] = firestore.Increment(_number(field, value))
+        if self.actions:
+            update["actions"] = {
+                action: {
+                    field: firestore.Increment(_number(field, value)) for field, value in zip(_BREAKDOWN_FIELDS, values)
+                }
+                for action, values in self.actions.items()
+            }
+        return update
+
+
+class OrgRollupCoalescer:
+    """Coalesces committed events into usage_org_daily / usage_org_monthly.
+
+    Events are summed in memory per (orgId, day) and (orgId, month) and
+    written every `flush_seconds` as one merge of Increments per doc, so an
+    org with many active members costs each worker one write per doc per
+    interval instead of one per event (Firestore sustains about one write
+    per second per document).
+
+    Totals lag ingest by at most `staleness_bound_seconds`. Deltas still in
+    memory when a worker is killed without shutdown are lost; a flush that
+    fails is retried with the next one. Inline action slots follow
+    AGGREGATE_MAX_ACTIONS per worker, so a doc may hold up to that many
+    actions per writing worker.
+    """
+
+    def __init__(
+        self,
+        flush_seconds: float = ORG_ROLLUP_FLUSH_SECONDS,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.flush_seconds = flush_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[DocKey, _Delta] = {}
+        self._inline: Dict[DocKey, Set[str]] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def staleness_bound_seconds(self) -> float:
+        return 2 * self.flush_seconds
+
+    def observe_event(self, db: firestore.Client, event: Dict[str, Any]) -> None:
+        """Commit listener: add the event to its org's pending day/month deltas."""
+
+        org_id = event.get("orgId")
+        if not org_id:
+            return
+        event_ts = _parse_timestamp(event["timestamp"])
+        values = _event_values(event)
+        action = event.get("action")
+        now = self._clock()
+        with self._lock:
+            for collection, period_key in (
+                (ORG_DAILY_COLLECTION, event_ts.strftime("%Y%m%d")),
+                (ORG_MONTHLY_COLLECTION, event_ts.strftime("%Y%m")),
+            ):
+                key = (collection, str(org_id), period_key)
+                delta = self._pending.get(key)
+                if delta is None:
+                    delta = self._pending[key] = _Delta(db, now)
+                action_key = None
+                if action:
+                    inline = self._inline.setdefault(key, set())
+                    action_key = DEFAULT_ACTION_POLICY.inline_key(str(action), inline)
+                    inline.add(action_key)
+                delta.add(values, action_key, event["timestamp"], event_ts)
+            pending = len(self._pending)
+        ORG_ROLLUP_EVENTS.inc()
+        ORG_ROLLUP_PENDING.set(pending)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self) -> int:
+        """Write all pending deltas. Returns the number of docs written."""
+
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._prune()
+            if not pending:
+                return 0
+            by_client: Dict[int, Tuple[Any, List[DocKey]]] = {}
+            for key, delta in pending.items():
+                by_client.setdefault(id(delta.db), (delta.db, []))[1].append(key)
+            written = 0
+            for db, keys in by_client.values():
+                for start in range(0, len(keys), _BATCH_LIMIT):
+                    chunk = keys[start : start + _BATCH_LIMIT]
+                    try:
+                        batch = db.batch()
+                        for collection, org_id, period_key in chunk:
+                            period_field = "month" if collection == ORG_MONTHLY_COLLECTION else "day"
+                            batch.set(
+                                db.collection(collection).document(org_doc_id(org_id, period_key)),
+                                pending[(collection, org_id, period_key)].update(org_id, period_field, period_key),
+                                merge=True,
+                            )
+                        batch.commit()
+                    except Exception as exc:  # noqa: BLE001
+                        self._requeue({key: pending[key] for key in chunk})
+                        ORG_ROLLUP_WRITES.inc(len(chunk), result="failed")
+                        LOGGER.warning("Org rollup flush failed", extra={"docs": len(chunk), "error": str(exc)})
+                        continue
+                    written += len(chunk)
+            ORG_ROLLUP_WRITES.inc(written, result="ok")
+            ORG_ROLLUP_PENDING.set(self.pending())
+            lag = self._clock() - min(delta.marked_at for delta in pending.values())
+            LOGGER.info("Org rollup flushed", extra={"docs": written, "maxLagSeconds": round(lag, 3)})
+            return written
+
+    def start(self) -> None:
+        """Flush every `flush_seconds` in a daemon thread."""
+
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="org-rollup", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the thread and flush what is still pending."""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_seconds)
+            self._thread = None
+        self.flush()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_seconds):
+            try:
+                self.flush()
+            except Exception as exc:  # noqa: BLE001
+                LOGGER.warning("Org rollup flush failed", extra={"error": str(exc)})
+
+    def _requeue(self, failed: Dict[DocKey, _Delta]) -> None:
+        with self._lock:
+            for key, delta in failed.items():
+                current = self._pending.get(key)
+                if current is None:
+                    self._pending[key] = delta
+                else:
+                    current.merge(delta)
+
+    def _prune(self) -> None:
+        # Inline-action views are only needed for the current periods.
+        for collection in (ORG_DAILY_COLLECTION, ORG_MONTHLY_COLLECTION):
+            periods = sorted({period for coll, _, period in self._inline if coll == collection})
+            stale = set(periods[:-_RETAINED_PERIODS])
+            for key in [key for key in self._inline if key[0] == collection and key[2] in stale]:
+                del self._inline[key]
+
+
+def _event_values(event: Dict[str, Any]) -> Tuple[float, ...]:
+    """(input tokens, output tokens, cost TRY, cost USD, count) as the user aggregates count them."""
+
+    return (
+        float(event.get("inputTokens", 0) or 0),
+        float(event.get("outputTokens", 0) or 0),
+        float(_resolved_cost_try(event)),
+        float(event.get("costUSD", 0.0) or 0.0),
+        1.0,
+    )
+
+
+def _number(field: str, value: float) -> Any:
+    # Token and request counters stay integers in Firestore.
+    return value if field.startswith("cost") or field.startswith("totalCost") else int(value)
+
+
+DEFAULT_ORG_ROLLUP = OrgRollupCoalescer()
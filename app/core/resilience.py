@@ -0,0 +1,399 @@
+from __future__ import annotations
+
+import contextvars
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, TypeVar
+
+from app.config.logger import get_logger
+from app.utils import metrics
+from app.utils.lazy import lazy_import
+
+api_retry = lazy_import("google.api_core.retry")
+LOGGER = get_logger("usage_service.resilience")
+
+STORAGE_CONCURRENCY_INITIAL = float(os.getenv("STORAGE_CONCURRENCY_INITIAL", "16"))
+STORAGE_CONCURRENCY_MIN = float(os.getenv("STORAGE_CONCURRENCY_MIN", "2"))
+STORAGE_CONCURRENCY_MAX = float(os.getenv("STORAGE_CONCURRENCY_MAX", "32"))
+STORAGE_TARGET_LATENCY_MS = float(os.getenv("STORAGE_TARGET_LATENCY_MS", "500"))
+STORAGE_BREAKER_FAILURE_RATIO = float(os.getenv("STORAGE_BREAKER_FAILURE_RATIO", "0.5"))
+STORAGE_BREAKER_MIN_CALLS = int(os.getenv("STORAGE_BREAKER_MIN_CALLS", "20"))
+STORAGE_BREAKER_WINDOW_SECONDS = int(os.getenv("STORAGE_BREAKER_WINDOW_SECONDS", "10"))
+STORAGE_BREAKER_OPEN_SECONDS = float(os.getenv("STORAGE_BREAKER_OPEN_SECONDS", "5"))
+STORAGE_BREAKER_HALF_OPEN_CALLS = int(os.getenv("STORAGE_BREAKER_HALF_OPEN_CALLS", "3"))
+STORAGE_DEFAULT_DEADLINE_MS = float(os.getenv("STORAGE_DEFAULT_DEADLINE_MS", "5000"))
+STORAGE_MAX_DEADLINE_MS = float(os.getenv("STORAGE_MAX_DEADLINE_MS", "30000"))
+STORAGE_OVERLOAD_RETRY_AFTER_SECONDS = float(os.getenv("STORAGE_OVERLOAD_RETRY_AFTER_SECONDS", "1"))
+
+# api_core exception names (matched on the MRO) that mean the backend is
+# slow or down. Contention (Aborted) and bad requests do not count.
+_BACKEND_FAILURES = frozenset(
+    ("ServiceUnavailable", "DeadlineExceeded", "InternalServerError", "ResourceExhausted", "Unknown", "RetryError")
+)
+
+STORAGE_CALLS = metrics.counter("usage_storage_calls_total", "Guarded storage calls by operation and result.")
+STORAGE_REJECTED = metrics.counter("usage_storage_rejected_total", "Storage calls refused before reaching Firestore.")
+STORAGE_LIMIT = metrics.gauge("usage_storage_concurrency_limit", "Current adaptive storage concurrency limit.")
+STORAGE_INFLIGHT = metrics.gauge("usage_storage_inflight", "Storage calls in flight.")
+STORAGE_BREAKER_STATE = metrics.gauge(
+    "usage_storage_breaker_state", "Storage circuit breaker state (0 closed, 1 half-open, 2 open)."
+)
+
+T = TypeVar("T")
+
+
+class StorageUnavailable(Exception):
+    """Storage refused or failed fast; callers should answer 503 with Retry-After."""
+
+    reason = "unavailable"
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class StorageOverloaded(StorageUnavailable):
+    reason = "overloaded"
+
+
+class StorageCircuitOpen(StorageUnavailable):
+    reason = "circuit_open"
+
+
+class StorageDeadlineExceeded(StorageUnavailable):
+    reason = "deadline"
+
+
+class InjectedStorageFault(ConnectionError):
+    """Raised by STORAGE_FAULT_INJECTION."""
+
+
+# Absolute time.monotonic() deadline of the request being served.
+_DEADLINE: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("usage_storage_deadline", default=None)
+
+
+def request_deadline(timeout_ms: Optional[str] = None) -> float:
+    """Deadline for a request from its `X-Request-Timeout-Ms` header (capped), or the default."""
+
+    budget_ms = STORAGE_DEFAULT_DEADLINE_MS
+    if timeout_ms:
+        try:
+            budget_ms = min(float(timeout_ms), STORAGE_MAX_DEADLINE_MS)
+        except ValueError:
+            pass
+    return time.monotonic() + max(0.0, budget_ms) / 1000
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[float]) -> Iterator[None]:
+    token = _DEADLINE.set(deadline)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def remaining_seconds() -> Optional[float]:
+    deadline = _DEADLINE.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def call_options() -> Dict[str, Any]:
+    """`retry`/`timeout` kwargs for Firestore calls, bounded by the request deadline.
+
+    Empty outside a deadline scope (background jobs keep the client defaults).
+    """
+
+    remaining = remaining_seconds()
+    if remaining is None:
+        return {}
+    remaining = max(remaining, 0.001)
+    retry = api_retry.Retry(
+        predicate=api_retry.if_transient_error,
+        initial=0.05,
+        maximum=min(1.0, remaining),
+        multiplier=2.0,
+        deadline=remaining,
+    )
+    return {"retry": retry, "timeout": remaining}
+
+
+def is_backend_failure(exc: BaseException) -> bool:
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    return any(
+        cls.__module__.startswith("google.api_core") and cls.__name__ in _BACKEND_FAILURES
+        for cls in type(exc).__mro__
+    )
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit driven by call latency and failures.
+
+    A call that completes under `target_latency` while the limit is at least
+    half used raises the limit by 1/limit (about +1 per limit's worth of
+    calls); a slow or failed call multiplies it by `backoff`, at most once
+    per `target_latency` so one burst of timeouts does not collapse it.
+    """
+
+    def __init__(
+        self,
+        initial: float = STORAGE_CONCURRENCY_INITIAL,
+        min_limit: float = STORAGE_CONCURRENCY_MIN,
+        max_limit: float = STORAGE_CONCURRENCY_MAX,
+        target_latency_ms: float = STORAGE_TARGET_LATENCY_MS,
+        backoff: float = 0.9,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency_ms / 1000
+        self.backoff = backoff
+        self._clock = clock
+        self._limit = min(max(initial, min_limit), max_limit)
+        self._inflight = 0
+        self._last_decrease = float("-inf")
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self) -> float:
+        return self._limit
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self._inflight >= int(self._limit):
+                return False
+            self._inflight += 1
+            return True
+
+    def release(self, latency: float, failed: bool = False) -> None:
+        with self._lock:
+            inflight = self._inflight
+            self._inflight -= 1
+            if failed or latency > self.target_latency:
+                now = self._clock()
+                if now - self._last_decrease >= self.target_latency:
+                    self._limit = max(self.min_limit, self._limit * self.backoff)
+                    self._last_decrease = now
+            elif inflight * 2 >= self._limit:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+
+class CircuitBreaker:
+    """Failure-ratio breaker over a sliding window of one-second buckets.
+
+    Opens when at least `min_calls` calls in the window failed at
+    `failure_ratio` or more; after `open_seconds` it lets `half_open_calls`
+    probes through and closes once they all succeed (any failure reopens).
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(
+        self,
+        failure_ratio: float = STORAGE_BREAKER_FAILURE_RATIO,
+        min_calls: int = STORAGE_BREAKER_MIN_CALLS,
+        window_seconds: int = STORAGE_BREAKER_WINDOW_SECONDS,
+        open_seconds: float = STORAGE_BREAKER_OPEN_SECONDS,
+        half_open_calls: int = STORAGE_BREAKER_HALF_OPEN_CALLS,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._clock = clock
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._buckets: Deque[List[int]] = deque()  # [second, calls, failures]
+        self._probes = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._maybe_half_open(self._clock())
+            return self._state
+
+    def state_value(self) -> int:
+        return self._STATE_VALUES[self.state]
+
+    def allow(self) -> Optional[float]:
+        """None if the call may proceed, else seconds until the next probe."""
+
+        with self._lock:
+            now = self._clock()
+            self._maybe_half_open(now)
+            if self._state == self.CLOSED:
+                return None
+            if self._state == self.OPEN:
+                return self._opened_at + self.open_seconds - now
+            if self._probes < self.half_open_calls:
+                self._probes += 1
+                return None
+            return self.open_seconds
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            now = self._clock()
+            if self._state == self.HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+                if not success:
+                    self._open(now)
+                    return
+                self._probe_successes += 1
+                if self._probe_successes >= self.half_open_calls:
+                    self._state = self.CLOSED
+                    self._buckets.clear()
+                    LOGGER.info("Storage circuit closed")
+                return
+            if self._state == self.OPEN:
+                return
+            second = int(now)
+            if not self._buckets or self._buckets[-1][0] != second:
+                self._buckets.append([second, 0, 0])
+            bucket = self._buckets[-1]
+            bucket[1] += 1
+            bucket[2] += 0 if success else 1
+            while self._buckets and self._buckets[0][0] <= second - self.window_seconds:
+                self._buckets.popleft()
+            calls = sum(entry[1] for entry in self._buckets)
+            failures = sum(entry[2] for entry in self._buckets)
+            if calls >= self.min_calls and failures >= calls * self.failure_ratio:
+                self._open(now)
+
+    def cancel(self) -> None:
+        """Return a half-open probe slot taken by `allow` for a call that never ran."""
+
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probes = max(0, self._probes - 1)
+
+    def _open(self, now: float) -> None:
+        if self._state != self.OPEN:
+            LOGGER.warning("Storage circuit opened", extra={"openSeconds": self.open_seconds})
+        self._state = self.OPEN
+        self._opened_at = now
+        self._probes = 0
+        self._probe_successes = 0
+
+    def _maybe_half_open(self, now: float) -> None:
+        if self._state == self.OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = self.HALF_OPEN
+            self._probes = 0
+            self._probe_successes = 0
+
+
+class StorageFaults:
+    """Synthetic latency/errors for storage calls, from STORAGE_FAULT_INJECTION.
+
+    Format: `latency_ms=300,error_rate=0.2,ops=aggregates|raw_event`
+    (`ops` optional, default all). Injected latency respects the deadline.
+    """
+
+    def __init__(self, latency_ms: float = 0.0, error_rate: float = 0.0, ops: Optional[frozenset] = None) -> None:
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.ops = ops
+
+    @classmethod
+    def parse(cls, raw: str) -> Optional["StorageFaults"]:
+        if not raw.strip():
+            return None
+        options = dict(part.split("=", 1) for part in raw.split(",") if "=" in part)
+        ops = options.get("ops")
+        return cls(
+            latency_ms=float(options.get("latency_ms", 0)),
+            error_rate=float(options.get("error_rate", 0)),
+            ops=frozenset(ops.split("|")) if ops else None,
+        )
+
+    def apply(self, op: str) -> None:
+        if self.ops is not None and op not in self.ops:
+            return
+        if self.latency:
+            remaining = remaining_seconds()
+            time.sleep(self.latency if remaining is None else max(0.0, min(self.latency, remaining)))
+            if remaining is not None and remaining < self.latency:
+                raise InjectedStorageFault(f"injected latency exceeded the deadline ({op})")
+        if self.error_rate and random.random() < self.error_rate:
+            raise InjectedStorageFault(f"injected storage error ({op})")
+
+
+class StorageGuard:
+    """Admission for storage calls: deadline check, circuit breaker, adaptive limit.
+
+    Refused calls raise a `StorageUnavailable` subclass without touching
+    Firestore; backend failures (see `is_backend_failure`) are re-raised as
+    `StorageUnavailable` after feeding the limiter and the breaker.
+    """
+
+    def __init__(
+        self,
+        limiter: AdaptiveLimiter,
+        breaker: CircuitBreaker,
+        faults: Optional[StorageFaults] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.limiter = limiter
+        self.breaker = breaker
+        self.faults = faults
+        self._clock = clock
+
+    def run(self, op: str, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        remaining = remaining_seconds()
+        if remaining is not None and remaining <= 0:
+            STORAGE_REJECTED.inc(op=op, reason=StorageDeadlineExceeded.reason)
+            raise StorageDeadlineExceeded(f"Deadline exceeded before {op}", STORAGE_OVERLOAD_RETRY_AFTER_SECONDS)
+        wait = self.breaker.allow()
+        if wait is not None:
+            STORAGE_REJECTED.inc(op=op, reason=StorageCircuitOpen.reason)
+            raise StorageCircuitOpen(f"Storage circuit open ({op})", wait)
+        if not self.limiter.try_acquire():
+            self.breaker.cancel()
+            STORAGE_REJECTED.inc(op=op, reason=StorageOverloaded.reason)
+            raise StorageOverloaded(f"Storage concurrency limit reached ({op})", STORAGE_OVERLOAD_RETRY_AFTER_SECONDS)
+
+        started = self._clock()
+        failed = False
+        try:
+            if self.faults is not None:
+                self.faults.apply(op)
+            return fn(*args, **kwargs)
+        except Exception as exc:
+            failed = is_backend_failure(exc)
+            if failed:
+                raise StorageUnavailable(f"Storage call failed ({op}): {exc}", self.breaker.open_seconds) from exc
+            raise
+        finally:
+            self.limiter.release(self._clock() - started, failed=failed)
+            self.breaker.record(not failed)
+            STORAGE_CALLS.inc(op=op, result="failure" if failed else "ok")
+
+
+STORAGE_GUARD = StorageGuard(
+    AdaptiveLimiter(),
+    CircuitBreaker(),
+    StorageFaults.parse(os.getenv("STORAGE_FAULT_INJECTION", "")),
+)
+if STORAGE_GUARD.faults is not None:
+    LOGGER.warning("Storage fault injection enabled", extra={"spec": os.getenv("STORAGE_FAULT_INJECTION")})
+
+STORAGE_LIMIT.set_callback(lambda: {metrics.labels(): STORAGE_GUARD.limiter.limit})
+STORAGE_INFLIGHT.set_callback(lambda: {metrics.labels(): float(STORAGE_GUARD.limiter.inflight)})
+STORAGE_BREAKER_STATE.set_callback(lambda: {metrics.labels(): float(STORAGE_GUARD.breaker.state_value())})
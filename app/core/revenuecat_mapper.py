@@ -1,3 +1,4 @@
+import time
 from typing import Any, Dict, Optional
 
 from app.config.logger import get_logger
@@ -14,6 +15,7 @@ def map_revenuecat_event(event: Dict[str, Any]) -> Dict[str, Any]:
       - price_in_purchased_currency
       - currency
       - country_code
+      - type, entitlement_ids, expiration_at_ms (premium status)
     """
 
     LOGGER.info("Mapping RevenueCat event", extra={"payload": event})
@@ -45,11 +47,32 @@ def map_revenuecat_event(event: Dict[str, Any]) -> Dict[str, Any]:
         "lastRevenueCatEventAt": event.get("event_timestamp_ms"),
         "countryCode": event.get("country_code"),
         "currency": currency,
+        "eventType": event.get("type"),
+        "entitlementIds": event.get("entitlement_ids"),
     }
+    mapped["isPremium"] = plan_is_premium(mapped)
     LOGGER.info("RevenueCat event mapped", extra={"mapped": mapped})
     return mapped
 
 
+def plan_is_premium(plan: Dict[str, Any], now_ms: Optional[float] = None) -> bool:
+    """Whether a mapped plan is premium at `now_ms` (default: now).
+
+    Evaluated on every read, not only when the webhook arrives, so a plan
+    lapses at `expiresAt` even if its EXPIRATION webhook is lost or late.
+    """
+
+    if plan.get("eventType") == "EXPIRATION":
+        return False
+    expires_at = plan.get("expiresAt")
+    if expires_at is None:
+        return bool(plan.get("entitlementIds"))
+    try:
+        return float(expires_at) > (time.time() * 1000 if now_ms is None else now_ms)
+    except (TypeError, ValueError):
+        return False
+
+
 def _amount(currency: Optional[str], amount: Optional[float]) -> Optional[Dict[str, Any]]:
     if amount is None or currency is None:
         return None
@@ -0,0 +1,310 @@
+from __future__ import annotations
+
+import calendar
+import datetime as dt
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.config.logger import get_logger
+from app.utils import metrics
+from app.utils.lazy import lazy_import
+from .actions import DEFAULT_ACTION_POLICY
+from .usage_tracker import MONTHLY_AGGREGATE_MODE, _parse_timestamp
+
+firestore = lazy_import("google.cloud.firestore")
+LOGGER = get_logger("usage_service.rollups")
+
+ROLLUP_INTERVAL_SECONDS = float(os.getenv("MONTHLY_ROLLUP_INTERVAL_SECONDS", "60"))
+ROLLUP_SWEEP_SECONDS = float(os.getenv("MONTHLY_ROLLUP_SWEEP_SECONDS", "900"))
+ROLLUP_SWEEP_LOOKBACK_SECONDS = float(os.getenv("MONTHLY_ROLLUP_SWEEP_LOOKBACK_SECONDS", "3600"))
+ROLLUP_GET_ALL_BATCH = int(os.getenv("MONTHLY_ROLLUP_GET_ALL_BATCH", "300"))
+
+ROLLUP_DOCS = metrics.counter("usage_monthly_rollup_docs_total", "usage_monthly docs rebuilt from daily docs.")
+ROLLUP_LAG = metrics.gauge("usage_monthly_rollup_lag_seconds", "Age of the oldest dirty month at the last rollup.")
+
+# Daily fields that describe the doc rather than count usage.
+_NON_ADDITIVE_FIELDS = frozenset(
+    ("userId", "day", "month", "hour", "lastEventAt", "updatedAt", "planSnapshot", "rebalancedFrom")
+)
+
+MonthKey = Tuple[str, str]  # (userId, YYYYMM)
+ClientsProvider = Callable[[], Iterable[Tuple[str, Any]]]
+
+
+def month_days(month_key: str, until: Optional[dt.date] = None) -> List[str]:
+    """YYYYMMDD keys of `month_key`, stopping at `until` for the current month."""
+
+    year, month = int(month_key[:4]), int(month_key[4:6])
+    last_day = calendar.monthrange(year, month)[1]
+    if until is not None and (until.year, until.month) == (year, month):
+        last_day = until.day
+    return [f"{month_key}{day:02d}" for day in range(1, last_day + 1)]
+
+
+def sum_daily_docs(user_id: str, month_key: str, daily_docs: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Fold daily aggregate docs (in day order) into a monthly doc body.
+
+    Numeric leaves are summed, nested maps (actions, models, ...) merged;
+    `lastEventAt` and `planSnapshot` come from the latest day carrying them.
+    `actions` is capped to the top AGGREGATE_MAX_ACTIONS by request count.
+    """
+
+    monthly: Dict[str, Any] = {"userId": user_id, "month": month_key}
+    source_updated_at = None
+    days = 0
+    for doc in daily_docs:
+        days += 1
+        for field, value in doc.items():
+            if field in ("lastEventAt", "planSnapshot") and value is not None:
+                monthly[field] = value
+            elif field == "updatedAt" and isinstance(value, dt.datetime):
+                source_updated_at = value if source_updated_at is None else max(source_updated_at, value)
+            elif field not in _NON_ADDITIVE_FIELDS:
+                monthly[field] = _add(monthly.get(field), value)
+    if isinstance(monthly.get("actions"), dict):
+        monthly["actions"] = DEFAULT_ACTION_POLICY.cap(monthly["actions"])
+    monthly["sourceDays"] = days
+    if source_updated_at is not None:
+        monthly["sourceUpdatedAt"] = source_updated_at
+    return monthly
+
+
+def monthly_from_daily(db: firestore.Client, user_id: str, month_key: str) -> Dict[str, Any]:
+    """Compute a month-to-date doc body straight from the daily docs."""
+
+    return _compute_months(db, [(user_id, month_key)])[(user_id, month_key)]
+
+
+class MonthlyRollupScheduler:
+    """Rebuilds usage_monthly from usage_daily in AGGREGATE_MONTHLY_MODE=derived.
+
+    Commits mark (userId, month) dirty in memory. A background thread
+    recomputes dirty months every `interval_seconds` with batched `get_all`
+    reads of the daily docs and writes them through a BulkWriter, so a
+    monthly doc lags its daily docs by at most `staleness_bound_seconds`
+    while the process is alive. A periodic sweep of daily docs by
+    `updatedAt` re-marks months written by other or crashed workers.
+    """
+
+    def __init__(
+        self,
+        interval_seconds: float = ROLLUP_INTERVAL_SECONDS,
+        sweep_seconds: float = ROLLUP_SWEEP_SECONDS,
+        sweep_lookback_seconds: float = ROLLUP_SWEEP_LOOKBACK_SECONDS,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.interval_seconds = interval_seconds
+        self.sweep_seconds = sweep_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dirty: Dict[MonthKey, Tuple[Any, float]] = {}
+        self._watermarks: Dict[str, dt.datetime] = {}
+        self._sweep_lookback = dt.timedelta(seconds=sweep_lookback_seconds)
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return MONTHLY_AGGREGATE_MODE == "derived"
+
+    @property
+    def staleness_bound_seconds(self) -> float:
+        # A key marked just after a flush waits one interval; the second
+        # interval covers the flush itself (reads + bulk write).
+        return 2 * self.interval_seconds
+
+    def observe_event(self, db: firestore.Client, event: Dict[str, Any]) -> None:
+        """Commit listener: mark the event's (userId, month) dirty."""
+
+        if not self.enabled or not event.get("userId"):
+            return
+        month_key = _parse_timestamp(event["timestamp"]).strftime("%Y%m")
+        self.mark_dirty(db, event["userId"], month_key)
+
+    def mark_dirty(self, db: firestore.Client, user_id: str, month_key: str) -> None:
+        with self._lock:
+            # Keep the first-dirty time: it is what staleness is measured from.
+            if (user_id, month_key) not in self._dirty:
+                self._dirty[(user_id, month_key)] = (db, self._clock())
+
+    def is_dirty(self, user_id: str, month_key: str) -> bool:
+        with self._lock:
+            return (user_id, month_key) in self._dirty
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._dirty)
+
+    def flush(self) -> int:
+        """Recompute and write all dirty months. Returns the number of docs written."""
+
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return 0
+            by_client: Dict[int, Tuple[Any, List[MonthKey]]] = {}
+            for key, (db, _) in dirty.items():
+                by_client.setdefault(id(db), (db, []))[1].append(key)
+            written = 0
+            for db, keys in by_client.values():
+                try:
+                    written += rollup_months(db, keys)
+                except Exception as exc:  # noqa: BLE001
+                    with self._lock:
+                        for key in keys:
+                            self._dirty.setdefault(key, dirty[key])
+                    LOGGER.warning("Monthly rollup failed", extra={"months": len(keys), "error": str(exc)})
+            lag = self._clock() - min(marked_at for _, marked_at in dirty.values())
+            ROLLUP_DOCS.inc(written)
+            ROLLUP_LAG.set(lag)
+            LOGGER.info("Monthly rollup flushed", extra={"docs": written, "maxLagSeconds": round(lag, 3)})
+            return written
+
+    def sweep(self, name: str, db: firestore.Client) -> int:
+        """Mark months of daily docs updated since this partition's watermark dirty."""
+
+        from google.cloud.firestore_v1.base_query import FieldFilter
+
+        now = dt.datetime.now(dt.timezone.utc)
+        since = self._watermarks.get(name, now - self._sweep_lookback)
+        # Overlap by one interval so writes committed while the previous
+        # sweep ran are not missed.
+        since -= dt.timedelta(seconds=self.interval_seconds)
+        query = (
+            db.collection("usage_daily")
+            .where(filter=FieldFilter("updatedAt", ">=", since))
+            .select(["userId", "day"])
+        )
+        marked = 0
+        for snapshot in query.stream():
+            data = snapshot.to_dict() or {}
+            user_id, day_key = data.get("userId"), data.get("day")
+            if not user_id or not day_key:
+                continue
+            self.mark_dirty(db, user_id, str(day_key)[:6])
+            marked += 1
+        self._watermarks[name] = now
+        LOGGER.info("Monthly rollup sweep", extra={"partition": name, "dailyDocs": marked})
+        return marked
+
+    def start(self, clients: ClientsProvider) -> None:
+        """Run flushes (and sweeps over `clients()`) in a daemon thread."""
+
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(clients,), name="monthly-rollup", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the thread and flush what is still dirty."""
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval_seconds)
+            self._thread = None
+        if self.enabled:
+            self.flush()
+
+    def _run(self, clients: ClientsProvider) -> None:
+        next_sweep = 0.0
+        while not self._stop.is_set():
+            if self.sweep_seconds > 0 and time.monotonic() >= next_sweep:
+                next_sweep = time.monotonic() + self.sweep_seconds
+                for name, db in clients():
+                    try:
+                        self.sweep(name, db)
+                    except Exception as exc:  # noqa: BLE001
+                        LOGGER.warning("Monthly rollup sweep failed", extra={"partition": name, "error": str(exc)})
+            try:
+                self.flush()
+            except Exception as exc:  # noqa: BLE001
+                LOGGER.warning("Monthly rollup flush failed", extra={"error": str(exc)})
+            self._stop.wait(self.interval_seconds)
+
+
+def rollup_months(db: firestore.Client, keys: List[MonthKey]) -> int:
+    """Rebuild usage_monthly docs for `(userId, YYYYMM)` keys from their daily docs.
+
+    Monthly docs are overwritten (not merged) and stamped with `rolledUpAt`.
+    Returns the number of docs written.
+    """
+
+    monthly_docs = _compute_months(db, keys)
+    writer = db.bulk_writer()
+    try:
+        for (user_id, month_key), body in monthly_docs.items():
+            body["rolledUpAt"] = firestore.SERVER_TIMESTAMP
+            body["updatedAt"] = firestore.SERVER_TIMESTAMP
+            writer.set(db.collection("usage_monthly").document(f"{user_id}_{month_key}"), body)
+    finally:
+        writer.close()
+    return len(monthly_docs)
+
+
+def read_month_to_date(
+    db: firestore.Client,
+    user_id: str,
+    month_key: str,
+    max_staleness_seconds: Optional[float] = None,
+    scheduler: Optional[MonthlyRollupScheduler] = None,
+) -> Dict[str, Any]:
+    """Month-to-date totals for a user with a staleness bound.
+
+    Inline mode, or derived mode when the caller accepts the scheduler's
+    staleness bound and this process has no pending rollup for the month,
+    reads usage_monthly. Otherwise the month is computed from daily docs.
+    The result carries `source` ("monthly" or "daily").
+    """
+
+    scheduler = scheduler or DEFAULT_ROLLUP
+    use_monthly = not scheduler.enabled or (
+        (max_staleness_seconds is None or max_staleness_seconds >= scheduler.staleness_bound_seconds)
+        and not scheduler.is_dirty(user_id, month_key)
+    )
+    if use_monthly:
+        snapshot = db.collection("usage_monthly").document(f"{user_id}_{month_key}").get()
+        body = snapshot.to_dict() if snapshot.exists else {"userId": user_id, "month": month_key}
+        body = dict(body or {})
+        body["source"] = "monthly"
+    else:
+        body = monthly_from_daily(db, user_id, month_key)
+        body["source"] = "daily"
+    if scheduler.enabled:
+        body["stalenessBoundSeconds"] = 0.0 if body["source"] == "daily" else scheduler.staleness_bound_seconds
+    return body
+
+
+def _compute_months(db: firestore.Client, keys: List[MonthKey]) -> Dict[MonthKey, Dict[str, Any]]:
+    today = dt.datetime.now(dt.timezone.utc).date()
+    doc_ids = {key: [f"{key[0]}_{day_key}" for day_key in month_days(key[1], until=today)] for key in keys}
+    refs = [db.collection("usage_daily").document(doc_id) for ids in doc_ids.values() for doc_id in ids]
+    by_id: Dict[str, Dict[str, Any]] = {}
+    for start in range(0, len(refs), ROLLUP_GET_ALL_BATCH):
+        for snapshot in db.get_all(refs[start : start + ROLLUP_GET_ALL_BATCH]):
+            if snapshot.exists:
+                by_id[snapshot.id] = snapshot.to_dict() or {}
+    return {
+        (user_id, month_key): sum_daily_docs(
+            user_id, month_key, (by_id[doc_id] for doc_id in doc_ids[(user_id, month_key)] if doc_id in by_id)
+        )
+        for user_id, month_key in keys
+    }
+
+
+def _add(current: Any, value: Any) -> Any:
+    if isinstance(value, dict):
+        merged = dict(current) if isinstance(current, dict) else {}
+        for key, item in value.items():
+            merged[key] = _add(merged.get(key), item)
+        return merged
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (current if isinstance(current, (int, float)) else 0) + value
+    return value if current is None else current
+
+
+DEFAULT_ROLLUP = MonthlyRollupScheduler()
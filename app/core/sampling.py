@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from app.utils import metrics
+
+RAW_EVENT_SAMPLE_RATE = float(os.getenv("RAW_EVENT_SAMPLE_RATE", "1.0"))
+RAW_EVENT_COST_THRESHOLD_USD = float(os.getenv("RAW_EVENT_COST_THRESHOLD_USD", "0.05"))
+RAW_EVENT_LATENCY_THRESHOLD_MS = float(os.getenv("RAW_EVENT_LATENCY_THRESHOLD_MS", "10000"))
+
+RAW_EVENT_SAMPLING = metrics.counter("usage_raw_event_sampling_total", "Raw event sampling decisions by reason.")
+
+
+@dataclass(frozen=True)
+class SamplingDecision:
+    keep: bool
+    reason: str
+    weight: float = 1.0
+
+
+class TailSampler:
+    """Decide after the fact which raw events are worth a `usage_events` doc.
+
+    Failures (`status` other than success, any `errorCode`) and events at or
+    above the cost or latency threshold are always kept with weight 1. The
+    rest are kept when a hash of `requestId` falls below `rate`, with weight
+    1/rate, so summing `samplingWeight` (or weight x field) over stored
+    events is an unbiased estimate of the full count (or total). Hashing the
+    requestId makes retries and other workers take the same decision.
+    """
+
+    def __init__(
+        self,
+        rate: float = RAW_EVENT_SAMPLE_RATE,
+        cost_threshold_usd: float = RAW_EVENT_COST_THRESHOLD_USD,
+        latency_threshold_ms: float = RAW_EVENT_LATENCY_THRESHOLD_MS,
+    ) -> None:
+        self.rate = min(max(rate, 0.0), 1.0)
+        self.cost_threshold_usd = cost_threshold_usd
+        self.latency_threshold_ms = latency_threshold_ms
+
+    def decide(self, event: Dict[str, Any]) -> SamplingDecision:
+        status = event.get("status")
+        if status and status != "success":
+            return SamplingDecision(True, "status")
+        if event.get("errorCode"):
+            return SamplingDecision(True, "error")
+        if self.cost_threshold_usd > 0 and _number(event.get("costUSD")) >= self.cost_threshold_usd:
+            return SamplingDecision(True, "cost")
+        if self.latency_threshold_ms > 0 and _number(event.get("latencyMs")) >= self.latency_threshold_ms:
+            return SamplingDecision(True, "latency")
+        if self.rate >= 1.0:
+            return SamplingDecision(True, "all")
+        if self.rate > 0.0 and sample_point(str(event.get("requestId") or "")) < self.rate:
+            return SamplingDecision(True, "sampled", 1.0 / self.rate)
+        return SamplingDecision(False, "dropped", 0.0)
+
+    def apply(self, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Return `event` with samplingWeight/samplingReason set, or None if it is not kept."""
+
+        decision = self.decide(event)
+        RAW_EVENT_SAMPLING.inc(reason=decision.reason)
+        if not decision.keep:
+            return None
+        return {**event, "samplingWeight": decision.weight, "samplingReason": decision.reason}
+
+
+def sample_point(request_id: str) -> float:
+    """Uniform value in [0, 1) derived from the requestId."""
+
+    digest = hashlib.blake2b(request_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64
+
+
+def _number(value: Any) -> float:
+    try:
+        return float(value or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+DEFAULT_SAMPLER = TailSampler()
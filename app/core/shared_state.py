@@ -0,0 +1,323 @@
+import atexit
+import contextlib
+import fcntl
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Optional, Tuple
+
+from app.config.logger import get_logger
+
+LOGGER = get_logger("usage_service.shared_state")
+
+SHARED_MEMORY_ENABLED = os.getenv("USAGE_SHARED_MEMORY", "").lower() in ("1", "true", "yes", "on")
+SHARED_MEMORY_PREFIX = os.getenv("USAGE_SHM_PREFIX", "usage_service")
+
+# Segment name suffixes of the SharedState tables.
+_TABLE_SUFFIXES = ("fx", "requests", "totals")
+
+_HEADER = struct.Struct("<QQ")  # seqlock version, key hash (0 = empty slot)
+_MAX_PROBE = 16
+_MAX_READ_RETRIES = 1000
+
+Values = Tuple[float, ...]
+
+
+class SharedHashTable:
+    """Fixed-size open-addressing hash table in `multiprocessing.shared_memory`.
+
+    Each slot holds a seqlock version, a 64-bit key hash and `value_count`
+    float64 values. The last value is the entry timestamp and drives
+    eviction when a probe sequence is full. Readers never lock: they retry
+    while a slot's version is odd or changes under them. Writers from all
+    processes serialise on an flock()ed lock file.
+    """
+
+    def __init__(self, name: str, capacity: int, value_count: int, create: bool) -> None:
+        self.name = name
+        self.capacity = capacity
+        self._values = struct.Struct(f"<{value_count}d")
+        self._slot_size = _HEADER.size + self._values.size
+        size = capacity * self._slot_size
+        self._shm = _open_segment(name, size, create)
+        self._buf = self._shm.buf
+        self._lock_path = os.path.join(tempfile.gettempdir(), f"{name}.lock")
+        self._lock_fd: Optional[int] = None
+        self._lock_pid: Optional[int] = None
+        self._thread_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Values]:
+        key_hash = _hash_key(key)
+        for offset in self._probe(key_hash):
+            found, stored_hash, values = self._read_slot(offset)
+            if not found or stored_hash == 0:
+                return None
+            if stored_hash == key_hash:
+                return values
+        return None
+
+    def put(self, key: str, values: Values) -> None:
+        self.update(key, lambda _current: values)
+
+    def update(self, key: str, compute: Callable[[Optional[Values]], Optional[Values]]) -> Optional[Values]:
+        """Read-modify-write `key` under the cross-process writer lock.
+
+        `compute` receives the current values (or None) and returns the new
+        values, or None to leave the table unchanged.
+        """
+
+        key_hash = _hash_key(key)
+        with self._writer_lock():
+            target: Optional[int] = None
+            oldest: Optional[Tuple[float, int]] = None
+            current: Optional[Values] = None
+            for offset in self._probe(key_hash):
+                _, stored_hash = _HEADER.unpack_from(self._buf, offset)
+                if stored_hash == key_hash:
+                    target = offset
+                    current = self._values.unpack_from(self._buf, offset + _HEADER.size)
+                    break
+                if stored_hash == 0:
+                    target = offset
+                    break
+                stamp = self._values.unpack_from(self._buf, offset + _HEADER.size)[-1]
+                if oldest is None or stamp < oldest[0]:
+                    oldest = (stamp, offset)
+            if target is None and oldest is not None:
+                target = oldest[1]
+            new_values = compute(current)
+            if new_values is None or target is None:
+                return current
+            self._write_slot(target, key_hash, new_values)
+            return new_values
+
+    def close(self) -> None:
+        self._buf = None
+        self._shm.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def unlink(self) -> None:
+        _unlink_segment(self._shm, self._lock_path)
+
+    def _probe(self, key_hash: int):
+        start = key_hash % self.capacity
+        for step in range(min(_MAX_PROBE, self.capacity)):
+            yield ((start + step) % self.capacity) * self._slot_size
+
+    def _read_slot(self, offset: int) -> Tuple[bool, int, Optional[Values]]:
+        buf = self._buf
+        for _ in range(_MAX_READ_RETRIES):
+            version, stored_hash = _HEADER.unpack_from(buf, offset)
+            if version & 1:
+                continue
+            values = self._values.unpack_from(buf, offset + _HEADER.size)
+            if _HEADER.unpack_from(buf, offset)[0] == version:
+                return True, stored_hash, values
+        return False, 0, None
+
+    def _write_slot(self, offset: int, key_hash: int, values: Values) -> None:
+        version, _ = _HEADER.unpack_from(self._buf, offset)
+        _HEADER.pack_into(self._buf, offset, version + 1, key_hash)
+        self._values.pack_into(self._buf, offset + _HEADER.size, *values)
+        _HEADER.pack_into(self._buf, offset, version + 2, key_hash)
+
+    @contextlib.contextmanager
+    def _writer_lock(self):
+        with self._thread_lock:
+            lock_fd = self._lock_file()
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+    def _lock_file(self) -> int:
+        # flock() locks belong to the open file description, which fork()
+        # shares; reopen per process so workers actually exclude each other.
+        pid = os.getpid()
+        if self._lock_fd is None or self._lock_pid != pid:
+            self._lock_fd = os.open(self._lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            self._lock_pid = pid
+        return self._lock_fd
+
+
+class SharedState:
+    """Shared-memory tables used by all workers of one container."""
+
+    def __init__(self, prefix: str, create: bool) -> None:
+        self.fx_rates = SharedHashTable(
+            f"{prefix}_fx",
+            int(os.getenv("USAGE_SHM_FX_CAPACITY", "256")),
+            value_count=2,  # rate, updatedAt (epoch seconds)
+            create=create,
+        )
+        self.recent_requests = SharedHashTable(
+            f"{prefix}_requests",
+            int(os.getenv("USAGE_SHM_REQUEST_CAPACITY", "65536")),
+            value_count=1,  # seenAt (epoch seconds)
+            create=create,
+        )
+        self.user_totals = SharedHashTable(
+            f"{prefix}_totals",
+            int(os.getenv("USAGE_SHM_TOTALS_CAPACITY", "65536")),
+            value_count=3,  # costUsd, tokens, updatedAt
+            create=create,
+        )
+        self.request_ttl_seconds = float(os.getenv("USAGE_SHM_REQUEST_TTL_SECONDS", "3600"))
+
+    def tables(self):
+        return (self.fx_rates, self.recent_requests, self.user_totals)
+
+    def is_recent_request(self, request_id: str) -> bool:
+        seen = self.recent_requests.get(request_id)
+        return seen is not None and time.time() - seen[0] <= self.request_ttl_seconds
+
+    def mark_request(self, request_id: str) -> None:
+        self.recent_requests.put(request_id, (time.time(),))
+
+    def get_totals(self, user_id: str, period_key: str) -> Optional[Tuple[float, float]]:
+        values = self.user_totals.get(f"{user_id}:{period_key}")
+        return (values[0], values[1]) if values is not None else None
+
+    def seed_totals(self, user_id: str, period_key: str, cost_usd: float, tokens: float) -> None:
+        """Store Firestore-seeded totals unless another worker already did."""
+
+        now = time.time()
+        self.user_totals.update(
+            f"{user_id}:{period_key}",
+            lambda current: (cost_usd, tokens, now) if current is None else None,
+        )
+
+    def add_totals(self, user_id: str, period_key: str, cost_usd: float, tokens: float) -> None:
+        """Add to already-seeded totals; unseeded keys are left for the next seed."""
+
+        now = time.time()
+        self.user_totals.update(
+            f"{user_id}:{period_key}",
+            lambda current: None if current is None else (current[0] + cost_usd, current[1] + tokens, now),
+        )
+
+    def close(self) -> None:
+        for table in self.tables():
+            table.close()
+
+    def unlink(self) -> None:
+        for table in self.tables():
+            table.unlink()
+
+
+_STATE: Optional[SharedState] = None
+_STATE_LOCK = threading.Lock()
+
+
+def get_shared_state() -> Optional[SharedState]:
+    """Return this process's handle on the shared tables, or None if disabled.
+
+    Segments are created by the gunicorn master in `on_starting` and
+    attached by name everywhere else. Without gunicorn the first process
+    that needs them creates them and unlinks them when it exits.
+    """
+
+    global _STATE
+    if not SHARED_MEMORY_ENABLED:
+        return None
+    if _STATE is not None:
+        return _STATE
+    with _STATE_LOCK:
+        if _STATE is None:
+            try:
+                _STATE = SharedState(SHARED_MEMORY_PREFIX, create=False)
+            except FileNotFoundError:
+                _STATE = SharedState(SHARED_MEMORY_PREFIX, create=True)
+                atexit.register(_destroy_if_owner, os.getpid())
+                LOGGER.info("Shared memory segments created", extra={"prefix": SHARED_MEMORY_PREFIX})
+    return _STATE
+
+
+def create_shared_state() -> Optional[SharedState]:
+    """Create fresh segments; call once from the pre-fork master.
+
+    Segments left behind by a master that died without `on_exit` are
+    unlinked first, so workers never start from its stale totals.
+    """
+
+    global _STATE
+    if not SHARED_MEMORY_ENABLED:
+        return None
+    with _STATE_LOCK:
+        if _STATE is None:
+            for suffix in _TABLE_SUFFIXES:
+                name = f"{SHARED_MEMORY_PREFIX}_{suffix}"
+                try:
+                    segment = _open_segment(name, 0, create=False)
+                except FileNotFoundError:
+                    continue
+                segment.close()
+                _unlink_segment(segment, os.path.join(tempfile.gettempdir(), f"{name}.lock"))
+                LOGGER.warning("Stale shared memory segment removed", extra={"segment": name})
+            _STATE = SharedState(SHARED_MEMORY_PREFIX, create=True)
+            LOGGER.info("Shared memory segments created", extra={"prefix": SHARED_MEMORY_PREFIX})
+    return _STATE
+
+
+def destroy_shared_state() -> None:
+    """Close and unlink the segments; call once from the master on exit."""
+
+    global _STATE
+    if _STATE is None:
+        return
+    _STATE.close()
+    _STATE.unlink()
+    _STATE = None
+    LOGGER.info("Shared memory segments removed", extra={"prefix": SHARED_MEMORY_PREFIX})
+
+
+def _destroy_if_owner(owner_pid: int) -> None:
+    # Forked children inherit atexit handlers; only the creator unlinks.
+    if os.getpid() == owner_pid:
+        destroy_shared_state()
+
+
+def _unlink_segment(segment: shared_memory.SharedMemory, lock_path: str) -> None:
+    # unlink() unregisters from the resource tracker; register first so
+    # the tracker (which we opted out of in _open_segment) stays quiet.
+    resource_tracker.register(segment._name, "shared_memory")  # type: ignore[attr-defined]
+    try:
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+    try:
+        os.unlink(lock_path)
+    except FileNotFoundError:
+        pass
+
+
+def _open_segment(name: str, size: int, create: bool) -> shared_memory.SharedMemory:
+    if create:
+        try:
+            # New segments are zero-filled, i.e. every slot starts empty.
+            segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            segment = shared_memory.SharedMemory(name=name)
+    else:
+        segment = shared_memory.SharedMemory(name=name)
+    # Python's resource tracker unlinks segments when *any* attached process
+    # exits; lifecycle is owned by destroy_shared_state instead.
+    try:
+        resource_tracker.unregister(segment._name, "shared_memory")  # type: ignore[attr-defined]
+    except Exception:  # noqa: BLE001
+        pass
+    if segment.size < size:
+        segment.close()
+        raise ValueError(f"shared memory segment {name} is smaller than expected ({segment.size} < {size})")
+    return segment
+
+
+def _hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big") or 1
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional
+
+from app.utils.cache import TtlCache
+
+# Aggregate fields that never change for a doc (userId, period key) or change
+# rarely (planSnapshot). Everything else is an Increment or per-event value.
+STATIC_AGGREGATE_FIELDS = ("userId", "day", "month", "hour", "planSnapshot")
+
+
+class StaticFieldCache:
+    """Per-process fingerprints of the static fields last written per doc.
+
+    Static fields are only sent when a doc is first written by this process,
+    when their fingerprint changes, or once the entry expires after
+    `refresh_seconds` (forced refresh in case the doc was rewritten elsewhere).
+    """
+
+    def __init__(self, max_entries: int = 100_000, refresh_seconds: float = 3600.0) -> None:
+        self._cache: TtlCache[str] = TtlCache(max_entries=max_entries, ttl_seconds=refresh_seconds)
+
+    def needs_write(self, doc_path: str, fingerprint: str) -> bool:
+        return self._cache.get(doc_path) != fingerprint
+
+    def record(self, doc_path: str, fingerprint: str) -> None:
+        """Call only after the write carrying the static fields committed."""
+
+        self._cache.set(doc_path, fingerprint)
+
+    def forget(self, doc_path: str) -> None:
+        self._cache.invalidate(doc_path)
+
+
+def static_fingerprint(update: Dict[str, Any], plan_snapshot: Optional[Dict[str, Any]] = None) -> str:
+    static = {field: update.get(field) for field in STATIC_AGGREGATE_FIELDS if field in update}
+    if plan_snapshot is not None:
+        static["planSnapshot"] = plan_snapshot
+    encoded = json.dumps(static, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def strip_static_fields(update: Dict[str, Any]) -> Dict[str, Any]:
+    return {field: value for field, value in update.items() if field not in STATIC_AGGREGATE_FIELDS}
+
+
+STATIC_FIELD_CACHE_ENABLED = os.getenv("AGGREGATE_STATIC_FIELD_CACHE", "true").lower() in ("1", "true", "yes", "on")
+DEFAULT_STATIC_FIELD_CACHE = StaticFieldCache(
+    max_entries=int(os.getenv("AGGREGATE_STATIC_FIELD_CACHE_SIZE", "100000")),
+    refresh_seconds=float(os.getenv("AGGREGATE_STATIC_FIELD_REFRESH_SECONDS", "3600")),
+)
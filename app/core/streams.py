@@ -0,0 +1,272 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from app.config.logger import get_logger
+from app.utils import metrics
+from app.utils.lazy import lazy_import
+from .usage_tracker import _parse_timestamp, _resolved_cost_try
+
+firestore = lazy_import("google.cloud.firestore")
+LOGGER = get_logger("usage_service.streams")
+
+STREAM_SUBSCRIBER_BUFFER = int(os.getenv("STREAM_SUBSCRIBER_BUFFER", "256"))
+STREAM_RESUME_BUFFER = int(os.getenv("STREAM_RESUME_BUFFER", "512"))
+STREAM_RESUME_SECONDS = float(os.getenv("STREAM_RESUME_SECONDS", "300"))
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+STREAM_MAX_SUBSCRIBERS = int(os.getenv("STREAM_MAX_SUBSCRIBERS", "1000"))
+
+STREAM_SUBSCRIBERS = metrics.gauge("usage_stream_subscribers", "Open usage SSE streams in this process.")
+STREAM_MESSAGES = metrics.counter("usage_stream_messages_total", "Aggregate deltas offered to SSE subscribers by result.")
+STREAM_CONNECTS = metrics.counter("usage_stream_connects_total", "SSE stream connects by resume outcome.")
+
+
+class TooManySubscribers(RuntimeError):
+    pass
+
+
+class _Subscriber:
+    __slots__ = ("loop", "buffer", "capacity", "wakeup", "dropped")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, capacity: int) -> None:
+        self.loop = loop
+        self.buffer: Deque[Tuple[int, Dict[str, Any]]] = deque()
+        self.capacity = capacity
+        self.wakeup = asyncio.Event()
+        self.dropped = False
+
+    def offer(self, message: Tuple[int, Dict[str, Any]]) -> None:
+        # Runs on the subscriber's event loop.
+        if self.dropped:
+            return
+        if len(self.buffer) >= self.capacity:
+            self.dropped = True
+            STREAM_MESSAGES.inc(result="dropped")
+        else:
+            self.buffer.append(message)
+            STREAM_MESSAGES.inc(result="queued")
+        self.wakeup.set()
+
+
+class _Channel:
+    __slots__ = ("subscribers", "ring", "evicted_through", "idle_since")
+
+    def __init__(self, created_seq: int, ring_size: int) -> None:
+        self.subscribers: Set[_Subscriber] = set()
+        self.ring: Deque[Tuple[int, Dict[str, Any]]] = deque(maxlen=ring_size)
+        # Highest seq this channel can no longer replay.
+        self.evicted_through = created_seq
+        self.idle_since: Optional[float] = None
+
+
+class UsageStreamHub:
+    """In-process pub/sub of committed aggregate deltas, keyed by userId.
+
+    The commit listener runs on ingest threads; deltas are handed to each
+    subscriber's event loop with `call_soon_threadsafe` and queued in a
+    buffer of `subscriber_buffer` messages. A subscriber whose buffer is
+    full is dropped (its stream ends) instead of slowing ingest down.
+
+    Users with a subscriber, or one in the last `resume_seconds`, keep
+    their last `resume_buffer` deltas. Every delta carries a
+    `{epoch}-{seq}` token (SSE `id`); reconnecting with it replays what was
+    missed, or yields a `reset` when the gap is no longer buffered or the
+    token is from another process, and the client re-reads the aggregates.
+
+    Only events committed by this process are published: with several
+    workers or instances, ingest for a user must reach the same process
+    as its streams (or clients subscribe to each).
+    """
+
+    def __init__(
+        self,
+        subscriber_buffer: int = STREAM_SUBSCRIBER_BUFFER,
+        resume_buffer: int = STREAM_RESUME_BUFFER,
+        resume_seconds: float = STREAM_RESUME_SECONDS,
+        max_subscribers: int = STREAM_MAX_SUBSCRIBERS,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.subscriber_buffer = subscriber_buffer
+        self.resume_buffer = resume_buffer
+        self.resume_seconds = resume_seconds
+        self.max_subscribers = max_subscribers
+        self.epoch = uuid.uuid4().hex[:12]
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._channels: Dict[str, _Channel] = {}
+        self._seq = 0
+        self._subscribers = 0
+
+    def token(self, seq: int) -> str:
+        return f"{self.epoch}-{seq}"
+
+    def observe_event(self, db: firestore.Client, event: Dict[str, Any]) -> None:
+        """Commit listener: publish the event's aggregate delta to the user's subscribers."""
+
+        user_id = event.get("userId")
+        if not user_id or user_id not in self._channels:
+            return
+        delta = aggregate_delta(event)
+        with self._lock:
+            channel = self._channels.get(user_id)
+            if channel is None:
+                return
+            self._seq += 1
+            message = (self._seq, delta)
+            if len(channel.ring) == channel.ring.maxlen:
+                channel.evicted_through = channel.ring[0][0]
+            channel.ring.append(message)
+            subscribers = list(channel.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.loop.call_soon_threadsafe(subscriber.offer, message)
+            except RuntimeError:
+                # Loop closed under us; the stream is already gone.
+                pass
+
+    async def stream(self, user_id: str, resume_token: Optional[str] = None) -> AsyncIterator[str]:
+        """Subscribe and yield SSE frames until the client goes away or is dropped.
+
+        The subscription is made on the first iteration, so an unconsumed
+        generator holds nothing. Check `has_capacity()` before responding.
+        """
+
+        try:
+            subscriber, start_seq, backlog, reset_reason = self._subscribe(user_id, resume_token)
+        except TooManySubscribers:
+            yield format_sse("dropped", {"reason": "capacity"})
+            return
+        try:
+            # Everything up to start_seq is in the backlog, the rest arrives
+            # in the buffer. With a backlog the ready frame carries no id, so
+            # a disconnect mid-replay resumes from the last replayed delta.
+            if reset_reason:
+                yield format_sse("reset", {"reason": reset_reason}, self.token(start_seq))
+            else:
+                yield format_sse("ready", {"replayed": len(backlog)}, None if backlog else self.token(start_seq))
+            for seq, delta in backlog:
+                yield format_sse("usage", delta, self.token(seq))
+            while True:
+                if not subscriber.buffer and not subscriber.dropped:
+                    subscriber.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(subscriber.wakeup.wait(), STREAM_HEARTBEAT_SECONDS)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                        continue
+                while subscriber.buffer:
+                    seq, delta = subscriber.buffer.popleft()
+                    yield format_sse("usage", delta, self.token(seq))
+                if subscriber.dropped:
+                    # Reconnecting with the last id resumes from the ring buffer.
+                    yield format_sse("dropped", {"reason": "slow_consumer"})
+                    return
+        finally:
+            self._unsubscribe(user_id, subscriber)
+
+    def subscribers(self) -> int:
+        with self._lock:
+            return self._subscribers
+
+    def has_capacity(self) -> bool:
+        return self.subscribers() < self.max_subscribers
+
+    def _subscribe(
+        self, user_id: str, resume_token: Optional[str]
+    ) -> Tuple[_Subscriber, int, List[Tuple[int, Dict[str, Any]]], Optional[str]]:
+        subscriber = _Subscriber(asyncio.get_running_loop(), self.subscriber_buffer)
+        with self._lock:
+            if self._subscribers >= self.max_subscribers:
+                raise TooManySubscribers(f"{self._subscribers} open streams")
+            self._prune()
+            channel = self._channels.get(user_id)
+            if channel is None:
+                channel = self._channels[user_id] = _Channel(self._seq, self.resume_buffer)
+            channel.subscribers.add(subscriber)
+            channel.idle_since = None
+            self._subscribers += 1
+            subscribers = self._subscribers
+            start_seq = self._seq
+            backlog: List[Tuple[int, Dict[str, Any]]] = []
+            reset_reason = None
+            if resume_token:
+                seq = self._parse_token(resume_token)
+                if seq is None:
+                    reset_reason = "unknown_token"
+                elif seq < channel.evicted_through:
+                    reset_reason = "expired"
+                else:
+                    backlog = [message for message in channel.ring if message[0] > seq]
+        STREAM_SUBSCRIBERS.set(subscribers)
+        STREAM_CONNECTS.inc(result=reset_reason or ("resumed" if resume_token else "new"))
+        LOGGER.info(
+            "Usage stream subscribed",
+            extra={"userId": user_id, "replayed": len(backlog), "reset": reset_reason, "subscribers": subscribers},
+        )
+        return subscriber, start_seq, backlog, reset_reason
+
+    def _unsubscribe(self, user_id: str, subscriber: _Subscriber) -> None:
+        with self._lock:
+            channel = self._channels.get(user_id)
+            if channel is not None and subscriber in channel.subscribers:
+                channel.subscribers.discard(subscriber)
+                self._subscribers -= 1
+                if not channel.subscribers:
+                    channel.idle_since = self._clock()
+            self._prune()
+            subscribers = self._subscribers
+        STREAM_SUBSCRIBERS.set(subscribers)
+        LOGGER.info("Usage stream closed", extra={"userId": user_id, "dropped": subscriber.dropped})
+
+    def _parse_token(self, token: str) -> Optional[int]:
+        epoch, _, seq = token.partition("-")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq:
+            return None
+        return int(seq)
+
+    def _prune(self) -> None:
+        # Caller holds the lock. Channels outlive their last subscriber by
+        # resume_seconds so reconnects can still be replayed.
+        cutoff = self._clock() - self.resume_seconds
+        for user_id in [
+            user_id
+            for user_id, channel in self._channels.items()
+            if channel.idle_since is not None and channel.idle_since < cutoff
+        ]:
+            del self._channels[user_id]
+
+
+def aggregate_delta(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Increments one committed event applied to the user's aggregate docs."""
+
+    timestamp = _parse_timestamp(event["timestamp"])
+    return {
+        "userId": event["userId"],
+        "requestId": event.get("requestId"),
+        "day": timestamp.strftime("%Y%m%d"),
+        "month": timestamp.strftime("%Y%m"),
+        "timestamp": event["timestamp"],
+        "action": event.get("action"),
+        "inputTokens": event.get("inputTokens", 0) or 0,
+        "outputTokens": event.get("outputTokens", 0) or 0,
+        "costUsd": event.get("costUSD", 0.0) or 0.0,
+        "costTry": _resolved_cost_try(event),
+    }
+
+
+def format_sse(event: str, data: Dict[str, Any], event_id: Optional[str] = None) -> str:
+    lines = [f"event: {event}"]
+    if event_id:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {json.dumps(data, separators=(',', ':'), default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+
+DEFAULT_STREAMS = UsageStreamHub()
@@ -0,0 +1,369 @@
+import datetime as dt
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields, replace
+from typing import Any, Dict, Optional, Tuple
+
+from app.config.logger import get_logger
+from .resilience import STORAGE_GUARD, call_options
+from .rollups import DEFAULT_ROLLUP, monthly_from_daily
+from .shared_state import get_shared_state
+from .usage_tracker import _parse_timestamp
+
+LOGGER = get_logger("usage_service.throttling")
+
+DECISION_ALLOW = "allow"
+DECISION_DEGRADE = "degrade"
+DECISION_DENY = "deny"
+
+
+@dataclass(frozen=True)
+class ThrottleRule:
+    """Limits applied to a single (userId, action) pair.
+
+    A limit of 0 disables that check.
+    """
+
+    bucket_capacity: float = 60.0
+    refill_per_second: float = 1.0
+    window_seconds: int = 60
+    window_limit: int = 0
+    daily_cost_usd_limit: float = 0.0
+    monthly_cost_usd_limit: float = 0.0
+    daily_token_limit: int = 0
+    degrade_ratio: float = 0.8
+
+
+class _BucketState:
+    __slots__ = ("tokens", "refilled_at", "window_start", "window_count", "prev_window_count", "touched_at")
+
+    def __init__(self, capacity: float, now: float) -> None:
+        self.tokens = capacity
+        self.refilled_at = now
+        self.window_start = now
+        self.window_count = 0
+        self.prev_window_count = 0
+        self.touched_at = now
+
+
+class _UserTotals:
+    __slots__ = ("day", "month", "daily_cost_usd", "monthly_cost_usd", "daily_tokens", "touched_at")
+
+    def __init__(self, day: str, month: str, now: float) -> None:
+        self.day = day
+        self.month = month
+        self.daily_cost_usd = 0.0
+        self.monthly_cost_usd = 0.0
+        self.daily_tokens = 0
+        self.touched_at = now
+
+
+class ThrottleEngine:
+    """In-memory token buckets, sliding windows and quota totals.
+
+    Buckets are keyed by (userId, action); quota totals by userId. Totals are
+    seeded from usage_daily/usage_monthly on first use and kept current by
+    `observe_event` after each committed ingest. Entries idle for longer than
+    `idle_ttl_seconds` are dropped lazily and the oldest entries are evicted
+    once `max_keys` is reached.
+    """
+
+    def __init__(
+        self,
+        default_rule: Optional[ThrottleRule] = None,
+        action_rules: Optional[Dict[str, ThrottleRule]] = None,
+        max_keys: int = 100_000,
+        idle_ttl_seconds: float = 3600.0,
+        clock=time.monotonic,
+    ) -> None:
+        self._default_rule = default_rule or ThrottleRule()
+        self._action_rules = dict(action_rules or {})
+        self._max_keys = max_keys
+        self._idle_ttl = idle_ttl_seconds
+        self._clock = clock
+        self._buckets: "OrderedDict[Tuple[str, str], _BucketState]" = OrderedDict()
+        self._totals: "OrderedDict[str, _UserTotals]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def rule_for(self, action: str) -> ThrottleRule:
+        return self._action_rules.get(action, self._default_rule)
+
+    def check(
+        self,
+        user_id: str,
+        action: str,
+        *,
+        cost: float = 1.0,
+        consume: bool = True,
+        db: Any = None,
+        now: Optional[dt.datetime] = None,
+    ) -> Dict[str, Any]:
+        """Return a throttlingDecision dict for the user/action pair.
+
+        When `consume` is False the decision is evaluated without taking
+        tokens from the bucket. `db` is only used to seed quota totals the
+        first time a user is seen on a given day.
+        """
+
+        now = now or dt.datetime.now(dt.timezone.utc)
+        day_key = now.strftime("%Y%m%d")
+        month_key = now.strftime("%Y%m")
+        rule = self.rule_for(action)
+        if db is not None and self._needs_seed(rule, user_id, day_key):
+            self._seed(db, user_id, day_key, month_key)
+
+        tick = self._clock()
+        shared_totals = _shared_totals(user_id, day_key, month_key, tick)
+        with self._lock:
+            bucket = self._bucket(user_id, action, rule, tick)
+            totals = shared_totals or self._totals.get(user_id)
+            if totals is not None and totals.day != day_key:
+                totals = None
+            elif totals is not None and shared_totals is None:
+                totals.touched_at = tick
+                self._totals.move_to_end(user_id)
+            decision = _evaluate(rule, bucket, totals, cost, tick)
+            if consume and decision["decision"] != DECISION_DENY:
+                bucket.tokens -= cost
+                bucket.window_count += 1
+                decision["remaining"]["bucket"] = int(bucket.tokens)
+                if "window" in decision["remaining"]:
+                    decision["remaining"]["window"] = max(0, decision["remaining"]["window"] - 1)
+        decision["policy"] = action if action in self._action_rules else "default"
+        decision["evaluatedAt"] = now.isoformat()
+        return decision
+
+    def observe_event(self, db: Any, event: Dict[str, Any]) -> None:
+        """Commit listener: add a committed event to the cached quota totals.
+
+        Users without cached totals are skipped; they are seeded from
+        Firestore (which already includes this event) on their next check.
+        """
+
+        user_id = event.get("userId")
+        if not user_id or get_shared_state() is not None:
+            # With shared memory, update_aggregates maintains the totals.
+            return
+        day_key, month_key = _event_keys(event)
+        with self._lock:
+            totals = self._totals.get(user_id)
+            if totals is None:
+                return
+            cost_usd = float(event.get("costUSD") or 0.0)
+            tokens = int(event.get("inputTokens") or 0) + int(event.get("outputTokens") or 0)
+            if totals.month == month_key:
+                totals.monthly_cost_usd += cost_usd
+            if totals.day == day_key:
+                totals.daily_cost_usd += cost_usd
+                totals.daily_tokens += tokens
+
+    def size(self) -> Dict[str, int]:
+        with self._lock:
+            return {"buckets": len(self._buckets), "users": len(self._totals)}
+
+    def _needs_seed(self, rule: ThrottleRule, user_id: str, day_key: str) -> bool:
+        if not (rule.daily_cost_usd_limit or rule.monthly_cost_usd_limit or rule.daily_token_limit):
+            return False
+        shared = get_shared_state()
+        if shared is not None:
+            return shared.get_totals(user_id, day_key) is None
+        with self._lock:
+            totals = self._totals.get(user_id)
+            return totals is None or totals.day != day_key
+
+    def _seed(self, db: Any, user_id: str, day_key: str, month_key: str) -> None:
+        daily_ref = db.collection("usage_daily").document(f"{user_id}_{day_key}")
+        monthly_ref = db.collection("usage_monthly").document(f"{user_id}_{month_key}")
+        snapshots = STORAGE_GUARD.run(
+            "throttle_seed",
+            lambda: {snap.reference.path: snap for snap in db.get_all([daily_ref, monthly_ref], **call_options())},
+        )
+        daily = _snapshot_dict(snapshots.get(daily_ref.path))
+        monthly = _snapshot_dict(snapshots.get(monthly_ref.path))
+        if DEFAULT_ROLLUP.enabled and DEFAULT_ROLLUP.is_dirty(user_id, month_key):
+            # Derived monthly doc is behind this process's own commits.
+            monthly = monthly_from_daily(db, user_id, month_key)
+
+        tick = self._clock()
+        totals = _UserTotals(day_key, month_key, tick)
+        totals.daily_cost_usd = float(daily.get("totalCostUsd") or 0.0)
+        totals.daily_tokens = int(daily.get("totalInputTokens") or 0) + int(daily.get("totalOutputTokens") or 0)
+        totals.monthly_cost_usd = float(monthly.get("totalCostUsd") or 0.0)
+        shared = get_shared_state()
+        if shared is not None:
+            monthly_tokens = int(monthly.get("totalInputTokens") or 0) + int(monthly.get("totalOutputTokens") or 0)
+            shared.seed_totals(user_id, day_key, totals.daily_cost_usd, totals.daily_tokens)
+            shared.seed_totals(user_id, month_key, totals.monthly_cost_usd, monthly_tokens)
+            return
+        with self._lock:
+            self._totals[user_id] = totals
+            self._totals.move_to_end(user_id)
+            self._expire(self._totals, tick)
+        LOGGER.debug(
+            "Throttle totals seeded",
+            extra={"userId": user_id, "day": day_key, "dailyCostUsd": totals.daily_cost_usd},
+        )
+
+    def _bucket(self, user_id: str, action: str, rule: ThrottleRule, tick: float) -> _BucketState:
+        key = (user_id, action)
+        bucket = self._buckets.get(key)
+        if bucket is None or tick - bucket.touched_at > self._idle_ttl:
+            bucket = _BucketState(rule.bucket_capacity, tick)
+            self._buckets[key] = bucket
+            self._buckets.move_to_end(key)
+            self._expire(self._buckets, tick)
+        else:
+            self._buckets.move_to_end(key)
+        _refill(rule, bucket, tick)
+        bucket.touched_at = tick
+        return bucket
+
+    def _expire(self, entries: "OrderedDict[Any, Any]", tick: float) -> None:
+        while entries:
+            oldest = next(iter(entries.values()))
+            if len(entries) <= self._max_keys and tick - oldest.touched_at <= self._idle_ttl:
+                break
+            entries.popitem(last=False)
+
+
+def _refill(rule: ThrottleRule, bucket: _BucketState, tick: float) -> None:
+    elapsed = tick - bucket.refilled_at
+    if elapsed > 0:
+        bucket.tokens = min(rule.bucket_capacity, bucket.tokens + elapsed * rule.refill_per_second)
+        bucket.refilled_at = tick
+    window = rule.window_seconds
+    if window > 0 and tick - bucket.window_start >= window:
+        windows_passed = int((tick - bucket.window_start) // window)
+        bucket.prev_window_count = bucket.window_count if windows_passed == 1 else 0
+        bucket.window_count = 0
+        bucket.window_start += windows_passed * window
+
+
+def _evaluate(
+    rule: ThrottleRule,
+    bucket: _BucketState,
+    totals: Optional[_UserTotals],
+    cost: float,
+    tick: float,
+) -> Dict[str, Any]:
+    remaining: Dict[str, Any] = {"bucket": int(bucket.tokens)}
+    degrade_reason: Optional[str] = None
+
+    if bucket.tokens < cost:
+        retry_after = (cost - bucket.tokens) / rule.refill_per_second if rule.refill_per_second else 0.0
+        return _decision(DECISION_DENY, "rate_limited", remaining, retry_after)
+    if bucket.tokens - cost < rule.bucket_capacity * (1.0 - rule.degrade_ratio):
+        degrade_reason = "burst"
+
+    if rule.window_limit and rule.window_seconds > 0:
+        elapsed_ratio = (tick - bucket.window_start) / rule.window_seconds
+        estimated = bucket.window_count + bucket.prev_window_count * max(0.0, 1.0 - elapsed_ratio)
+        remaining["window"] = max(0, int(rule.window_limit - estimated))
+        if estimated + 1 > rule.window_limit:
+            retry_after = rule.window_seconds - (tick - bucket.window_start)
+            return _decision(DECISION_DENY, "window_limit", remaining, retry_after)
+        if estimated + 1 > rule.window_limit * rule.degrade_ratio:
+            degrade_reason = degrade_reason or "window_near_limit"
+
+    if totals is not None:
+        for limit, used, name in (
+            (rule.daily_cost_usd_limit, totals.daily_cost_usd, "dailyCostUsd"),
+            (rule.monthly_cost_usd_limit, totals.monthly_cost_usd, "monthlyCostUsd"),
+            (rule.daily_token_limit, totals.daily_tokens, "dailyTokens"),
+        ):
+            if not limit:
+                continue
+            remaining[name] = max(0.0, round(limit - used, 6))
+            if used >= limit:
+                return _decision(DECISION_DENY, f"{name}_quota", remaining, 0.0)
+            if used >= limit * rule.degrade_ratio:
+                degrade_reason = degrade_reason or f"{name}_near_quota"
+
+    if degrade_reason:
+        return _decision(DECISION_DEGRADE, degrade_reason, remaining, 0.0)
+    return _decision(DECISION_ALLOW, None, remaining, 0.0)
+
+
+def _decision(
+    decision: str,
+    reason: Optional[str],
+    remaining: Dict[str, Any],
+    retry_after_seconds: float,
+) -> Dict[str, Any]:
+    payload: Dict[str, Any] = {"decision": decision, "remaining": remaining}
+    if reason:
+        payload["reason"] = reason
+    if retry_after_seconds > 0:
+        payload["retryAfterMs"] = int(retry_after_seconds * 1000) + 1
+    return payload
+
+
+def _shared_totals(user_id: str, day_key: str, month_key: str, tick: float) -> Optional[_UserTotals]:
+    shared = get_shared_state()
+    if shared is None:
+        return None
+    daily = shared.get_totals(user_id, day_key)
+    if daily is None:
+        return None
+    monthly = shared.get_totals(user_id, month_key)
+    totals = _UserTotals(day_key, month_key, tick)
+    totals.daily_cost_usd, daily_tokens = daily
+    totals.daily_tokens = int(daily_tokens)
+    totals.monthly_cost_usd = monthly[0] if monthly is not None else 0.0
+    return totals
+
+
+def _event_keys(event: Dict[str, Any]) -> Tuple[str, str]:
+    timestamp = _parse_timestamp(event.get("timestamp") or time.time())
+    return timestamp.strftime("%Y%m%d"), timestamp.strftime("%Y%m")
+
+
+def _snapshot_dict(snapshot: Any) -> Dict[str, Any]:
+    if snapshot is None or not snapshot.exists:
+        return {}
+    return snapshot.to_dict() or {}
+
+
+def rule_from_env(prefix: str = "THROTTLE_") -> ThrottleRule:
+    """Build the default rule from THROTTLE_* environment variables."""
+
+    overrides: Dict[str, Any] = {}
+    for field in fields(ThrottleRule):
+        raw = os.getenv(f"{prefix}{field.name.upper()}")
+        if raw is None or raw == "":
+            continue
+        try:
+            overrides[field.name] = field.type(raw) if callable(field.type) else float(raw)
+        except (TypeError, ValueError):
+            LOGGER.warning("Invalid throttle setting ignored", extra={"setting": field.name, "value": raw})
+    return replace(ThrottleRule(), **overrides)
+
+
+def action_rules_from_env(default_rule: ThrottleRule) -> Dict[str, ThrottleRule]:
+    """Parse THROTTLE_ACTION_RULES, e.g. '{"generate_ppt": {"window_limit": 5}}'."""
+
+    raw = os.getenv("THROTTLE_ACTION_RULES")
+    if not raw:
+        return {}
+    try:
+        parsed = json.loads(raw)
+        return {action: replace(default_rule, **values) for action, values in parsed.items()}
+    except (ValueError, TypeError, AttributeError) as exc:
+        LOGGER.error("Invalid THROTTLE_ACTION_RULES payload: %s", exc)
+        return {}
+
+
+def build_engine_from_env() -> ThrottleEngine:
+    default_rule = rule_from_env()
+    return ThrottleEngine(
+        default_rule=default_rule,
+        action_rules=action_rules_from_env(default_rule),
+        max_keys=int(os.getenv("THROTTLE_MAX_KEYS", "100000")),
+        idle_ttl_seconds=float(os.getenv("THROTTLE_IDLE_TTL_SECONDS", "3600")),
+    )
+
+
+DEFAULT_ENGINE = build_engine_from_env()
@@ -0,0 +1,210 @@
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Mapping, Optional, Sequence, Tuple, Union
+
+# A field spec is a list of terms that are summed. Each term is a dotted
+# path or a tuple of alternative paths; the first alternative present with
+# a non-None value wins, so an explicit 0 is respected.
+Term = Union[str, Tuple[str, ...]]
+FieldSpec = Sequence[Term]
+
+USAGE_FIELDS = ("inputTokens", "outputTokens", "totalTokens", "cachedTokens", "reasoningTokens")
+
+# A compiled path is a plain key, or a tuple of keys for nested lookups.
+_Path = Union[str, Tuple[str, ...]]
+
+
+@dataclass(frozen=True)
+class UsageMapping:
+    """Declarative description of where a provider reports token usage.
+
+    `envelopes` are dotted paths to the usage object inside a full response
+    (tried in order when the payload is not already the usage object).
+    `totalTokens` falls back to input + output when no term is present.
+    A payload none of the fields match is parsed with the generic key set.
+    """
+
+    fields: Mapping[str, FieldSpec]
+    envelopes: Sequence[str] = ()
+
+
+class UsageExtractor:
+    """Token extractor compiled once from a `UsageMapping`.
+
+    The mapping is flattened into a lookup plan: single-key paths become
+    plain `dict.get` keys and only nested paths walk the payload.
+    """
+
+    def __init__(self, name: str, mapping: UsageMapping, fallback: Optional["UsageExtractor"] = None) -> None:
+        unknown = set(mapping.fields) - set(USAGE_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown usage fields for {name}: {sorted(unknown)}")
+        self.name = name
+        self.fallback = fallback
+        self._plan = tuple(
+            (field, tuple(_compile_term(term) for term in spec)) for field, spec in mapping.fields.items()
+        )
+        self._envelopes = tuple(_compile_path(path) for path in mapping.envelopes)
+        self._usage_keys = frozenset(
+            path if isinstance(path, str) else path[0]
+            for _, terms in self._plan
+            for term in terms
+            for path in term
+        )
+
+    def resolve(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the usage object: the payload itself or the first envelope found."""
+
+        if not self._usage_keys.isdisjoint(payload):
+            return payload
+        for path in self._envelopes:
+            usage = payload.get(path) if path.__class__ is str else _lookup(payload, path)
+            if isinstance(usage, dict):
+                return usage
+        return {}
+
+    def parse(self, payload: Dict[str, Any]) -> Dict[str, int]:
+        """Return inputTokens/outputTokens/totalTokens plus any cached/reasoning counts found."""
+
+        usage = self.resolve(payload)
+        parsed: Dict[str, int] = {}
+        for field, terms in self._plan:
+            total = None
+            for term in terms:
+                for path in term:
+                    value = usage.get(path) if path.__class__ is str else _lookup(usage, path)
+                    if value is not None:
+                        if value.__class__ is not int:
+                            value = _to_int(value)
+                        total = value if total is None else total + value
+                        break
+            if total is not None:
+                parsed[field] = total
+        if not parsed and self.fallback is not None:
+            # Producers that omit `provider` (or mislabel it) still send one
+            # of the other providers' shapes.
+            return self.fallback.parse(payload)
+        input_tokens = parsed.setdefault("inputTokens", 0)
+        output_tokens = parsed.setdefault("outputTokens", 0)
+        parsed.setdefault("totalTokens", input_tokens + output_tokens)
+        return parsed
+
+
+# Prompt counts include cached tokens for every provider (Anthropic reports
+# cache reads/writes separately, so they are added back); reasoning tokens
+# are part of output. Gemini reports thoughts outside candidatesTokenCount.
+GEMINI_MAPPING = UsageMapping(
+    fields={
+        "inputTokens": ["promptTokenCount"],
+        "outputTokens": ["candidatesTokenCount", "thoughtsTokenCount"],
+        "totalTokens": ["totalTokenCount"],
+        "cachedTokens": ["cachedContentTokenCount"],
+        "reasoningTokens": ["thoughtsTokenCount"],
+    },
+    envelopes=("usageMetadata", "usage_metadata"),
+)
+VERTEX_MAPPING = UsageMapping(
+    fields=GEMINI_MAPPING.fields,
+    # Batch prediction output lines wrap the GenerateContentResponse.
+    envelopes=("response.usageMetadata", "usageMetadata", "usage_metadata"),
+)
+OPENAI_MAPPING = UsageMapping(
+    fields={
+        # Chat Completions names first, Responses API names second.
+        "inputTokens": [("prompt_tokens", "input_tokens")],
+        "outputTokens": [("completion_tokens", "output_tokens")],
+        "totalTokens": ["total_tokens"],
+        "cachedTokens": [("prompt_tokens_details.cached_tokens", "input_tokens_details.cached_tokens")],
+        "reasoningTokens": [
+            ("completion_tokens_details.reasoning_tokens", "output_tokens_details.reasoning_tokens")
+        ],
+    },
+    envelopes=("usage", "response.usage"),
+)
+ANTHROPIC_MAPPING = UsageMapping(
+    fields={
+        "inputTokens": ["input_tokens", "cache_read_input_tokens", "cache_creation_input_tokens"],
+        "outputTokens": ["output_tokens"],
+        "cachedTokens": ["cache_read_input_tokens"],
+    },
+    envelopes=("usage", "message.usage"),
+)
+MISTRAL_MAPPING = UsageMapping(
+    fields={
+        "inputTokens": ["prompt_tokens"],
+        "outputTokens": ["completion_tokens"],
+        "totalTokens": ["total_tokens"],
+    },
+    envelopes=("usage",),
+)
+# Unknown providers: every key name any supported provider uses.
+GENERIC_MAPPING = UsageMapping(
+    fields={
+        "inputTokens": [("promptTokenCount", "prompt_tokens", "inputTokens", "input_tokens")],
+        "outputTokens": [
+            ("candidatesTokenCount", "completionTokenCount", "completion_tokens", "outputTokens", "output_tokens"),
+            "thoughtsTokenCount",
+        ],
+        "totalTokens": [("totalTokenCount", "total_tokens", "totalTokens")],
+        "cachedTokens": [("cachedContentTokenCount", "prompt_tokens_details.cached_tokens", "cachedTokens")],
+        "reasoningTokens": [
+            ("thoughtsTokenCount", "completion_tokens_details.reasoning_tokens", "reasoningTokens")
+        ],
+    },
+    envelopes=("usageMetadata", "usage_metadata", "usage"),
+)
+
+_REGISTRY: Dict[str, UsageExtractor] = {}
+_ALIASES: Dict[str, str] = {}
+
+
+def register_usage_parser(name: str, mapping: UsageMapping, aliases: Iterable[str] = ()) -> UsageExtractor:
+    """Compile `mapping` and register it for `name` and its aliases (case-insensitive)."""
+
+    key = name.lower()
+    extractor = UsageExtractor(name, mapping, fallback=None if key == "generic" else _REGISTRY.get("generic"))
+    _REGISTRY[key] = extractor
+    for alias in aliases:
+        _ALIASES[alias.lower()] = key
+    return extractor
+
+
+def get_usage_parser(provider: Optional[str]) -> UsageExtractor:
+    key = (provider or "").lower()
+    return _REGISTRY.get(_ALIASES.get(key, key)) or _REGISTRY["generic"]
+
+
+def parse_usage(provider: Optional[str], payload: Dict[str, Any]) -> Dict[str, int]:
+    return get_usage_parser(provider).parse(payload)
+
+
+def _compile_term(term: Term) -> Tuple[_Path, ...]:
+    paths = (term,) if isinstance(term, str) else term
+    return tuple(_compile_path(path) for path in paths)
+
+
+def _compile_path(path: str) -> _Path:
+    keys = tuple(path.split("."))
+    return keys[0] if len(keys) == 1 else keys
+
+
+def _lookup(payload: Any, keys: Tuple[str, ...]) -> Any:
+    for key in keys:
+        if not isinstance(payload, dict):
+            return None
+        payload = payload.get(key)
+    return payload
+
+
+def _to_int(value: Any) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+register_usage_parser("generic", GENERIC_MAPPING)
+register_usage_parser("gemini", GEMINI_MAPPING, aliases=("google", "google-ai", "gemini-api"))
+register_usage_parser("vertex", VERTEX_MAPPING, aliases=("vertex_ai", "vertexai", "vertex-batch", "vertex_batch"))
+register_usage_parser("openai", OPENAI_MAPPING, aliases=("azure", "azure_openai", "azure-openai"))
+register_usage_parser("anthropic", ANTHROPIC_MAPPING, aliases=("claude",))
+register_usage_parser("mistral", MISTRAL_MAPPING, aliases=("mistralai",))
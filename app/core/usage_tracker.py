@@ -1,26 +1,95 @@
+from __future__ import annotations
+
 import datetime as dt
 import os
 from concurrent.futures import ThreadPoolExecutor
-from typing import Any, Dict, Optional
-
-from google.cloud import firestore
+from typing import Any, Callable, Dict, List, Optional
 
 from app.config.logger import get_logger
-from .dedup import acquire_request_lock
+from app.utils.lazy import lazy_import
+from .actions import (
+    ACTION_OVERFLOW,
+    ACTIONS_SUBCOLLECTION,
+    DEFAULT_ACTION_POLICY,
+    OTHER_ACTION,
+    existing_actions,
+    observe_doc_size,
+    spill_doc_id,
+)
+from .dedup import claim_request, record_lock_result
+from .event_codec import decode_event, encode_event
+from .resilience import STORAGE_GUARD, call_options
+from .sampling import DEFAULT_SAMPLER
+from .shared_state import get_shared_state
+from .static_fields import (
+    DEFAULT_STATIC_FIELD_CACHE,
+    STATIC_FIELD_CACHE_ENABLED,
+    static_fingerprint,
+    strip_static_fields,
+)
 
 DEFAULT_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+firestore = lazy_import("google.cloud.firestore")
 LOGGER = get_logger("usage_service.usage_tracking")
 DEBUG_LOGS = os.getenv("USAGE_TRACKING_DEBUG", "").lower() in ("1", "true", "yes", "on")
 WRITE_RAW_EVENTS = os.getenv("WRITE_RAW_EVENTS", "").lower() in ("1", "true", "yes", "on")
+RAW_EVENT_ENCODING = os.getenv("RAW_EVENT_ENCODING", "full").lower()
+# "inline": every event also updates usage_monthly in the ingest transaction.
+# "derived": only daily docs are written; app.core.rollups rebuilds monthly.
+MONTHLY_AGGREGATE_MODE = os.getenv("AGGREGATE_MONTHLY_MODE", "inline").lower()
+WRITE_HOURLY_AGGREGATES = os.getenv("WRITE_HOURLY_AGGREGATES", "").lower() in ("1", "true", "yes", "on")
+
+# Extra rollup maps written next to `actions`, keyed by event field.
+ROLLUP_DIMENSION_FIELDS = {
+    "model": "models",
+    "provider": "providers",
+    "endpoint": "endpoints",
+    "status": "statuses",
+}
+ROLLUP_DIMENSIONS = tuple(
+    dim
+    for dim in (part.strip() for part in os.getenv("AGGREGATE_ROLLUP_DIMENSIONS", "").split(","))
+    if dim in ROLLUP_DIMENSION_FIELDS
+)
+
+CommitListener = Callable[[Any, Dict[str, Any]], None]
+_COMMIT_LISTENERS: List[CommitListener] = []
+
+
+def add_commit_listener(listener: CommitListener) -> None:
+    """Register a callback run after aggregates for a new requestId commit.
+
+    Listeners receive (db, event) and must be cheap; exceptions are logged
+    and never fail the ingest.
+    """
+
+    if listener not in _COMMIT_LISTENERS:
+        _COMMIT_LISTENERS.append(listener)
+
 
+def remove_commit_listener(listener: CommitListener) -> None:
+    if listener in _COMMIT_LISTENERS:
+        _COMMIT_LISTENERS.remove(listener)
 
-def log_event(db: firestore.Client, event: Dict[str, Any]) -> None:
-    """Write a raw usage event document.
+
+def log_event(db: firestore.Client, event: Dict[str, Any]) -> bool:
+    """Write a raw usage event document if the tail sampler keeps it.
 
     Firestore path: usage_events/{eventId}
+
+    Stored events carry `samplingWeight` and `samplingReason` (see
+    `app.core.sampling`). Returns False when the event was sampled out.
+
+    With RAW_EVENT_ENCODING=compact only userId/timestamp/action/model stay
+    top-level; the rest is a compressed blob (see `app.core.event_codec`).
     """
 
     event_id = event.get("eventId") or event["requestId"]
+    sampled = DEFAULT_SAMPLER.apply(event)
+    if sampled is None:
+        LOGGER.debug("UsageTracking log_event sampled out", extra={"eventId": event_id})
+        return False
+    event = sampled
     LOGGER.info(
         "UsageTracking log_event start",
         extra={
@@ -31,7 +100,8 @@ def log_event(db: firestore.Client, event: Dict[str, Any]) -> None:
         },
     )
     doc_ref = db.collection("usage_events").document(event_id)
-    payload = dict(event)
+    compact = RAW_EVENT_ENCODING == "compact"
+    payload = encode_event(event) if compact else dict(event)
     payload.setdefault("loggedAt", firestore.SERVER_TIMESTAMP)
     if DEBUG_LOGS:
         LOGGER.info(
@@ -42,16 +112,31 @@ def log_event(db: firestore.Client, event: Dict[str, Any]) -> None:
                 "payload": payload,
             },
         )
-    doc_ref.set(payload, merge=True)
+    # A compact doc replaces the whole document so no stale full-format
+    # fields survive next to the blob.
+    STORAGE_GUARD.run("raw_event", doc_ref.set, payload, merge=not compact, **call_options())
     LOGGER.info(
         "UsageTracking log_event done",
-        extra={"eventId": event_id, "userId": event.get("userId")},
+        extra={"eventId": event_id, "userId": event.get("userId"), "samplingReason": event["samplingReason"]},
     )
+    return True
+
+
+def read_event(db: firestore.Client, event_id: str) -> Optional[Dict[str, Any]]:
+    """Return usage_events/{eventId} decoded to the full event, or None."""
+
+    snapshot = STORAGE_GUARD.run("read_event", db.collection("usage_events").document(event_id).get, **call_options())
+    if not snapshot.exists:
+        return None
+    return decode_event(snapshot.to_dict() or {})
 
 
 def update_aggregates(db: firestore.Client, event: Dict[str, Any]) -> bool:
     """Update daily and monthly aggregates if requestId is new.
 
+    In derived monthly mode only the daily (and hourly) docs are written;
+    the monthly doc is rebuilt by the rollup scheduler after commit.
+
     Returns:
         True if aggregates were updated.
         False if requestId already existed (idempotent skip).
@@ -62,6 +147,7 @@ def update_aggregates(db: firestore.Client, event: Dict[str, Any]) -> bool:
     timestamp = _parse_timestamp(event["timestamp"])
     day_key = timestamp.strftime("%Y%m%d")
     month_key = timestamp.strftime("%Y%m")
+    hour_key = timestamp.strftime("%Y%m%d%H")
 
     LOGGER.info(
         "UsageTracking update_aggregates start",
@@ -77,36 +163,74 @@ def update_aggregates(db: firestore.Client, event: Dict[str, Any]) -> bool:
             "costTRY": event.get("costTRY"),
         },
     )
-    if not acquire_request_lock(
-        db,
-        request_id,
-        {
-            "userId": user_id,
-            "endpoint": event.get("endpoint"),
-            "createdAt": firestore.SERVER_TIMESTAMP,
-        },
-    ):
+    shared = get_shared_state()
+    if shared is not None and shared.is_recent_request(request_id):
+        # Another worker in this container already committed this requestId.
         if DEBUG_LOGS:
             LOGGER.info(
-                "UsageTracking dedup skip (requestId already exists)",
+                "UsageTracking dedup skip (shared recent requestId)",
                 extra={"requestId": request_id, "userId": user_id},
             )
         return False
+    lock_metadata = {
+        "userId": user_id,
+        "endpoint": event.get("endpoint"),
+        "createdAt": firestore.SERVER_TIMESTAMP,
+    }
 
     daily_ref = db.collection("usage_daily").document(f"{user_id}_{day_key}")
-    monthly_ref = db.collection("usage_monthly").document(f"{user_id}_{month_key}")
+    monthly_ref = (
+        db.collection("usage_monthly").document(f"{user_id}_{month_key}")
+        if MONTHLY_AGGREGATE_MODE != "derived"
+        else None
+    )
+    hourly_ref = (
+        db.collection("usage_hourly").document(f"{user_id}_{hour_key}") if WRITE_HOURLY_AGGREGATES else None
+    )
+
+    # Static-field fingerprints to record once the transaction commits.
+    written_fingerprints: Dict[str, str] = {}
 
+    # The dedup doc is written in the aggregate transaction: a failed commit
+    # leaves neither, so a spilled or retried event is applied exactly once.
     @firestore.transactional
-    def _txn(transaction: firestore.Transaction) -> None:
-        daily_snapshot = daily_ref.get(transaction=transaction)
-        monthly_snapshot = monthly_ref.get(transaction=transaction)
-
-        daily_update = _build_aggregate_update(event, daily_snapshot, day_key=day_key)
-        monthly_update = _build_aggregate_update(
-            event,
-            monthly_snapshot,
-            month_key=month_key,
-            is_monthly=True,
+    def _txn(transaction: firestore.Transaction) -> bool:
+        written_fingerprints.clear()
+        write_lock = claim_request(transaction, db, request_id, lock_metadata, bucket=day_key)
+        if write_lock is None:
+            return False
+        options = call_options()
+        daily_snapshot = daily_ref.get(transaction=transaction, **options)
+        monthly_snapshot = monthly_ref.get(transaction=transaction, **options) if monthly_ref is not None else None
+        observe_doc_size("usage_daily", daily_snapshot)
+        observe_doc_size("usage_monthly", monthly_snapshot)
+        # Hourly docs follow the daily decision (their actions are a subset of the day's).
+        daily_action = _action_key(event, daily_snapshot, "usage_daily")
+        monthly_action = _action_key(event, monthly_snapshot, "usage_monthly") if monthly_ref is not None else None
+
+        daily_update = _elide_static_fields(
+            daily_ref.path,
+            _build_aggregate_update(event, daily_snapshot, day_key=day_key, action_key=daily_action),
+            event.get("plan"),
+            daily_snapshot,
+            written_fingerprints,
+        )
+        monthly_update = (
+            _elide_static_fields(
+                monthly_ref.path,
+                _build_aggregate_update(
+                    event,
+                    monthly_snapshot,
+                    month_key=month_key,
+                    is_monthly=True,
+                    action_key=monthly_action,
+                ),
+                event.get("plan"),
+                monthly_snapshot,
+                written_fingerprints,
+            )
+            if monthly_ref is not None
+            else None
         )
 
         if DEBUG_LOGS:
@@ -118,15 +242,47 @@ def update_aggregates(db: firestore.Client, event: Dict[str, Any]) -> bool:
                     "day": day_key,
                     "month": month_key,
                     "daily_exists": daily_snapshot.exists,
-                    "monthly_exists": monthly_snapshot.exists,
+                    "monthly_exists": monthly_snapshot.exists if monthly_snapshot is not None else None,
                 },
             )
 
+        write_lock()
         transaction.set(daily_ref, daily_update, merge=True)
-        transaction.set(monthly_ref, monthly_update, merge=True)
+        _spill_action(transaction, daily_ref, event, daily_action)
+        if monthly_ref is not None:
+            transaction.set(monthly_ref, monthly_update, merge=True)
+            _spill_action(transaction, monthly_ref, event, monthly_action)
+        if hourly_ref is not None:
+            hourly_update = _elide_static_fields(
+                hourly_ref.path,
+                _build_aggregate_update(event, None, hour_key=hour_key, action_key=daily_action),
+                None,
+                None,
+                written_fingerprints,
+            )
+            transaction.set(hourly_ref, hourly_update, merge=True)
+        return True
 
     transaction = db.transaction()
-    _txn(transaction)
+    applied = STORAGE_GUARD.run("aggregates", _txn, transaction)
+    record_lock_result(request_id, applied)
+    if not applied:
+        if shared is not None:
+            shared.mark_request(request_id)
+        if DEBUG_LOGS:
+            LOGGER.info(
+                "UsageTracking dedup skip (requestId already exists)",
+                extra={"requestId": request_id, "userId": user_id},
+            )
+        return False
+    for doc_path, fingerprint in written_fingerprints.items():
+        DEFAULT_STATIC_FIELD_CACHE.record(doc_path, fingerprint)
+    if shared is not None:
+        shared.mark_request(request_id)
+        cost_usd = float(event.get("costUSD") or 0.0)
+        tokens = float((event.get("inputTokens") or 0) + (event.get("outputTokens") or 0))
+        shared.add_totals(user_id, day_key, cost_usd, tokens)
+        shared.add_totals(user_id, month_key, cost_usd, tokens)
     LOGGER.info(
         "UsageTracking aggregate updates committed",
         extra={
@@ -136,6 +292,7 @@ def update_aggregates(db: firestore.Client, event: Dict[str, Any]) -> bool:
             "month": month_key,
         },
     )
+    _notify_commit_listeners(db, event)
     return True
 
 
@@ -181,13 +338,37 @@ def enqueue_usage_update(db: firestore.Client, event: Dict[str, Any]) -> None:
     DEFAULT_EXECUTOR.submit(_work)
 
 
+def _notify_commit_listeners(db: firestore.Client, event: Dict[str, Any]) -> None:
+    for listener in list(_COMMIT_LISTENERS):
+        try:
+            listener(db, event)
+        except Exception as exc:  # noqa: BLE001
+            LOGGER.warning(
+                "UsageTracking commit listener failed",
+                extra={
+                    "requestId": event.get("requestId"),
+                    "listener": getattr(listener, "__qualname__", repr(listener)),
+                    "error": str(exc),
+                },
+                exc_info=DEBUG_LOGS,
+            )
+
+
 def _build_aggregate_update(
     event: Dict[str, Any],
-    snapshot: firestore.DocumentSnapshot,
+    snapshot: Optional[firestore.DocumentSnapshot],
     day_key: Optional[str] = None,
     month_key: Optional[str] = None,
     is_monthly: bool = False,
+    hour_key: Optional[str] = None,
+    action_key: Optional[str] = None,
 ) -> Dict[str, Any]:
+    """Merge payload for one aggregate doc.
+
+    `action_key` is the `actions` entry to increment (the action itself or
+    `_other`); by default it is decided from `snapshot`.
+    """
+
     now = firestore.SERVER_TIMESTAMP
     update: Dict[str, Any] = {
         "userId": event["userId"],
@@ -195,18 +376,17 @@ def _build_aggregate_update(
         "updatedAt": now,
     }
 
-    if is_monthly:
+    if hour_key:
+        update["hour"] = hour_key
+    elif is_monthly:
         update["month"] = month_key
     else:
         update["day"] = day_key
 
     input_tokens = event.get("inputTokens", 0) or 0
     output_tokens = event.get("outputTokens", 0) or 0
-    cost_try = event.get("costTRY")
-    cost_local = (event.get("cost") or {}).get("amount", 0.0) or 0.0
     cost_usd = event.get("costUSD", 0.0) or 0.0
-    currency = (event.get("cost") or {}).get("currency")
-    resolved_cost_try = cost_try if cost_try is not None else (cost_local if currency == "TRY" else 0.0)
+    resolved_cost_try = _resolved_cost_try(event)
 
     update.update(
         {
@@ -224,6 +404,7 @@ def _build_aggregate_update(
             "userId": event.get("userId"),
             "day": day_key,
             "month": month_key,
+            "hour": hour_key,
             "inputTokens": input_tokens,
             "outputTokens": output_tokens,
             "costTRY": resolved_cost_try,
@@ -233,21 +414,121 @@ def _build_aggregate_update(
 
     action = event.get("action")
     if action:
-        action_update = {
-            "tokensIn": firestore.Increment(input_tokens),
-            "tokensOut": firestore.Increment(output_tokens),
-            "costTry": firestore.Increment(resolved_cost_try),
-            "costUsd": firestore.Increment(cost_usd),
-        }
-        update.setdefault("actions", {}).setdefault(action, {}).update(action_update)
+        action_key = action_key or DEFAULT_ACTION_POLICY.inline_key(str(action), existing_actions(snapshot))
+        action_update = _breakdown_increments(input_tokens, output_tokens, resolved_cost_try, cost_usd)
+        update.setdefault("actions", {}).setdefault(action_key, {}).update(action_update)
+
+    for dimension in ROLLUP_DIMENSIONS:
+        value = event.get(dimension)
+        if not value:
+            continue
+        dimension_update = _breakdown_increments(input_tokens, output_tokens, resolved_cost_try, cost_usd)
+        update.setdefault(ROLLUP_DIMENSION_FIELDS[dimension], {})[str(value)] = dimension_update
 
     plan_snapshot = event.get("plan")
-    if plan_snapshot:
+    if plan_snapshot and not hour_key and not _snapshot_field_equals(snapshot, "planSnapshot", plan_snapshot):
         update["planSnapshot"] = plan_snapshot
 
     return update
 
 
+def _action_key(event: Dict[str, Any], snapshot: Optional[firestore.DocumentSnapshot], collection: str) -> Optional[str]:
+    action = event.get("action")
+    if not action:
+        return None
+    key = DEFAULT_ACTION_POLICY.inline_key(str(action), existing_actions(snapshot))
+    if key == OTHER_ACTION:
+        reason = "cap" if DEFAULT_ACTION_POLICY.is_allowed(str(action)) else "not_allowed"
+        ACTION_OVERFLOW.inc(collection=collection, reason=reason)
+    return key
+
+
+def _spill_action(
+    transaction: firestore.Transaction,
+    doc_ref: Any,
+    event: Dict[str, Any],
+    action_key: Optional[str],
+) -> None:
+    """With AGGREGATE_ACTIONS_SPILL, keep the breakdown of a folded action in the doc's subcollection."""
+
+    action = event.get("action")
+    if action_key != OTHER_ACTION or not DEFAULT_ACTION_POLICY.spill or not action:
+        return
+    spill = _breakdown_increments(
+        event.get("inputTokens", 0) or 0,
+        event.get("outputTokens", 0) or 0,
+        _resolved_cost_try(event),
+        event.get("costUSD", 0.0) or 0.0,
+    )
+    spill.update({"action": str(action), "updatedAt": firestore.SERVER_TIMESTAMP})
+    transaction.set(doc_ref.collection(ACTIONS_SUBCOLLECTION).document(spill_doc_id(str(action))), spill, merge=True)
+
+
+def _resolved_cost_try(event: Dict[str, Any]) -> float:
+    """TRY amount the aggregates count for an event: costTRY, else a TRY-denominated cost."""
+
+    cost_try = event.get("costTRY")
+    if cost_try is not None:
+        return cost_try
+    cost = event.get("cost") or {}
+    return (cost.get("amount", 0.0) or 0.0) if cost.get("currency") == "TRY" else 0.0
+
+
+def _elide_static_fields(
+    doc_path: str,
+    update: Dict[str, Any],
+    plan_snapshot: Optional[Dict[str, Any]],
+    snapshot: Optional[firestore.DocumentSnapshot],
+    written_fingerprints: Dict[str, str],
+) -> Dict[str, Any]:
+    """Drop userId/period/planSnapshot if this process already wrote the same values.
+
+    The doc read in the transaction wins over the cache: if it holds another
+    planSnapshot (written by another worker), the cache entry is stale.
+    """
+
+    if not STATIC_FIELD_CACHE_ENABLED:
+        return update
+    fingerprint = static_fingerprint(update, plan_snapshot)
+    doc_missing = snapshot is not None and not snapshot.exists
+    plan_changed = (
+        plan_snapshot is not None
+        and snapshot is not None
+        and not _snapshot_field_equals(snapshot, "planSnapshot", plan_snapshot)
+    )
+    if plan_changed:
+        DEFAULT_STATIC_FIELD_CACHE.forget(doc_path)
+    if doc_missing or plan_changed or DEFAULT_STATIC_FIELD_CACHE.needs_write(doc_path, fingerprint):
+        written_fingerprints[doc_path] = fingerprint
+        return update
+    return strip_static_fields(update)
+
+
+def _snapshot_field_equals(
+    snapshot: Optional[firestore.DocumentSnapshot],
+    field: str,
+    value: Any,
+) -> bool:
+    if snapshot is None or not snapshot.exists:
+        return False
+    return (snapshot.to_dict() or {}).get(field) == value
+
+
+def _breakdown_increments(
+    input_tokens: int,
+    output_tokens: int,
+    cost_try: float,
+    cost_usd: float,
+) -> Dict[str, Any]:
+    return {
+        "tokensIn": firestore.Increment(input_tokens),
+        "tokensOut": firestore.Increment(output_tokens),
+        "costTry": firestore.Increment(cost_try),
+        "costUsd": firestore.Increment(cost_usd),
+        "count": firestore.Increment(1),
+    }
+
+
 def _parse_timestamp(value: Any) -> dt.datetime:
     if isinstance(value, dt.datetime):
         return value
@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import os
+from typing import Any, Dict, Optional
+
+from app.config.logger import get_logger
+from app.utils.cache import TtlCache
+from app.utils.lazy import lazy_import
+from .resilience import STORAGE_GUARD, call_options
+from .revenuecat_mapper import plan_is_premium
+
+firestore = lazy_import("google.cloud.firestore")
+LOGGER = get_logger("usage_service.user_plans")
+
+USER_PLANS_COLLECTION = "user_plans"
+
+_PLAN_CACHE: TtlCache[Dict[str, Any]] = TtlCache(
+    max_entries=int(os.getenv("USER_PLAN_CACHE_SIZE", "50000")),
+    ttl_seconds=float(os.getenv("USER_PLAN_CACHE_TTL_SECONDS", "300")),
+)
+
+
+def get_user_plan(db: firestore.Client, user_id: str) -> Optional[Dict[str, Any]]:
+    """Return the stored plan for a user through the in-process cache.
+
+    `isPremium` is re-evaluated against `expiresAt` on each call; the stored
+    value is only what it was when the webhook arrived.
+    """
+
+    def _load() -> Optional[Dict[str, Any]]:
+        doc_ref = db.collection(USER_PLANS_COLLECTION).document(user_id)
+        snapshot = STORAGE_GUARD.run("user_plan", doc_ref.get, **call_options())
+        if not snapshot.exists:
+            return None
+        return (snapshot.to_dict() or {}).get("plan")
+
+    plan = _PLAN_CACHE.get_or_load(user_id, _load)
+    if plan is None:
+        return None
+    is_premium = plan_is_premium(plan)
+    return plan if plan.get("isPremium") == is_premium else {**plan, "isPremium": is_premium}
+
+
+def store_user_plan(db: firestore.Client, user_id: str, plan: Dict[str, Any]) -> bool:
+    """Write user_plans/{userId} unless a newer RevenueCat event is already stored.
+
+    Returns:
+        True if the plan was written.
+        False if the stored plan is from a later event (out-of-order webhook).
+    """
+
+    doc_ref = db.collection(USER_PLANS_COLLECTION).document(user_id)
+    event_at = plan.get("lastRevenueCatEventAt")
+
+    @firestore.transactional
+    def _txn(transaction: firestore.Transaction) -> bool:
+        snapshot = doc_ref.get(transaction=transaction)
+        if snapshot.exists and event_at is not None:
+            stored_at = ((snapshot.to_dict() or {}).get("plan") or {}).get("lastRevenueCatEventAt")
+            if stored_at is not None and stored_at > event_at:
+                return False
+        transaction.set(
+            doc_ref,
+            {"userId": user_id, "plan": plan, "updatedAt": firestore.SERVER_TIMESTAMP},
+        )
+        return True
+
+    written = _txn(db.transaction())
+    if written:
+        _PLAN_CACHE.set(user_id, plan)
+    LOGGER.info(
+        "User plan store result",
+        extra={"userId": user_id, "written": written, "eventAt": event_at},
+    )
+    return written
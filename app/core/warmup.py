@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from app.config.logger import get_logger
+
+LOGGER = get_logger("usage_service.warmup")
+
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes", "on")
+WARMUP_FIRESTORE_PING = os.getenv("WARMUP_FIRESTORE_PING", "true").lower() in ("1", "true", "yes", "on")
+
+
+class Readiness:
+    """Tracks whether startup warmup finished; backs the /ready probe."""
+
+    def __init__(self) -> None:
+        self._ready = threading.Event()
+        self.error: Optional[str] = None
+        self.timings_ms: Dict[str, float] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def mark_ready(self) -> None:
+        self._ready.set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def status(self) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {"ready": self.ready, "timingsMs": dict(self.timings_ms)}
+        if self.error:
+            payload["error"] = self.error
+        return payload
+
+
+READINESS = Readiness()
+
+
+def run_warmup(readiness: Readiness = READINESS) -> None:
+    """Pay cold-start costs before traffic arrives.
+
+    Imports the Firestore SDK, builds one client per partition, opens each
+    channel (fetching a credential token) with a single document read, and
+    primes the pricing and FX caches. Failures are recorded and retried in the
+    background; the service stays not-ready until a pass succeeds.
+    """
+
+    from app.db.partitions import get_partition_router
+    from .event_builder import _FX_CACHE
+    from .pricing import calculate_cost_usd
+
+    steps = (
+        ("firestoreClient", lambda: get_partition_router().clients()),
+        ("firestoreChannel", lambda: get_partition_router().fan_out(lambda _name, db: _ping_firestore(db))),
+        ("pricing", lambda: calculate_cost_usd("gemini-2.5-flash", 1, 1)),
+        ("fx", lambda: _FX_CACHE.get_or_fetch("USD", "TRY")),
+    )
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            for name, step in steps:
+                started = time.perf_counter()
+                step()
+                readiness.timings_ms[name] = round((time.perf_counter() - started) * 1000, 2)
+        except Exception as exc:  # noqa: BLE001
+            readiness.error = f"{type(exc).__name__}: {exc}"
+            LOGGER.warning("Warmup attempt failed", extra={"attempt": attempt, "error": readiness.error})
+            time.sleep(min(30.0, 2.0 ** attempt))
+            continue
+        readiness.error = None
+        readiness.mark_ready()
+        LOGGER.info("Warmup finished", extra={"timingsMs": readiness.timings_ms, "attempt": attempt})
+        return
+
+
+def start_warmup(readiness: Readiness = READINESS) -> None:
+    """Run warmup in a daemon thread so the server starts listening at once."""
+
+    if not WARMUP_ENABLED:
+        readiness.mark_ready()
+        return
+    threading.Thread(target=run_warmup, args=(readiness,), name="usage-warmup", daemon=True).start()
+
+
+def _ping_firestore(db: Any) -> None:
+    if not WARMUP_FIRESTORE_PING:
+        return
+    # Any RPC opens the gRPC channel and fetches an access token; a missing
+    # doc costs a single read.
+    db.collection("request_dedup").document("_warmup").get()
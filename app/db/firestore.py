@@ -1,22 +1,55 @@
 import base64
 import json
 import os
-from typing import Optional
-
-from google.cloud import firestore
-from google.oauth2 import service_account
+import threading
+from typing import TYPE_CHECKING, Any, Optional
 
 from app.config.logger import get_logger
+from app.utils.lazy import lazy_import
+
+if TYPE_CHECKING:
+    from google.cloud.firestore import Client as FirestoreClient
+else:
+    # Route signatures are evaluated by FastAPI at import time; keep them
+    # from pulling in google.cloud.firestore before warmup.
+    FirestoreClient = Any
 
+firestore = lazy_import("google.cloud.firestore")
 LOGGER = get_logger("usage_service.firestore")
 
+_CLIENT: Optional["FirestoreClient"] = None
+_CLIENT_LOCK = threading.Lock()
+
+
+def get_firestore_client() -> "FirestoreClient":
+    """Return the process-wide Firestore client, building it on first use.
+
+    The client (and its gRPC channel and credentials) is reused across
+    requests; `app.core.warmup` builds it before the service reports ready.
+    """
+
+    global _CLIENT
+    if _CLIENT is not None:
+        return _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = build_firestore_client()
+    return _CLIENT
+
+
+def build_firestore_client(project: Optional[str] = None, database: Optional[str] = None) -> "FirestoreClient":
+    """Build a new client; `project`/`database` override the credential defaults.
+
+    Used directly for partition clients (`app.db.partitions`); everything
+    else should share `get_firestore_client()`.
+    """
 
-def get_firestore_client() -> firestore.Client:
-    LOGGER.info("Firestore client initialization started")
+    LOGGER.info("Firestore client initialization started", extra={"project": project, "database": database})
+    kwargs = {"database": database} if database else {}
     service_account_base64 = os.getenv("FIREBASE_SERVICE_ACCOUNT_BASE64")
     if not service_account_base64:
         LOGGER.info("FIREBASE_SERVICE_ACCOUNT_BASE64 not set; using default credentials")
-        return firestore.Client()
+        return firestore.Client(project=project, **kwargs)
 
     try:
         decoded_json = base64.b64decode(service_account_base64).decode("utf-8")
@@ -25,7 +58,8 @@ def get_firestore_client() -> firestore.Client:
         LOGGER.error("Invalid FIREBASE_SERVICE_ACCOUNT_BASE64 payload: %s", exc)
         raise
 
+    service_account = lazy_import("google.oauth2.service_account")
     credentials = service_account.Credentials.from_service_account_info(payload)
-    project_id: Optional[str] = payload.get("project_id")
+    project_id: Optional[str] = project or payload.get("project_id")
     LOGGER.info("Firestore client initialized with explicit credentials")
-    return firestore.Client(credentials=credentials, project=project_id)
+    return firestore.Client(credentials=credentials, project=project_id, **kwargs)
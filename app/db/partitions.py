@@ -0,0 +1,226 @@
+import bisect
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, TypeVar
+
+from app.config.logger import get_logger
+from app.db.firestore import FirestoreClient, build_firestore_client, get_firestore_client
+
+LOGGER = get_logger("usage_service.partitions")
+
+PARTITION_VNODES = int(os.getenv("FIRESTORE_PARTITION_VNODES", "128"))
+PARTITION_FANOUT_WORKERS = int(os.getenv("FIRESTORE_PARTITION_FANOUT_WORKERS", "8"))
+
+# Collections whose docs belong to one user and therefore live on that
+# user's partition. Everything else (leaderboard, cardinality, latency
+# sketches) is global and stays on the primary partition.
+USER_SCOPED_COLLECTIONS = (
+    "usage_daily",
+    "usage_monthly",
+    "usage_hourly",
+    "usage_events",
+    "request_dedup",
+    "user_plans",
+    "user_credits",
+    "user_orgs",
+)
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class Partition:
+    name: str
+    project: Optional[str] = None
+    database: Optional[str] = None
+    weight: int = 1
+
+
+def partitions_from_env(raw: Optional[str] = None) -> List[Partition]:
+    """Parse `FIRESTORE_PARTITIONS`.
+
+    A JSON list of `{"name", "project", "database", "weight"}` objects; the
+    first entry is the primary partition. Unset means a single partition
+    backed by the default client.
+    """
+
+    raw = os.getenv("FIRESTORE_PARTITIONS", "") if raw is None else raw
+    if not raw.strip():
+        return [Partition(name="default")]
+    try:
+        entries = json.loads(raw)
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"Invalid FIRESTORE_PARTITIONS: {exc}") from exc
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("FIRESTORE_PARTITIONS must be a non-empty JSON list")
+    partitions = [
+        Partition(
+            name=str(entry["name"]),
+            project=entry.get("project"),
+            database=entry.get("database"),
+            weight=max(1, int(entry.get("weight", 1))),
+        )
+        for entry in entries
+    ]
+    names = [partition.name for partition in partitions]
+    if len(set(names)) != len(names):
+        raise ValueError("FIRESTORE_PARTITIONS names must be unique")
+    return partitions
+
+
+class HashRing:
+    """Consistent-hash ring with `vnodes * weight` points per partition.
+
+    Adding or removing one of N partitions moves roughly 1/N of the users;
+    the rest keep their owner, which is what makes rebalancing cheap.
+    """
+
+    def __init__(self, names: Iterable[Tuple[str, int]], vnodes: int = PARTITION_VNODES) -> None:
+        points = []
+        for name, weight in names:
+            for replica in range(vnodes * weight):
+                points.append((_hash(f"{name}#{replica}"), name))
+        if not points:
+            raise ValueError("HashRing needs at least one partition")
+        points.sort()
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def owner(self, key: str) -> str:
+        index = bisect.bisect(self._hashes, _hash(key))
+        return self._names[index % len(self._names)]
+
+
+class PartitionRouter:
+    """Routes per-user Firestore work to one of N databases/projects.
+
+    Dedup locks, aggregates, raw events and plans for a user always resolve
+    to the same partition; global docs use `primary()`. Clients are built
+    lazily, one per partition.
+    """
+
+    def __init__(self, partitions: Sequence[Partition], vnodes: int = PARTITION_VNODES) -> None:
+        self.partitions = list(partitions)
+        self._by_name = {partition.name: partition for partition in self.partitions}
+        self._ring = HashRing(((p.name, p.weight) for p in self.partitions), vnodes)
+        self._clients: Dict[str, FirestoreClient] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def primary_name(self) -> str:
+        return self.partitions[0].name
+
+    def partition(self, name: str) -> Partition:
+        return self._by_name[name]
+
+    def is_partitioned(self) -> bool:
+        return len(self.partitions) > 1
+
+    def partition_for_user(self, user_id: str) -> str:
+        if not self.is_partitioned():
+            return self.primary_name
+        return self._ring.owner(user_id)
+
+    def client_for_user(self, user_id: str) -> FirestoreClient:
+        return self.client(self.partition_for_user(user_id))
+
+    def primary(self) -> FirestoreClient:
+        return self.client(self.primary_name)
+
+    def client(self, name: str) -> FirestoreClient:
+        client = self._clients.get(name)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._clients.get(name)
+            if client is None:
+                client = self._build_client(self.partition(name))
+                self._clients[name] = client
+        return client
+
+    def clients(self) -> List[Tuple[str, FirestoreClient]]:
+        return [(partition.name, self.client(partition.name)) for partition in self.partitions]
+
+    def fan_out(self, fn: Callable[[str, FirestoreClient], T]) -> Dict[str, T]:
+        """Run `fn(partition_name, client)` against every partition in parallel.
+
+        Returns results keyed by partition name; the first exception is
+        re-raised after all calls finish.
+        """
+
+        clients = self.clients()
+        if len(clients) == 1:
+            name, client = clients[0]
+            return {name: fn(name, client)}
+        with ThreadPoolExecutor(max_workers=min(PARTITION_FANOUT_WORKERS, len(clients))) as pool:
+            futures = {name: pool.submit(fn, name, client) for name, client in clients}
+        return {name: future.result() for name, future in futures.items()}
+
+    def get_user_docs(self, collection: str, keys: Iterable[Tuple[str, str]]) -> Dict[str, Any]:
+        """Batch-read `(user_id, doc_id)` pairs, one `get_all` per partition in parallel.
+
+        Returns snapshots keyed by doc ID.
+        """
+
+        grouped: Dict[str, List[str]] = {}
+        for user_id, doc_id in keys:
+            grouped.setdefault(self.partition_for_user(user_id), []).append(doc_id)
+        if not grouped:
+            return {}
+
+        def _read(name: str) -> Dict[str, Any]:
+            db = self.client(name)
+            refs = [db.collection(collection).document(doc_id) for doc_id in grouped[name]]
+            return {snapshot.id: snapshot for snapshot in db.get_all(refs)}
+
+        with ThreadPoolExecutor(max_workers=min(PARTITION_FANOUT_WORKERS, len(grouped))) as pool:
+            results = list(pool.map(_read, grouped))
+        merged: Dict[str, Any] = {}
+        for result in results:
+            merged.update(result)
+        return merged
+
+    def on_primary(self, listener: Callable[[Any, Dict[str, Any]], None]) -> Callable[[Any, Dict[str, Any]], None]:
+        """Wrap a commit listener so it flushes global state to the primary partition."""
+
+        def _listener(_db: Any, event: Dict[str, Any]) -> None:
+            listener(self.primary(), event)
+
+        return _listener
+
+    def _build_client(self, partition: Partition) -> FirestoreClient:
+        if not self.is_partitioned() or (partition.project is None and partition.database is None):
+            return get_firestore_client()
+        LOGGER.info(
+            "Firestore partition client created",
+            extra={"partition": partition.name, "project": partition.project, "database": partition.database},
+        )
+        return build_firestore_client(project=partition.project, database=partition.database)
+
+
+_ROUTER: Optional[PartitionRouter] = None
+_ROUTER_LOCK = threading.Lock()
+
+
+def get_partition_router() -> PartitionRouter:
+    """Return the process-wide router built from `FIRESTORE_PARTITIONS`."""
+
+    global _ROUTER
+    if _ROUTER is not None:
+        return _ROUTER
+    with _ROUTER_LOCK:
+        if _ROUTER is None:
+            _ROUTER = PartitionRouter(partitions_from_env())
+            LOGGER.info(
+                "Partition router configured",
+                extra={"partitions": [partition.name for partition in _ROUTER.partitions]},
+            )
+    return _ROUTER
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
@@ -0,0 +1,76 @@
+"""Local analytics snapshot of usage_monthly.
+
+`sync` pulls monthly docs updated since the last run (per-partition
+`updatedAt` watermark) into a SQLite file; run it from cron. `query` runs
+a cohort group-by against the file without touching Firestore.
+
+Usage:
+    python -m app.jobs.analytics_snapshot sync [--path FILE] [--page-size 500]
+    python -m app.jobs.analytics_snapshot query --by plan,country [--from YYYYMM] [--to YYYYMM]
+        [--where plan=pro] [--json]
+"""
+
+import argparse
+import json
+import sys
+
+from app.config.logger import get_logger, setup_logging
+from app.core.analytics import (
+    ANALYTICS_SNAPSHOT_PATH,
+    AnalyticsSnapshot,
+    CohortQueryError,
+    run_cohort_query,
+)
+from app.db.partitions import get_partition_router
+
+LOGGER = get_logger("usage_service.jobs.analytics_snapshot")
+
+_METRICS = ("users", "userMonths", "requests", "costUsd", "avgCostUsd", "inputTokens", "outputTokens")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Sync or query the local usage_monthly analytics snapshot.")
+    parser.add_argument("--path", default=ANALYTICS_SNAPSHOT_PATH, help="SQLite file (default: ANALYTICS_SNAPSHOT_PATH)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    sync = commands.add_parser("sync", help="Pull monthly docs updated since the last sync")
+    sync.add_argument("--page-size", type=int, default=500)
+    query = commands.add_parser("query", help="Group-by over the snapshot")
+    query.add_argument("--by", default="plan", help="Comma-separated: plan, country, premium, month, action")
+    query.add_argument("--from", dest="month_from", type=int, default=None, help="YYYYMM (inclusive)")
+    query.add_argument("--to", dest="month_to", type=int, default=None, help="YYYYMM (inclusive)")
+    query.add_argument("--where", action="append", default=[], help="dimension=value filter (repeatable)")
+    query.add_argument("--json", action="store_true", help="Print the result as JSON")
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("--path or ANALYTICS_SNAPSHOT_PATH is required")
+
+    setup_logging()
+    if args.command == "sync":
+        snapshot = AnalyticsSnapshot(args.path)
+        try:
+            read = snapshot.sync(get_partition_router().clients(), page_size=args.page_size)
+            for name, count in read.items():
+                print(f"partition={name} docs={count} watermark={snapshot.watermarks().get(name)}")
+        finally:
+            snapshot.close()
+        return 0
+
+    dimensions = [name.strip() for name in args.by.split(",") if name.strip()]
+    filters = dict(item.split("=", 1) for item in args.where)
+    try:
+        result = run_cohort_query(args.path, dimensions, args.month_from, args.month_to, filters)
+    except CohortQueryError as exc:
+        parser.error(str(exc))
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+        return 0
+    header = dimensions + list(_METRICS)
+    print("\t".join(header))
+    for row in result["rows"]:
+        print("\t".join(str(row[name]) for name in header))
+    print(f"# {len(result['rows'])} rows in {result['elapsedMs']} ms, watermarks={result['watermarks']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+"""Delete expired request_dedup docs.
+
+Intended for cron on backends without a Firestore TTL policy (e.g. the
+emulator). With a TTL policy on `request_dedup.expireAt` it is not needed,
+except once with `--backfill-expire-at`: docs written before `expireAt`
+existed get createdAt + DEDUP_WINDOW_SECONDS so the policy covers them.
+Runs against every partition in `FIRESTORE_PARTITIONS`, one after another
+so the per-database write rate stays at `--max-ops-per-second`.
+
+Usage:
+    python -m app.jobs.dedup_cleanup [--max-ops-per-second 500] [--max-deletes N] [--backfill-expire-at]
+"""
+
+import argparse
+
+from app.config.logger import get_logger, setup_logging
+from app.core.dedup import backfill_dedup_expire_at, cleanup_expired_dedup, count_live_dedup_keys
+from app.db.partitions import get_partition_router
+
+LOGGER = get_logger("usage_service.jobs.dedup_cleanup")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Delete expired request_dedup docs.")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--max-ops-per-second", type=int, default=500)
+    parser.add_argument("--max-deletes", type=int, default=None)
+    parser.add_argument(
+        "--backfill-expire-at", action="store_true", help="Only set expireAt on docs written without it (full scan)"
+    )
+    args = parser.parse_args()
+
+    setup_logging()
+    partitions = get_partition_router()
+    for name, db in partitions.clients():
+        if args.backfill_expire_at:
+            updated = backfill_dedup_expire_at(db, page_size=args.page_size, max_ops_per_second=args.max_ops_per_second)
+            LOGGER.info("Dedup expireAt backfill job done", extra={"partition": name, "updated": updated})
+            print(f"partition={name} backfilled={updated}")
+            continue
+        deleted = cleanup_expired_dedup(
+            db,
+            page_size=args.page_size,
+            max_ops_per_second=args.max_ops_per_second,
+            max_deletes=args.max_deletes,
+        )
+        live = count_live_dedup_keys(db)
+        LOGGER.info("Dedup cleanup job done", extra={"partition": name, "deleted": deleted, "liveKeys": live})
+        print(f"partition={name} deleted={deleted} live={live}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Rebuild usage_monthly docs from usage_daily.
+
+Backfill for switching to AGGREGATE_MONTHLY_MODE=derived, or a repair run
+after an outage longer than the rollup sweep lookback. Runs against every
+partition in FIRESTORE_PARTITIONS.
+
+Usage:
+    python -m app.jobs.monthly_rollup [--month YYYYMM] [--user USER_ID] [--batch 200]
+"""
+
+import argparse
+import datetime as dt
+
+from app.config.logger import get_logger, setup_logging
+from app.core.rollups import rollup_months
+from app.db.partitions import get_partition_router
+
+LOGGER = get_logger("usage_service.jobs.monthly_rollup")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Rebuild usage_monthly docs from usage_daily.")
+    parser.add_argument("--month", default=dt.datetime.now(dt.timezone.utc).strftime("%Y%m"))
+    parser.add_argument("--user", default=None, help="Only this user (default: every user with daily docs)")
+    parser.add_argument("--batch", type=int, default=200, help="Users rebuilt per get_all/bulk write round")
+    args = parser.parse_args()
+
+    setup_logging()
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    partitions = get_partition_router()
+    if args.user:
+        written = rollup_months(partitions.client_for_user(args.user), [(args.user, args.month)])
+        print(f"user={args.user} month={args.month} written={written}")
+        return
+    for name, db in partitions.clients():
+        query = (
+            db.collection("usage_daily")
+            .where(filter=FieldFilter("day", ">=", f"{args.month}01"))
+            .where(filter=FieldFilter("day", "<=", f"{args.month}31"))
+            .select(["userId"])
+        )
+        users = sorted({(snapshot.to_dict() or {}).get("userId") for snapshot in query.stream()} - {None})
+        written = 0
+        for start in range(0, len(users), args.batch):
+            written += rollup_months(db, [(user_id, args.month) for user_id in users[start : start + args.batch]])
+        LOGGER.info("Monthly rollup job done", extra={"partition": name, "month": args.month, "docs": written})
+        print(f"partition={name} month={args.month} users={len(users)} written={written}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""Move user-scoped docs to their owner after FIRESTORE_PARTITIONS changes.
+
+Deploy the new partition list first (new writes go straight to the new
+owner), then run this job with the previous list. For every doc in a
+user-scoped collection whose `userId` now hashes to another partition it:
+
+- merges aggregates (`usage_daily`, `usage_monthly`, `usage_hourly`) into
+  the target by summing numeric fields (the `lastEventAt`/`updatedAt`
+  stamps take the later value), because the target may already hold
+  increments written after the switch;
+- merges credit balances (`user_credits`): the source's `balanceUsd`
+  plus its leases (held by workers of the previous deployment) and its
+  `spentUsd` are added to the target, which may already hold grants or
+  spend made after the switch;
+- copies other docs (dedup locks, raw events, plans) only if the target
+  has none, since a target doc is always newer;
+- moves the docs' subcollections the same way: spilled action breakdowns
+  (`actions`) of daily/monthly aggregates are merged, credit grant and
+  settlement records (`user_credits/{userId}/grants`, `settled`) are
+  copied if absent;
+- deletes the source doc and those subcollection docs with `--delete-source`.
+  A credits doc changed since it was read is left in place (`retained`)
+  for the next run.
+
+Merged aggregates record `rebalancedFrom.{partition}` so a rerun after a
+crash does not add the same source doc twice; merged credits record the
+amounts carried over there, and a rerun adds only what changed since.
+Dry runs count parent docs only.
+
+Usage:
+    python -m app.jobs.rebalance_partitions --from '<old FIRESTORE_PARTITIONS>' [--apply] [--delete-source]
+"""
+
+import argparse
+import datetime as dt
+import json
+import time
+from typing import Any, Dict, Optional, Sequence
+
+from app.config.logger import get_logger, setup_logging
+from app.core.actions import ACTIONS_SUBCOLLECTION
+from app.core.credits import SETTLED_SUBCOLLECTION, USER_CREDITS_COLLECTION
+from app.db.partitions import USER_SCOPED_COLLECTIONS, PartitionRouter, partitions_from_env
+from app.utils.lazy import lazy_import
+
+firestore = lazy_import("google.cloud.firestore")
+LOGGER = get_logger("usage_service.jobs.rebalance_partitions")
+
+AGGREGATE_COLLECTIONS = ("usage_daily", "usage_monthly", "usage_hourly")
+# Subcollections moved with their parent doc.
+SUBCOLLECTIONS = {
+    "usage_daily": (ACTIONS_SUBCOLLECTION,),
+    "usage_monthly": (ACTIONS_SUBCOLLECTION,),
+    USER_CREDITS_COLLECTION: ("grants", SETTLED_SUBCOLLECTION),
+}
+REBALANCE_MARKER = "rebalancedFrom"
+# Top-level aggregate fields that are descriptive rather than counters.
+NON_ADDITIVE_FIELDS = ("userId", "day", "month", "hour", "planSnapshot", REBALANCE_MARKER)
+# Aggregate timestamps (epoch numbers or datetimes) that keep the later value.
+LATEST_FIELDS = ("lastEventAt", "updatedAt")
+# Credit amounts carried over to the target (leases are folded into balanceUsd).
+CREDIT_FIELDS = ("balanceUsd", "spentUsd")
+_EPSILON_USD = 1e-9
+
+
+class _Pacer:
+    def __init__(self, ops_per_second: float) -> None:
+        self.interval = 1.0 / ops_per_second if ops_per_second > 0 else 0.0
+        self._next = time.monotonic()
+
+    def wait(self) -> None:
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if now < self._next:
+            time.sleep(self._next - now)
+        self._next = max(now, self._next) + self.interval
+
+
+def rebalance(
+    old: PartitionRouter,
+    new: PartitionRouter,
+    collections: Sequence[str] = USER_SCOPED_COLLECTIONS,
+    apply: bool = False,
+    delete_source: bool = False,
+    page_size: int = 500,
+    max_ops_per_second: float = 200,
+) -> Dict[str, int]:
+    """Scan every old partition and move docs whose owner changed.
+
+    With `apply=False` only counts what would move. Returns counters
+    (`scanned`, `moved`, `merged`, `copied`, `kept`, `skipped`, `deleted`,
+    `retained` for credits docs not deleted because they changed, and
+    `subdocs` for subcollection docs moved with their parent).
+    """
+
+    stats = {
+        "scanned": 0,
+        "moved": 0,
+        "merged": 0,
+        "copied": 0,
+        "kept": 0,
+        "skipped": 0,
+        "deleted": 0,
+        "retained": 0,
+        "subdocs": 0,
+    }
+    pacer = _Pacer(max_ops_per_second)
+    for source_name, source_db in old.clients():
+        for collection in collections:
+            for snapshot in _iter_collection(source_db, collection, page_size):
+                stats["scanned"] += 1
+                data = snapshot.to_dict() or {}
+                user_id = data.get("userId")
+                if not user_id:
+                    stats["skipped"] += 1
+                    continue
+                target_name = new.partition_for_user(str(user_id))
+                if _same_location(old, source_name, new, target_name):
+                    continue
+                stats["moved"] += 1
+                if not apply:
+                    continue
+                pacer.wait()
+                target_db = new.client(target_name)
+                target_ref = target_db.collection(collection).document(snapshot.id)
+                if collection in AGGREGATE_COLLECTIONS:
+                    outcome = _merge_aggregate(target_db, target_ref, data, source_name)
+                elif collection == USER_CREDITS_COLLECTION:
+                    outcome = _merge_credits(target_db, target_ref, data, source_name)
+                else:
+                    outcome = _copy_if_absent(target_db, target_ref, data)
+                stats[outcome] += 1
+                # Children first: deleting a doc leaves its subcollections behind.
+                for subcollection in SUBCOLLECTIONS.get(collection, ()):
+                    for child in _iter_collection(snapshot.reference, subcollection, page_size):
+                        pacer.wait()
+                        child_ref = target_ref.collection(subcollection).document(child.id)
+                        if collection in AGGREGATE_COLLECTIONS:
+                            _merge_aggregate(target_db, child_ref, child.to_dict() or {}, source_name)
+                        else:
+                            _copy_if_absent(target_db, child_ref, child.to_dict() or {})
+                        stats["subdocs"] += 1
+                        if delete_source:
+                            child.reference.delete()
+                            stats["deleted"] += 1
+                if not delete_source:
+                    continue
+                if collection == USER_CREDITS_COLLECTION and not _delete_unchanged(source_db, snapshot):
+                    stats["retained"] += 1
+                    continue
+                snapshot.reference.delete()
+                stats["deleted"] += 1
+            LOGGER.info(
+                "Rebalance collection scanned",
+                extra={"partition": source_name, "collection": collection, "stats": dict(stats)},
+            )
+    return stats
+
+
+def merge_values(target: Any, source: Any) -> Any:
+    """Merge two aggregate values: numbers add, timestamps keep the later, maps recurse.
+
+    LATEST_FIELDS keep the later value at any depth, even when they are
+    epoch numbers. Any other value keeps the target's (it was written after the
+    switch).
+    """
+
+    if isinstance(target, dict) and isinstance(source, dict):
+        merged = dict(target)
+        for key, value in source.items():
+            if key not in target:
+                merged[key] = value
+            elif key in LATEST_FIELDS and _is_number(target[key]) and _is_number(value):
+                merged[key] = max(target[key], value)
+            else:
+                merged[key] = merge_values(target[key], value)
+        return merged
+    if _is_number(target) and _is_number(source):
+        return target + source
+    if isinstance(target, dt.datetime) and isinstance(source, dt.datetime):
+        return max(target, source)
+    return target
+
+
+def _merge_aggregate(db: Any, target_ref: Any, data: Dict[str, Any], source_name: str) -> str:
+    @firestore.transactional
+    def _txn(transaction: Any) -> str:
+        snapshot = target_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            payload = dict(data)
+            payload[REBALANCE_MARKER] = {source_name: True}
+            transaction.set(target_ref, payload)
+            return "copied"
+        current = snapshot.to_dict() or {}
+        if (current.get(REBALANCE_MARKER) or {}).get(source_name):
+            return "kept"
+        merged = merge_values(current, {k: v for k, v in data.items() if k not in NON_ADDITIVE_FIELDS})
+        merged[REBALANCE_MARKER] = {**(current.get(REBALANCE_MARKER) or {}), source_name: True}
+        transaction.set(target_ref, merged)
+        return "merged"
+
+    return _txn(db.transaction())
+
+
+def credit_amounts(data: Dict[str, Any]) -> Dict[str, float]:
+    """Amounts a source credits doc carries over: leases go back to the balance.
+
+    Workers of the previous deployment held those leases; like a crashed
+    worker's, their unreported spend is forgiven rather than lost credit.
+    """
+
+    leased = sum(float((lease or {}).get("amountUsd") or 0.0) for lease in (data.get("leases") or {}).values())
+    return {
+        "balanceUsd": float(data.get("balanceUsd") or 0.0) + leased,
+        "spentUsd": float(data.get("spentUsd") or 0.0),
+    }
+
+
+def _merge_credits(db: Any, target_ref: Any, data: Dict[str, Any], source_name: str) -> str:
+    moved = credit_amounts(data)
+
+    @firestore.transactional
+    def _txn(transaction: Any) -> str:
+        snapshot = target_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            transaction.set(
+                target_ref,
+                {
+                    "userId": data.get("userId"),
+                    **moved,
+                    REBALANCE_MARKER: {source_name: moved},
+                    "updatedAt": firestore.SERVER_TIMESTAMP,
+                },
+            )
+            return "copied"
+        current = snapshot.to_dict() or {}
+        # What an earlier run already carried over from this source.
+        done = (current.get(REBALANCE_MARKER) or {}).get(source_name)
+        done = done if isinstance(done, dict) else {}
+        delta = {field: moved[field] - float(done.get(field) or 0.0) for field in CREDIT_FIELDS}
+        if all(abs(value) <= _EPSILON_USD for value in delta.values()):
+            return "kept"
+        transaction.set(
+            target_ref,
+            {
+                **{field: float(current.get(field) or 0.0) + delta[field] for field in CREDIT_FIELDS},
+                REBALANCE_MARKER: {source_name: moved},
+                "updatedAt": firestore.SERVER_TIMESTAMP,
+            },
+            merge=True,
+        )
+        return "merged"
+
+    return _txn(db.transaction())
+
+
+def _delete_unchanged(db: Any, snapshot: Any) -> bool:
+    """Delete a source doc only if it was not written after `snapshot` was read."""
+
+    try:
+        snapshot.reference.delete(option=db.write_option(last_update_time=snapshot.update_time))
+    except Exception as exc:  # noqa: BLE001
+        LOGGER.warning(
+            "Rebalance kept a source doc changed during the move",
+            extra={"path": snapshot.reference.path, "error": str(exc)},
+        )
+        return False
+    return True
+
+
+def _copy_if_absent(db: Any, target_ref: Any, data: Dict[str, Any]) -> str:
+    @firestore.transactional
+    def _txn(transaction: Any) -> str:
+        if target_ref.get(transaction=transaction).exists:
+            return "kept"
+        transaction.set(target_ref, data)
+        return "copied"
+
+    return _txn(db.transaction())
+
+
+def _iter_collection(parent: Any, collection: str, page_size: int):
+    # `parent` is a client or, for subcollections, a document reference.
+    query = parent.collection(collection).order_by("__name__").limit(page_size)
+    last: Optional[Any] = None
+    while True:
+        page = list((query.start_after(last) if last is not None else query).stream())
+        yield from page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+
+def _same_location(old: PartitionRouter, old_name: str, new: PartitionRouter, new_name: str) -> bool:
+    source = old.partition(old_name)
+    target = new.partition(new_name)
+    return (source.project, source.database) == (target.project, target.database)
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move user-scoped docs after FIRESTORE_PARTITIONS changes.")
+    parser.add_argument("--from", dest="source", required=True, help="Previous FIRESTORE_PARTITIONS JSON")
+    parser.add_argument("--to", dest="target", default=None, help="New partitions JSON (default: env)")
+    parser.add_argument("--collections", default=",".join(USER_SCOPED_COLLECTIONS))
+    parser.add_argument("--apply", action="store_true", help="Write changes (default: dry run)")
+    parser.add_argument("--delete-source", action="store_true")
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--max-ops-per-second", type=float, default=200)
+    args = parser.parse_args()
+
+    setup_logging()
+    old = PartitionRouter(partitions_from_env(args.source))
+    new = PartitionRouter(partitions_from_env(args.target))
+    stats = rebalance(
+        old,
+        new,
+        collections=[name.strip() for name in args.collections.split(",") if name.strip()],
+        apply=args.apply,
+        delete_source=args.delete_source,
+        page_size=args.page_size,
+        max_ops_per_second=args.max_ops_per_second,
+    )
+    LOGGER.info("Rebalance job done", extra={"apply": args.apply, "stats": stats})
+    print(json.dumps({"apply": args.apply, **stats}))
+
+
+if __name__ == "__main__":
+    main()
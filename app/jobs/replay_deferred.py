@@ -0,0 +1,91 @@
+"""Replay events spilled to STORAGE_FALLBACK_DIR while Firestore was unavailable.
+
+Each event goes through `update_aggregates` again, so requestIds that did
+reach Firestore are skipped by dedup and a file can be replayed more than
+once. Fully replayed files are renamed to `*.ndjson.done`. Files of the
+current UTC hour are skipped unless --include-current is given, since a
+worker may still be appending to them. Commit listeners (leaderboard,
+cardinality, latency sketches) are not run for replayed events, except
+the billing ones: events carrying `credits.reservationId` are charged,
+and org totals get the event (orgId resolved from user_orgs when
+ATTACH_USER_ORGS is set). Credit leases are returned and org deltas
+flushed before the job exits.
+
+Usage:
+    python -m app.jobs.replay_deferred [--dir PATH] [--include-current] [--dry-run]
+"""
+
+import argparse
+import datetime as dt
+import os
+import sys
+from typing import Optional
+
+from app.config.logger import get_logger, setup_logging
+from app.core.credits import DEFAULT_LEDGER
+from app.core.orgs import DEFAULT_ORG_ROLLUP, get_user_org
+from app.core.fallback import STORAGE_FALLBACK_DIR, pending_files, read_deferred
+from app.core.resilience import StorageUnavailable
+from app.core.usage_tracker import WRITE_RAW_EVENTS, log_event, update_aggregates
+from app.db.partitions import PartitionRouter, get_partition_router
+
+LOGGER = get_logger("usage_service.jobs.replay_deferred")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Replay events spilled to the storage fallback sink.")
+    parser.add_argument("--dir", default=STORAGE_FALLBACK_DIR, help="Spill directory (default: STORAGE_FALLBACK_DIR)")
+    parser.add_argument("--include-current", action="store_true", help="Also replay files of the current hour")
+    parser.add_argument("--dry-run", action="store_true", help="Only count pending events")
+    args = parser.parse_args()
+    if not args.dir:
+        parser.error("--dir or STORAGE_FALLBACK_DIR is required")
+
+    setup_logging()
+    current_hour = None if args.include_current else dt.datetime.now(dt.timezone.utc).strftime("%Y%m%d%H")
+    partitions = get_partition_router()
+    try:
+        return _replay(args, partitions, current_hour)
+    finally:
+        DEFAULT_LEDGER.stop()
+        DEFAULT_ORG_ROLLUP.stop()
+
+
+def _replay(args: argparse.Namespace, partitions: PartitionRouter, current_hour: Optional[str]) -> int:
+    for path in pending_files(args.dir, before_hour=current_hour):
+        applied = deduped = 0
+        try:
+            for event in read_deferred(path):
+                if args.dry_run:
+                    applied += 1
+                    continue
+                db = partitions.client_for_user(event["userId"])
+                if _attach_user_orgs() and not event.get("orgId"):
+                    org_id = get_user_org(db, event["userId"])
+                    if org_id:
+                        event["orgId"] = org_id
+                if update_aggregates(db, event):
+                    applied += 1
+                    if WRITE_RAW_EVENTS:
+                        log_event(db, event)
+                    DEFAULT_LEDGER.observe_event(db, event)
+                    DEFAULT_ORG_ROLLUP.observe_event(partitions.primary(), event)
+                else:
+                    deduped += 1
+        except StorageUnavailable as exc:
+            LOGGER.warning("Deferred replay stopped: %s", exc, extra={"file": str(path)})
+            print(f"{path.name}: stopped after applied={applied} deduped={deduped}: {exc}")
+            return 1
+        if not args.dry_run:
+            path.rename(path.with_name(path.name + ".done"))
+        LOGGER.info("Deferred file replayed", extra={"file": str(path), "applied": applied, "deduped": deduped})
+        print(f"{path.name}: applied={applied} deduped={deduped}")
+    return 0
+
+
+def _attach_user_orgs() -> bool:
+    return os.getenv("ATTACH_USER_ORGS", "").lower() in ("1", "true", "yes", "on")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,33 @@
 import json
+import time
 import uuid
 from typing import Any
 
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 
 from app.config.logger import get_logger, setup_logging
+from app.api.auth import producer_keys
+from app.api.routes_credits import router as credits_router
 from app.api.routes_health import router as health_router
+from app.api.routes_orgs import router as orgs_router
+from app.api.routes_revenuecat import router as revenuecat_router
+from app.api.routes_throttle import router as throttle_router
 from app.api.routes_usage import router as usage_router
+from app.db.partitions import get_partition_router
+from app.core.admission import AdmissionRejected
+from app.core.capture import DEFAULT_CAPTURE
+from app.core.cardinality import DEFAULT_CARDINALITY
+from app.core.credits import DEFAULT_LEDGER
+from app.core.latency import DEFAULT_LATENCY
+from app.core.leaderboard import DEFAULT_LEADERBOARD
+from app.core.orgs import DEFAULT_ORG_ROLLUP
+from app.core.resilience import StorageUnavailable
+from app.core.rollups import DEFAULT_ROLLUP
+from app.core.streams import DEFAULT_STREAMS
+from app.core.throttling import DEFAULT_ENGINE as THROTTLE_ENGINE
+from app.core.usage_tracker import add_commit_listener
+from app.core.warmup import start_warmup
 
 setup_logging()
 LOGGER = get_logger("usage_service.request")
@@ -29,8 +50,8 @@ async def log_requests(request: Request, call_next):
     request_id = str(uuid.uuid4())
     request.state.request_id = request_id
 
-    # Quiet health checks: skip verbose logging to reduce noise.
-    if request.url.path == "/health":
+    # Quiet health checks and scrapes: skip verbose logging to reduce noise.
+    if request.url.path in ("/health", "/ready", "/metrics"):
         response = await call_next(request)
         LOGGER.debug(
             "Health check request skipped verbose logging",
@@ -38,13 +59,13 @@ async def log_requests(request: Request, call_next):
         )
         return response
 
+    received_at = time.time()
+    started = time.perf_counter()
+    # Starlette caches the body read here and replays it to the route; the
+    # original receive channel stays in place so streamed responses still
+    # see http.disconnect.
     raw_body = await request.body()
 
-    async def receive() -> dict:
-        return {"type": "http.request", "body": raw_body, "more_body": False}
-
-    request._receive = receive  # type: ignore[attr-defined]
-
     request_json: Any = None
     if raw_body:
         try:
@@ -71,6 +92,25 @@ async def log_requests(request: Request, call_next):
         )
 
     response = await call_next(request)
+    DEFAULT_CAPTURE.record(
+        received_at,
+        request.method,
+        request.url.path,
+        request.url.query,
+        request.headers,
+        raw_body,
+        response.status_code,
+        (time.perf_counter() - started) * 1000,
+    )
+
+    # Streamed exports (NDJSON/CSV) pass through unbuffered.
+    if not response.headers.get("content-type", "").startswith("application/json"):
+        LOGGER.info(
+            "Response status: %s (Request ID: %s, streamed)",
+            response.status_code,
+            request_id,
+        )
+        return response
 
     resp_body = b""
     async for chunk in response.body_iterator:
@@ -104,5 +144,73 @@ async def log_requests(request: Request, call_next):
     )
 
 
+@app.exception_handler(StorageUnavailable)
+async def storage_unavailable(request: Request, exc: StorageUnavailable) -> JSONResponse:
+    LOGGER.warning(
+        "Storage unavailable: %s",
+        exc,
+        extra={"requestId": getattr(request.state, "request_id", None), "reason": exc.reason},
+    )
+    return JSONResponse(
+        content={"detail": "Storage temporarily unavailable", "reason": exc.reason},
+        status_code=503,
+        headers={"Retry-After": exc.retry_after_header()},
+    )
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected(request: Request, exc: AdmissionRejected) -> JSONResponse:
+    LOGGER.warning(
+        "Admission rejected: %s",
+        exc,
+        extra={"requestId": getattr(request.state, "request_id", None), "reason": exc.reason},
+    )
+    return JSONResponse(
+        content={"detail": "Too many requests for producer", "reason": exc.reason},
+        status_code=429,
+        headers={"Retry-After": exc.retry_after_header()},
+    )
+
+
 app.include_router(health_router)
 app.include_router(usage_router)
+app.include_router(throttle_router)
+app.include_router(revenuecat_router)
+app.include_router(credits_router)
+app.include_router(orgs_router)
+
+# Listeners get the client of the user's partition; global sketches are
+# checkpointed to the primary partition instead.
+PARTITIONS = get_partition_router()
+add_commit_listener(THROTTLE_ENGINE.observe_event)
+add_commit_listener(PARTITIONS.on_primary(DEFAULT_LEADERBOARD.observe_event))
+add_commit_listener(PARTITIONS.on_primary(DEFAULT_CARDINALITY.observe_event))
+add_commit_listener(PARTITIONS.on_primary(DEFAULT_LATENCY.observe_event))
+add_commit_listener(PARTITIONS.on_primary(DEFAULT_ORG_ROLLUP.observe_event))
+add_commit_listener(DEFAULT_ROLLUP.observe_event)
+add_commit_listener(DEFAULT_LEDGER.observe_event)
+add_commit_listener(DEFAULT_STREAMS.observe_event)
+
+
+@app.on_event("startup")
+def warmup() -> None:
+    producer_keys()  # fail at startup on a malformed USAGE_SERVICE_PRODUCER_KEYS
+    start_warmup()
+    DEFAULT_ROLLUP.start(PARTITIONS.clients)
+    DEFAULT_LEDGER.start()
+    DEFAULT_ORG_ROLLUP.start()
+
+
+@app.on_event("shutdown")
+def flush_checkpoints() -> None:
+    try:
+        db = PARTITIONS.primary()
+        DEFAULT_LEADERBOARD.checkpoint(db)
+        DEFAULT_CARDINALITY.flush(db)
+        DEFAULT_LATENCY.flush(db)
+        DEFAULT_ROLLUP.stop()
+        DEFAULT_LEDGER.stop()
+        DEFAULT_ORG_ROLLUP.stop()
+        DEFAULT_CAPTURE.close()
+    except Exception as exc:  # noqa: BLE001
+        LOGGER.warning("Shutdown checkpoint failed: %s", exc)
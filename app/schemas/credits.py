@@ -0,0 +1,26 @@
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+
+class CreditReserveRequest(BaseModel):
+    userId: str = Field(..., description="User identifier")
+    amountUsd: float = Field(..., gt=0, description="Upper bound of the upcoming request's cost")
+    reservationId: Optional[str] = Field(None, description="Caller-chosen ID; generated when omitted")
+    ttlSeconds: Optional[float] = Field(None, gt=0, description="Hold duration (default CREDIT_RESERVATION_TTL_SECONDS)")
+
+
+class CreditCommitRequest(BaseModel):
+    userId: str = Field(..., description="User identifier")
+    reservationId: str = Field(..., description="ID returned by /v1/credits/reserve")
+    actualUsd: float = Field(..., ge=0, description="Actual cost of the request")
+
+
+class CreditReleaseRequest(BaseModel):
+    userId: str = Field(..., description="User identifier")
+    reservationId: str = Field(..., description="ID returned by /v1/credits/reserve")
+
+
+class CreditGrantRequest(BaseModel):
+    amountUsd: float = Field(..., description="Credit to add; negative values deduct")
+    grantId: Optional[str] = Field(None, description="Idempotency key; a repeated grantId is ignored")
@@ -1,8 +1,132 @@
+from typing import Any, Dict, List, Optional
+
 from pydantic import BaseModel
 
 
 class UsageIngestResponse(BaseModel):
     ok: bool
     deduped: bool
+    deferred: bool = False
     requestId: str
     eventId: str
+
+
+class ThrottleDecisionResponse(BaseModel):
+    decision: str
+    reason: Optional[str] = None
+    retryAfterMs: Optional[int] = None
+    remaining: Dict[str, Any] = {}
+    policy: str
+    evaluatedAt: str
+
+
+class TopUserEntry(BaseModel):
+    userId: str
+    value: float
+    maxError: float
+
+
+class TopUsersResponse(BaseModel):
+    period: str
+    key: str
+    metric: str
+    users: List[TopUserEntry]
+
+
+class CardinalityResponse(BaseModel):
+    day: str
+    dimension: str
+    distinctUsers: Dict[str, int]
+
+
+class LatencyStats(BaseModel):
+    requests: int
+    samples: int
+    p50: Optional[float] = None
+    p95: Optional[float] = None
+    p99: Optional[float] = None
+    errorRate: float
+    errors: Dict[str, int] = {}
+
+
+class LatencyResponse(BaseModel):
+    day: str
+    dimension: str
+    values: Dict[str, LatencyStats]
+
+
+class MonthToDateResponse(BaseModel):
+    userId: str
+    month: str
+    source: str
+    totalInputTokens: int = 0
+    totalOutputTokens: int = 0
+    totalCostUsd: float = 0.0
+    totalCostTry: float = 0.0
+    actions: Dict[str, Dict[str, float]] = {}
+    stalenessBoundSeconds: Optional[float] = None
+
+
+class CohortQueryResponse(BaseModel):
+    rows: List[Dict[str, Any]]
+    watermarks: Dict[str, str] = {}
+    elapsedMs: float
+
+
+class RevenueCatWebhookResponse(BaseModel):
+    ok: bool
+    userId: str
+    stored: bool
+
+
+class CreditReservationResponse(BaseModel):
+    ok: bool
+    reservationId: Optional[str] = None
+    amountUsd: float = 0.0
+    availableUsd: Optional[float] = None
+    reason: Optional[str] = None
+
+
+class CreditCommitResponse(BaseModel):
+    ok: bool
+    reservationId: str
+    chargedUsd: float
+
+
+class CreditReleaseResponse(BaseModel):
+    ok: bool
+    released: bool
+
+
+class CreditBalanceResponse(BaseModel):
+    userId: str
+    balanceUsd: float
+    leasedUsd: float
+    spentUsd: float
+    local: Dict[str, float] = {}
+
+
+class CreditGrantResponse(BaseModel):
+    ok: bool
+    applied: bool
+    balanceUsd: float
+
+
+class OrgUsageResponse(BaseModel):
+    orgId: str
+    period: str
+    key: str
+    totalInputTokens: int = 0
+    totalOutputTokens: int = 0
+    totalCostUsd: float = 0.0
+    totalCostTry: float = 0.0
+    requestCount: int = 0
+    actions: Dict[str, Dict[str, float]] = {}
+    lastEventAt: Optional[Any] = None
+    stalenessBoundSeconds: float
+
+
+class OrgMemberResponse(BaseModel):
+    ok: bool
+    userId: str
+    orgId: Optional[str] = None
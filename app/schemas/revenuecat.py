@@ -0,0 +1,11 @@
+from typing import Any, Dict, Optional
+
+from pydantic import BaseModel, Field
+
+
+class RevenueCatWebhook(BaseModel):
+    api_version: Optional[str] = None
+    event: Dict[str, Any] = Field(..., description="RevenueCat event payload")
+
+    class Config:
+        extra = "allow"
@@ -0,0 +1,8 @@
+from pydantic import BaseModel, Field
+
+
+class ThrottleCheckRequest(BaseModel):
+    userId: str = Field(..., description="User identifier")
+    action: str = Field(..., description="High-level action name (e.g. analyze_pdf)")
+    cost: float = Field(1.0, ge=0, description="Bucket tokens consumed by this request")
+    consume: bool = Field(True, description="False evaluates the decision without consuming tokens")
@@ -6,6 +6,7 @@ from pydantic import BaseModel, Field
 class UsageEvent(BaseModel):
     requestId: str = Field(..., description="Unique request identifier for idempotency")
     userId: str = Field(..., description="User identifier")
+    orgId: Optional[str] = Field(None, description="Organisation the usage is billed to")
     timestamp: Union[int, str] = Field(..., description="Unix epoch seconds in UTC")
     action: str = Field(..., description="High-level action name (e.g. analyze_pdf)")
     eventId: Optional[str] = Field(None, description="Event identifier (defaults to requestId)")
@@ -22,6 +23,7 @@ class UsageEvent(BaseModel):
     outputTokens: Optional[int] = None
     totalTokens: Optional[int] = None
     cachedTokens: Optional[int] = None
+    reasoningTokens: Optional[int] = None
     isCacheHit: Optional[bool] = None
     latencyMs: Optional[int] = None
     status: Optional[str] = None
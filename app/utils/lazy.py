@@ -0,0 +1,30 @@
+import importlib
+import importlib.util
+import sys
+import threading
+from types import ModuleType
+
+_LOCK = threading.Lock()
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Return `name` as a module whose body runs on first attribute access.
+
+    Used for heavy dependencies (google.cloud.firestore, google.oauth2) so
+    importing the app stays fast and the cost moves to the warmup phase.
+    Modules already imported are returned as-is.
+    """
+
+    with _LOCK:
+        module = sys.modules.get(name)
+        if module is not None:
+            return module
+        spec = importlib.util.find_spec(name)
+        if spec is None or spec.loader is None:
+            raise ModuleNotFoundError(f"No module named {name!r}", name=name)
+        loader = importlib.util.LazyLoader(spec.loader)
+        spec.loader = loader
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        loader.exec_module(module)
+        return module
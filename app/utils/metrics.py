@@ -0,0 +1,115 @@
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help = help_text
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def value(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(_label_key(labels), 0.0)
+
+    def samples(self) -> List[Tuple[LabelKey, float]]:
+        with self._lock:
+            return list(self._values.items())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        super().__init__(name, help_text)
+        self._callback: Optional[Callable[[], Dict[LabelKey, float]]] = None
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[_label_key(labels)] = float(value)
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set_callback(self, callback: Callable[[], Dict[LabelKey, float]]) -> None:
+        """Compute samples at scrape time instead of storing them."""
+
+        self._callback = callback
+
+    def samples(self) -> List[Tuple[LabelKey, float]]:
+        if self._callback is not None:
+            return list(self._callback().items())
+        return super().samples()
+
+
+_REGISTRY: Dict[str, _Metric] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def counter(name: str, help_text: str) -> Counter:
+    return _get_or_create(Counter, name, help_text)
+
+
+def gauge(name: str, help_text: str) -> Gauge:
+    return _get_or_create(Gauge, name, help_text)
+
+
+def labels(**values: str) -> LabelKey:
+    """Build a label key for Gauge callbacks."""
+
+    return _label_key(values)
+
+
+def render_prometheus() -> str:
+    """Render every registered metric in the Prometheus text exposition format."""
+
+    lines: List[str] = []
+    with _REGISTRY_LOCK:
+        metrics = sorted(_REGISTRY.values(), key=lambda metric: metric.name)
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for key, value in sorted(metric.samples()):
+            if key:
+                rendered = ",".join(f'{name}="{_escape(label)}"' for name, label in key)
+                lines.append(f"{metric.name}{{{rendered}}} {value}")
+            else:
+                lines.append(f"{metric.name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _get_or_create(kind, name: str, help_text: str):
+    with _REGISTRY_LOCK:
+        metric = _REGISTRY.get(name)
+        if metric is None:
+            metric = _REGISTRY[name] = kind(name, help_text)
+        elif not isinstance(metric, kind):
+            raise ValueError(f"metric {name} already registered as {metric.kind}")
+        return metric
+
+
+def _label_key(values: Dict[str, str]) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in values.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,30 @@
+import os
+import socket
+import threading
+import time
+
+
+def worker_id() -> str:
+    """Stable identifier of this process, used for per-worker checkpoint slots."""
+
+    return os.getenv("USAGE_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class IntervalGate:
+    """Thread-safe "at most once per interval" gate for lazy periodic work."""
+
+    def __init__(self, interval_seconds: float, clock=time.monotonic) -> None:
+        self._interval = interval_seconds
+        self._clock = clock
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def due(self) -> bool:
+        """Return True (and reset the timer) if the interval has elapsed."""
+
+        now = self._clock()
+        with self._lock:
+            if now - self._last < self._interval:
+                return False
+            self._last = now
+            return True
@@ -0,0 +1 @@
+"""Local benchmark and accuracy scripts. Run from the repo root with `python -m benchmarks.<name>`."""
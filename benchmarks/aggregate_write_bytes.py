@@ -0,0 +1,88 @@
+"""Count field bytes sent per event for daily/monthly aggregate updates.
+
+Usage:
+    python -m benchmarks.aggregate_write_bytes [--events 10000] [--users 50]
+
+Compares the update payloads with the static-field fingerprint cache
+disabled ("before") and enabled ("after"). Sizes follow Firestore's
+storage-size rules (app.core.doc_size); no Firestore calls are made.
+"""
+
+import argparse
+import random
+from typing import Any, Dict
+
+from app.core import usage_tracker
+from app.core.doc_size import map_bytes
+from app.core.static_fields import StaticFieldCache
+
+
+class _Snapshot:
+    def __init__(self, data: Dict[str, Any] | None) -> None:
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Dict[str, Any] | None:
+        return self._data
+
+
+def _events(count: int, users: int, seed: int):
+    rng = random.Random(seed)
+    plans = {f"uid_{i}": {"tier": rng.choice(["free", "pro"]), "isPremium": rng.random() < 0.3} for i in range(users)}
+    for index in range(count):
+        user_id = f"uid_{rng.randrange(users)}"
+        yield {
+            "requestId": f"req_{index}",
+            "userId": user_id,
+            "timestamp": 1768206132 + index,
+            "action": rng.choice(["chat", "analyze_pdf", "generate_ppt"]),
+            "model": "gemini-2.5-flash",
+            "inputTokens": rng.randint(100, 4000),
+            "outputTokens": rng.randint(50, 2000),
+            "costUSD": rng.random() / 100,
+            "costTRY": rng.random(),
+            "plan": plans[user_id],
+        }
+
+
+def _run(count: int, users: int, seed: int, cache_enabled: bool) -> float:
+    usage_tracker.STATIC_FIELD_CACHE_ENABLED = cache_enabled
+    usage_tracker.DEFAULT_STATIC_FIELD_CACHE = StaticFieldCache()
+    stored: Dict[str, Dict[str, Any]] = {}
+    total = 0
+    for event in _events(count, users, seed):
+        timestamp = usage_tracker._parse_timestamp(event["timestamp"])
+        fingerprints: Dict[str, str] = {}
+        for path, kwargs in (
+            (f"usage_daily/{event['userId']}_{timestamp:%Y%m%d}", {"day_key": timestamp.strftime("%Y%m%d")}),
+            (
+                f"usage_monthly/{event['userId']}_{timestamp:%Y%m}",
+                {"month_key": timestamp.strftime("%Y%m"), "is_monthly": True},
+            ),
+        ):
+            snapshot = _Snapshot(stored.get(path))
+            update = usage_tracker._build_aggregate_update(event, snapshot, **kwargs)
+            update = usage_tracker._elide_static_fields(path, update, event.get("plan"), snapshot, fingerprints)
+            total += map_bytes(update)
+            stored.setdefault(path, {}).update(
+                {key: value for key, value in update.items() if key in ("userId", "planSnapshot", "day", "month")}
+            )
+        for path, fingerprint in fingerprints.items():
+            usage_tracker.DEFAULT_STATIC_FIELD_CACHE.record(path, fingerprint)
+    return total / count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=10_000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=3)
+    args = parser.parse_args()
+
+    before = _run(args.events, args.users, args.seed, cache_enabled=False)
+    after = _run(args.events, args.users, args.seed, cache_enabled=True)
+    print(f"field bytes/event before={before:.1f} after={after:.1f} saved={1 - after / before:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Compare HyperLogLog estimates against exact distinct counts.
+
+Usage:
+    python -m benchmarks.hll_accuracy [--users 1000000] [--workers 4] [--precision 12]
+
+Synthetic users are split across several sketches (as if ingested by
+different instances), serialised, merged and compared with the exact count.
+Exits non-zero if the relative error exceeds 3 standard errors.
+"""
+
+import argparse
+import math
+import random
+import sys
+import time
+
+from app.core.cardinality import HyperLogLog
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--precision", type=int, default=12)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    sketches = [HyperLogLog(args.precision) for _ in range(args.workers)]
+    checkpoints = (1_000, 10_000, 100_000, args.users)
+    standard_error = 1.04 / math.sqrt(1 << args.precision)
+    failed = False
+
+    started = time.perf_counter()
+    seen = 0
+    for user in range(args.users):
+        user_id = f"uid_{user:08d}"
+        # Each user shows up 1-3 times on random workers, like retries/multiple actions.
+        for _ in range(rng.randint(1, 3)):
+            sketches[rng.randrange(args.workers)].add(user_id)
+        seen += 1
+        if seen in checkpoints:
+            merged = HyperLogLog.from_bytes(sketches[0].to_bytes())
+            for sketch in sketches[1:]:
+                merged.merge(HyperLogLog.from_bytes(sketch.to_bytes()))
+            estimate = merged.estimate()
+            error = (estimate - seen) / seen
+            ok = abs(error) <= 3 * standard_error
+            failed = failed or not ok
+            print(
+                f"exact={seen:>9} estimate={estimate:>9} error={error:+.4%} "
+                f"bound=±{3 * standard_error:.2%} bytes={len(merged.to_bytes())} {'ok' if ok else 'FAIL'}"
+            )
+    elapsed = time.perf_counter() - started
+    print(f"adds/sec={seen * 2 / elapsed:,.0f} (approx, avg 2 adds per user)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+"""Time and allocation profile of the per-event pure-Python ingest path.
+
+Usage:
+    python -m benchmarks.hot_path [--filter NAME] [--log-level WARNING|INFO]
+        [--rounds 5] [--save-baseline [PATH]] [--compare [PATH]]
+        [--threshold 0.15] [--confirm 2]
+
+Cases cover event enrichment (rawUsage parsing, pricing, FX), the
+provider usage parsers, `calculate_cost_usd`, `_calculate_local_cost`,
+`_build_aggregate_update` and `_parse_timestamp`, with Gemini and OpenAI
+payloads from benchmarks/fixtures/usage_payloads.json. No Firestore calls
+are made; FX rates are seeded so nothing is fetched.
+
+Timing runs in --rounds rounds over all cases (interleaved, so a burst
+of host load hits one round rather than every run of one case); a round
+is the best of --repeat timeit runs, taken right after timing a fixed
+reference workload. Per case it prints the best ns/op over rounds, the
+spread ((max - min) / median) of its time relative to the reference
+across rounds, the peak traced memory of a single call and the bytes
+still held after 1000 calls (tracemalloc). `enrich_usage_event` cases
+include a shallow copy of the input event, since the function mutates
+it.
+
+With the default --log-level WARNING the service's INFO logs are
+filtered out early; INFO formats every record into a discarded stream,
+which is what a deployment with LOG_LEVEL=INFO pays.
+
+--save-baseline writes the results, per-round timings included, as JSON
+(default .benchmarks/hot_path.json). --compare reads one and exits 1
+when a case's peak bytes grew by more than --threshold (a fraction), or
+when its time relative to the reference grew by more than --threshold in
+both the fastest and the median round. The ratio cancels host slowdowns
+that last longer than one round (shared or throttled hosts drift by 2x
+over minutes); requiring the median to agree keeps one lucky baseline
+round from failing a run. A case flagged on time is re-timed up to
+--confirm times and fails only if every re-timing still flags it. Δ and
+spread in the comparison are of the relative time. Baselines are
+machine-specific: compare only against one saved on the same host.
+"""
+
+import argparse
+import datetime as dt
+import gc
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+from app.core import event_builder, usage_tracker
+from app.core.pricing import calculate_cost_usd
+from app.core.usage_parsers import get_usage_parser
+
+FIXTURES = Path(__file__).parent / "fixtures" / "usage_payloads.json"
+DEFAULT_BASELINE = Path(".benchmarks") / "hot_path.json"
+# Peak-memory growth below this many bytes is noise, whatever the ratio.
+_MIN_PEAK_DELTA_BYTES = 256
+
+
+class _Snapshot:
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.exists = True
+        self.id = "uid_bench_20260112"
+        self._data = data
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self._data
+
+
+def _fixture(name: str) -> Dict[str, Any]:
+    for case in json.loads(FIXTURES.read_text()):
+        if case["name"] == name:
+            return case["payload"]
+    raise KeyError(name)
+
+
+def _cases() -> List[Tuple[str, Callable[[], Any]]]:
+    gemini_response = _fixture("gemini full response with thoughts and cache")
+    openai_response = _fixture("openai chat completions with cached and reasoning details")
+    gemini_event = {
+        "requestId": "req_bench_gemini",
+        "userId": "uid_bench",
+        "timestamp": 1768206132,
+        "action": "analyze_pdf",
+        "endpoint": "/v1/pdf/analyze",
+        "provider": "gemini",
+        "model": "models/gemini-2.5-flash",
+        "latencyMs": 2140,
+        "status": "success",
+        "plan": {"tier": "pro", "isPremium": True},
+        "metadata": {"pages": 12, "fileType": "pdf"},
+        "rawUsage": gemini_response,
+    }
+    openai_event = {
+        **gemini_event,
+        "requestId": "req_bench_openai",
+        "action": "chat",
+        "endpoint": "/v1/chat",
+        "provider": "openai",
+        "model": "gpt-4o-mini",
+        "userCurrency": "TRY",
+        "rawUsage": openai_response,
+    }
+    enriched = event_builder.enrich_usage_event(dict(gemini_event))
+    existing = _Snapshot(
+        {
+            "userId": "uid_bench",
+            "day": "20260112",
+            "planSnapshot": {"tier": "pro", "isPremium": True},
+            "actions": {
+                name: {"tokensIn": 1000, "tokensOut": 200, "costTry": 0.5, "costUsd": 0.01, "count": 3}
+                for name in ("chat", "analyze_pdf", "generate_ppt", "analyze_image")
+            },
+        }
+    )
+    gemini_parser = get_usage_parser("gemini")
+    openai_parser = get_usage_parser("openai")
+    return [
+        ("enrich_usage_event/gemini", lambda: event_builder.enrich_usage_event(dict(gemini_event))),
+        ("enrich_usage_event/openai_try", lambda: event_builder.enrich_usage_event(dict(openai_event))),
+        ("usage_parser/gemini", lambda: gemini_parser.parse(gemini_response)),
+        ("usage_parser/openai", lambda: openai_parser.parse(openai_response)),
+        ("calculate_cost_usd", lambda: calculate_cost_usd("gemini-2.5-flash", 5000, 1320)),
+        ("calculate_local_cost/usd", lambda: event_builder._calculate_local_cost(0.0123, "USD")),
+        ("calculate_local_cost/try", lambda: event_builder._calculate_local_cost(0.0123, "TRY")),
+        (
+            "build_aggregate_update/daily",
+            lambda: usage_tracker._build_aggregate_update(enriched, existing, day_key="20260112"),
+        ),
+        (
+            "build_aggregate_update/monthly",
+            lambda: usage_tracker._build_aggregate_update(enriched, existing, month_key="202601", is_monthly=True),
+        ),
+        ("parse_timestamp/epoch", lambda: usage_tracker._parse_timestamp(1768206132)),
+        ("parse_timestamp/iso", lambda: usage_tracker._parse_timestamp("2026-01-12T08:22:12Z")),
+    ]
+
+
+def _reference() -> Any:
+    """Fixed dict/str/float workload timed next to every case to track host speed."""
+
+    row = {"inputTokens": 5000, "outputTokens": 1320, "model": "gemini-2.5-flash"}
+    total = 0.0
+    for key, value in row.items():
+        total += len(key) + (value if isinstance(value, int) else len(value.lower()))
+    return round(total * 1.5e-6, 6)
+
+
+def _time_rounds(
+    cases: List[Tuple[str, Callable[[], Any]]], rounds: int, repeat: int
+) -> Dict[str, Tuple[List[float], List[float]]]:
+    """(ns/op, ns/op relative to _reference) of each case per round.
+
+    A round times the reference and then the case, each the best of
+    `repeat` timeit runs; the two runs are adjacent, so host slowdowns
+    that outlast them cancel out of the ratio.
+    """
+
+    def timed(fn: Callable[[], Any]) -> Callable[[], float]:
+        timer = timeit.Timer(fn)
+        number, _ = timer.autorange()
+        return lambda: min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+    reference = timed(_reference)
+    timers = {name: timed(fn) for name, fn in cases}
+    timings: Dict[str, Tuple[List[float], List[float]]] = {name: ([], []) for name, _ in cases}
+    for _ in range(rounds):
+        for name, timer in timers.items():
+            reference_ns = reference()
+            ns = timer()
+            timings[name][0].append(ns)
+            timings[name][1].append(ns / reference_ns)
+    return timings
+
+
+def _spread(rounds: List[float]) -> float:
+    return (max(rounds) - min(rounds)) / statistics.median(rounds)
+
+
+def _memory(fn: Callable[[], Any], calls: int = 1000) -> Tuple[int, float]:
+    """(peak bytes of one call, bytes retained per call over `calls` calls)."""
+
+    fn()  # warm caches so one-time allocations are not charged to the case
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        single_peak = peak - base
+        gc.collect()
+        before, _ = tracemalloc.get_traced_memory()
+        for _ in range(calls):
+            fn()
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return single_peak, (after - before) / calls
+
+
+def _configure_logging(level: str) -> None:
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logging.basicConfig(level=getattr(logging, level), handlers=[handler], force=True)
+
+
+def _compare(
+    results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], threshold: float
+) -> Dict[str, List[str]]:
+    """Print the comparison table; regression flags ("time", "memory") per case."""
+
+    regressions: Dict[str, List[str]] = {}
+    print(f"\n{'case':<32} {'ns/op':>10} {'base':>10} {'Δ':>8} {'spread':>7} {'peak B':>8} {'base':>8}")
+    for name, current in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<32} {current['ns_per_op']:10.0f} {'-':>10}")
+            continue
+        peak_delta = current["peak_bytes"] - base["peak_bytes"]
+        flags = []
+        base_rounds = base.get("relative_rounds")
+        if base_rounds:
+            current_rounds = current["relative_rounds"]
+            ratio = min(current_rounds) / min(base_rounds) - 1
+            median_ratio = statistics.median(current_rounds) / statistics.median(base_rounds) - 1
+            if ratio > threshold and median_ratio > threshold:
+                flags.append("time")
+        else:
+            # Baselines saved before reference timing are not compared on time.
+            ratio, base_rounds = current["ns_per_op"] / base["ns_per_op"] - 1, [1.0]
+        if peak_delta > _MIN_PEAK_DELTA_BYTES and peak_delta > threshold * base["peak_bytes"]:
+            flags.append("memory")
+        print(
+            f"{name:<32} {current['ns_per_op']:10.0f} {base['ns_per_op']:10.0f} {ratio:+8.1%} "
+            f"{_spread(base_rounds):7.1%} "
+            f"{current['peak_bytes']:8d} {base['peak_bytes']:8d} {'REGRESSION ' + '+'.join(flags) if flags else ''}"
+        )
+        regressions[name] = flags
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="", help="Only cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=7, help="timeit runs per round; the best one counts")
+    parser.add_argument("--rounds", type=int, default=5, help="Interleaved timing rounds over all cases")
+    parser.add_argument("--log-level", default="WARNING", choices=("WARNING", "INFO"))
+    parser.add_argument("--save-baseline", nargs="?", const=str(DEFAULT_BASELINE), default=None, metavar="PATH")
+    parser.add_argument("--compare", nargs="?", const=str(DEFAULT_BASELINE), default=None, metavar="PATH")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Allowed growth as a fraction (0.15 = 15%%)")
+    parser.add_argument("--confirm", type=int, default=2, help="Re-timings a time regression must survive")
+    args = parser.parse_args()
+
+    _configure_logging(args.log_level)
+    # Seed FX so enrichment never calls the provider stub mid-measurement.
+    event_builder._FX_CACHE.set_rate("USD", "TRY", 43.0)
+
+    cases = [(name, fn) for name, fn in _cases() if args.filter in name]
+    rounds = max(args.rounds, 1)
+    timings = _time_rounds(cases, rounds, args.repeat)
+    results: Dict[str, Dict[str, Any]] = {}
+    print(f"{'case':<32} {'ns/op':>10} {'spread':>7} {'peak B':>8} {'retained B/call':>16}")
+    for name, fn in cases:
+        ns_rounds, relative_rounds = timings[name]
+        peak, retained = _memory(fn)
+        results[name] = {
+            "ns_per_op": round(min(ns_rounds), 1),
+            "relative_rounds": [round(value, 4) for value in relative_rounds],
+            "peak_bytes": peak,
+            "retained_bytes_per_call": round(retained, 1),
+        }
+        print(f"{name:<32} {min(ns_rounds):10.0f} {_spread(relative_rounds):7.1%} {peak:8d} {retained:16.1f}")
+
+    meta = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "node": platform.node(),
+        "logLevel": args.log_level,
+        "createdAt": dt.datetime.now(dt.timezone.utc).isoformat(),
+    }
+    status = 0
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        mismatched = [key for key in ("python", "machine", "node", "logLevel") if baseline["meta"].get(key) != meta[key]]
+        if mismatched:
+            print(f"warning: baseline differs in {', '.join(mismatched)}; timings are not comparable")
+        flags = _compare(results, baseline, args.threshold)
+        for attempt in range(1, args.confirm + 1):
+            # A time regression has to reproduce; memory peaks are deterministic.
+            suspects = [name for name, case_flags in flags.items() if case_flags == ["time"]]
+            if not suspects:
+                break
+            print(f"\nre-timing {len(suspects)} case(s) flagged on time ({attempt}/{args.confirm})")
+            retimed = _time_rounds([(name, fn) for name, fn in cases if name in suspects], rounds, args.repeat)
+            for name in suspects:
+                ns_rounds, relative_rounds = retimed[name]
+                results[name]["ns_per_op"] = round(min(ns_rounds), 1)
+                results[name]["relative_rounds"] = [round(value, 4) for value in relative_rounds]
+            flags.update(_compare({name: results[name] for name in suspects}, baseline, args.threshold))
+        regressions = [name for name, case_flags in flags.items() if case_flags]
+        print(f"\nresult: {'FAIL ' + ', '.join(regressions) if regressions else 'OK'} (threshold {args.threshold:.0%})")
+        status = 1 if regressions else 0
+    if args.save_baseline:
+        path = Path(args.save_baseline)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({"meta": meta, "results": results}, indent=2) + "\n")
+        print(f"baseline saved to {path}")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""Report where import time goes when the service boots.
+
+Usage:
+    python -m benchmarks.import_profile [--module app.main] [--top 25]
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter
+(so nothing is already cached in sys.modules), parses the stderr report
+and prints the modules with the largest cumulative import time, plus the
+total wall time of the import.
+"""
+
+import argparse
+import re
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S.*)$")
+
+
+def profile_imports(module: str) -> Tuple[float, List[Tuple[str, int, int, int]]]:
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        tail = "\n".join(result.stderr.splitlines()[-10:])
+        raise RuntimeError(f"import {module} failed:\n{tail}")
+    rows = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((name.strip(), int(self_us), int(cumulative_us), len(indent) // 2))
+    return elapsed, rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+
+    elapsed, rows = profile_imports(args.module)
+    total_us = max((row[2] for row in rows), default=0)
+    print(f"import {args.module}: {elapsed * 1000:.1f} ms wall (interpreter start included), "
+          f"{total_us / 1000:.1f} ms in imports, {len(rows)} modules")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+    for name, self_us, cumulative_us, depth in sorted(rows, key=lambda row: row[2], reverse=True)[: args.top]:
+        print(f"{cumulative_us / 1000:14.1f} {self_us / 1000:9.1f}  {'  ' * depth}{name}")
+
+    heavy = [row for row in rows if row[0].startswith(("google.cloud.firestore", "grpc"))]
+    if heavy:
+        print(f"\nfirestore/grpc modules imported eagerly: {len(heavy)}")
+    else:
+        print("\nfirestore/grpc not imported at module load (deferred to warmup)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""Compare stored bytes per usage_events doc: full vs compact encoding.
+
+Usage:
+    python -m benchmarks.raw_event_bytes [--events 5000]
+
+Builds synthetic enriched events (metadata, fx, plan, rawUsage, cost),
+then reports average document size and automatic single-field index size
+(app.core.doc_size) for the full document and for each compact codec
+available in this environment, plus encode/decode time. Every row is
+measured with the `usage_events` index exemptions from
+firestore.indexes.json, i.e. the deployed index set; "full, no
+exemptions" is shown for reference only. The compact codec used by
+default (RAW_EVENT_CODEC) is marked.
+"""
+
+import argparse
+import json
+import random
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from app.core import event_codec
+from app.core.doc_size import document_bytes, single_field_index_bytes
+
+INDEXES_FILE = Path(__file__).resolve().parent.parent / "firestore.indexes.json"
+
+
+def exempt_fields(collection: str = "usage_events") -> Tuple[str, ...]:
+    """Fields of `collection` whose single-field indexes are disabled in firestore.indexes.json."""
+
+    overrides = json.loads(INDEXES_FILE.read_text()).get("fieldOverrides") or []
+    return tuple(
+        override["fieldPath"]
+        for override in overrides
+        if override.get("collectionGroup") == collection and override.get("indexes") == []
+    )
+
+
+def _events(count: int, seed: int) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    events = []
+    for index in range(count):
+        input_tokens = rng.randint(100, 8000)
+        output_tokens = rng.randint(50, 3000)
+        cost_usd = (input_tokens * 0.3 + output_tokens * 2.5) / 1_000_000
+        events.append(
+            {
+                "requestId": f"req_{index:08d}",
+                "eventId": f"req_{index:08d}",
+                "userId": f"uid_{rng.randrange(5000):05d}",
+                "timestamp": 1768206132 + index,
+                "action": rng.choice(["chat", "analyze_pdf", "generate_ppt", "summarize"]),
+                "endpoint": rng.choice(["/v1/chat", "/v1/pdf/analyze", "/v1/ppt"]),
+                "provider": "gemini",
+                "model": rng.choice(["gemini-2.5-flash", "gemini-2.5-pro"]),
+                "subscriptionType": rng.choice(["free", "monthly", "yearly"]),
+                "countryCode": rng.choice(["TR", "DE", "US"]),
+                "userCurrency": "TRY",
+                "plan": {"tier": rng.choice(["free", "pro"]), "isPremium": rng.random() < 0.3, "entitlementIds": ["pro"]},
+                "metadata": {"appVersion": "3.4.1", "platform": rng.choice(["ios", "android"]), "locale": "tr-TR"},
+                "rawUsage": {
+                    "promptTokenCount": input_tokens,
+                    "candidatesTokenCount": output_tokens,
+                    "totalTokenCount": input_tokens + output_tokens,
+                },
+                "inputTokens": input_tokens,
+                "outputTokens": output_tokens,
+                "totalTokens": input_tokens + output_tokens,
+                "latencyMs": rng.randint(300, 9000),
+                "status": "success",
+                "cost": {"inputUSD": input_tokens * 0.3 / 1e6, "outputUSD": output_tokens * 2.5 / 1e6},
+                "costUSD": cost_usd,
+                "costTRY": cost_usd * 43.0,
+                "fx": {"base": "USD", "quote": "TRY", "rate": 43.0, "updatedAt": "2026-01-12T08:00:00+00:00"},
+                "costCalculationVersion": "v1",
+                "throttlingDecision": {"decision": "allow", "remaining": rng.randint(0, 60), "policy": "default"},
+            }
+        )
+    return events
+
+
+def _measure(events: List[Dict[str, Any]], exempt: Tuple[str, ...], encoding: str = "") -> Dict[str, float]:
+    doc_total = index_total = 0
+    started = time.perf_counter()
+    docs = []
+    for event in events:
+        doc = event_codec.encode_event(event, encoding) if encoding else dict(event)
+        doc["loggedAt"] = 0.0
+        docs.append(doc)
+    encode_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    if encoding:
+        for doc in docs:
+            event_codec.decode_event(doc)
+    decode_seconds = time.perf_counter() - started
+    for event, doc in zip(events, docs):
+        doc_total += document_bytes("usage_events", event["eventId"], doc)
+        index_total += single_field_index_bytes("usage_events", event["eventId"], doc, exempt)
+    count = len(events)
+    return {
+        "doc": doc_total / count,
+        "index": index_total / count,
+        "encode_us": encode_seconds / count * 1e6,
+        "decode_us": decode_seconds / count * 1e6,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=5_000)
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args()
+
+    events = _events(args.events, args.seed)
+    exempt = exempt_fields()
+    rows = [("full", _measure(events, exempt)), ("full, no exemptions", _measure(events, ()))]
+    encodings = event_codec.available_encodings()
+    if event_codec.MSGPACK_ZSTD not in encodings:
+        print("msgpack/zstandard not installed; measuring json+zlib only")
+    default = event_codec.default_encoding()
+    rows.extend(
+        (f"compact {encoding}{' *' if encoding == default else ''}", _measure(events, exempt, encoding))
+        for encoding in encodings
+    )
+
+    baseline = rows[0][1]["doc"] + rows[0][1]["index"]
+    print(f"exempt fields: {', '.join(exempt)}")
+    print(f"{'encoding':<22} {'doc B':>8} {'index B':>9} {'total B':>9} {'vs full':>8} {'enc us':>8} {'dec us':>8}")
+    for name, row in rows:
+        total = row["doc"] + row["index"]
+        print(
+            f"{name:<22} {row['doc']:8.0f} {row['index']:9.0f} {total:9.0f} "
+            f"{total / baseline:8.1%} {row['encode_us']:8.1f} {row['decode_us']:8.1f}"
+        )
+    print("* default compact codec (RAW_EVENT_CODEC)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""Replay captured ingest traffic against a running instance and check its totals.
+
+Usage:
+    python -m benchmarks.replay_ingest CAPTURE [CAPTURE ...] [--target http://localhost:8080]
+        [--speed 1] [--concurrency 64] [--run-id ID] [--no-verify]
+
+CAPTURE is an NDJSON file or a CAPTURE_DIR written by the service
+(app.core.capture). Requests keep their original inter-arrival gaps divided
+by --speed (1 = real time, 10 = 10x, 0 = as fast as --concurrency allows).
+userId, requestId and eventId are prefixed with the run ID, so runs do not
+collide while retried requestIds stay duplicates of each other.
+
+Run the service and this tool against the same Firestore stand-in, e.g.:
+    gcloud emulators firestore start --host-port=localhost:8681
+    export FIRESTORE_EMULATOR_HOST=localhost:8681 GOOGLE_CLOUD_PROJECT=replay-local
+
+Reports throughput, latency percentiles, how late sends were against the
+schedule, and dedup correctness (one accepted response per requestId).
+Unless --no-verify is given, the usage_daily docs of every replayed
+(user, day) are read back and compared with the sum of the accepted
+events, each enriched with the service's enrich_usage_event. Responses
+with `deferred: true` (spilled to the fallback sink) are not counted;
+exit status is 1 on any mismatch.
+"""
+
+import argparse
+import copy
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.core.capture import load_capture
+from app.core.event_builder import enrich_usage_event
+from app.core.usage_tracker import _parse_timestamp
+
+_COST_TOLERANCE_USD = 1e-6
+_DROPPED_HEADERS = frozenset(("host", "content-length", "connection", "transfer-encoding", "x-internal-key"))
+
+DayKey = Tuple[str, str]  # (userId, YYYYMMDD)
+
+
+class _Result:
+    __slots__ = ("status", "latency_ms", "lag_ms", "body", "response")
+
+    def __init__(self, status: int, latency_ms: float, lag_ms: float, body: Any, response: Any) -> None:
+        self.status = status
+        self.latency_ms = latency_ms
+        self.lag_ms = lag_ms
+        self.body = body
+        self.response = response
+
+
+class _Sender:
+    """One keep-alive HTTP connection per pool thread."""
+
+    def __init__(self, target: str, internal_key: Optional[str], timeout: float) -> None:
+        parsed = urllib.parse.urlsplit(target)
+        self._https = parsed.scheme == "https"
+        self._netloc = parsed.netloc
+        self._internal_key = internal_key
+        self._timeout = timeout
+        self._local = threading.local()
+
+    def send(self, record: Dict[str, Any], body: Any, due: float) -> _Result:
+        lag_ms = max(0.0, time.perf_counter() - due) * 1000
+        headers = {k: v for k, v in record.get("headers", {}).items() if k.lower() not in _DROPPED_HEADERS}
+        headers["content-type"] = "application/json"
+        if self._internal_key:
+            headers["X-Internal-Key"] = self._internal_key
+        path = record["path"] + (f"?{record['query']}" if record.get("query") else "")
+        payload = json.dumps(body).encode("utf-8") if body is not None else b""
+        started = time.perf_counter()
+        try:
+            status, raw = self._request(record["method"], path, payload, headers)
+        except (OSError, http.client.HTTPException):
+            self._local.connection = None
+            return _Result(0, (time.perf_counter() - started) * 1000, lag_ms, body, None)
+        latency_ms = (time.perf_counter() - started) * 1000
+        try:
+            response = json.loads(raw) if raw else None
+        except ValueError:
+            response = None
+        return _Result(status, latency_ms, lag_ms, body, response)
+
+    def _request(self, method: str, path: str, payload: bytes, headers: Dict[str, str]) -> Tuple[int, bytes]:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            factory = http.client.HTTPSConnection if self._https else http.client.HTTPConnection
+            connection = factory(self._netloc, timeout=self._timeout)
+            self._local.connection = connection
+        connection.request(method, path, body=payload, headers=headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+
+
+def _rewrite(body: Any, run_id: str) -> Any:
+    if not isinstance(body, dict):
+        return body
+    body = dict(body)
+    for field in ("userId", "requestId", "eventId"):
+        if isinstance(body.get(field), str):
+            body[field] = f"{run_id}_{body[field]}"
+    return body
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _expected_increments(body: Dict[str, Any]) -> Dict[str, float]:
+    """Counters one accepted event adds to its usage_daily doc, via the service's own enrichment."""
+
+    event = enrich_usage_event(copy.deepcopy(body))
+    return {
+        "totalInputTokens": event.get("inputTokens", 0) or 0,
+        "totalOutputTokens": event.get("outputTokens", 0) or 0,
+        "totalCostUsd": event.get("costUSD", 0.0) or 0.0,
+        "count": 1,
+    }
+
+
+def _verify(expected: Dict[DayKey, Dict[str, float]]) -> List[str]:
+    from app.db.partitions import get_partition_router
+
+    snapshots = get_partition_router().get_user_docs(
+        "usage_daily", [(user_id, f"{user_id}_{day}") for user_id, day in expected]
+    )
+    problems = []
+    for (user_id, day), totals in sorted(expected.items()):
+        snapshot = snapshots.get(f"{user_id}_{day}")
+        doc = (snapshot.to_dict() or {}) if snapshot is not None and snapshot.exists else {}
+        actual = {
+            "totalInputTokens": doc.get("totalInputTokens", 0),
+            "totalOutputTokens": doc.get("totalOutputTokens", 0),
+            "totalCostUsd": doc.get("totalCostUsd", 0.0),
+            "count": sum((entry or {}).get("count", 0) for entry in (doc.get("actions") or {}).values()),
+        }
+        for field, value in totals.items():
+            tolerance = _COST_TOLERANCE_USD * totals["count"] if field == "totalCostUsd" else 0
+            if abs(actual[field] - value) > tolerance:
+                problems.append(f"{user_id}_{day} {field}: expected {value}, got {actual[field]}")
+    return problems
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="+")
+    parser.add_argument("--target", default="http://localhost:8080")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time compression; 0 = as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--run-id", default=f"replay{int(time.time())}")
+    parser.add_argument("--internal-key", default=os.getenv("USAGE_SERVICE_INTERNAL_KEY"))
+    parser.add_argument("--no-verify", action="store_true", help="Skip reading usage_daily back from Firestore")
+    args = parser.parse_args()
+
+    records = load_capture(args.captures)
+    if not records:
+        print("no capture records found")
+        return 1
+    sender = _Sender(args.target, args.internal_key, args.timeout)
+    first_ts = records[0]["ts"]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = []
+        for record in records:
+            due = started + ((record["ts"] - first_ts) / args.speed if args.speed > 0 else 0.0)
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(sender.send, record, _rewrite(record.get("body"), args.run_id), due))
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+
+    latencies = [result.latency_ms for result in results if result.status]
+    lags = [result.lag_ms for result in results]
+    statuses = Counter(result.status for result in results)
+    captured_span = records[-1]["ts"] - first_ts
+    print(f"run id: {args.run_id}")
+    print(f"requests: {len(results)} in {elapsed:.2f}s ({len(results) / elapsed:.1f} req/s); capture spanned {captured_span:.2f}s")
+    print("statuses: " + ", ".join(f"{status or 'conn-error'}={count}" for status, count in sorted(statuses.items())))
+    print(
+        "latency ms: "
+        + " ".join(f"p{int(q * 100)}={_percentile(latencies, q):.1f}" for q in (0.5, 0.9, 0.99))
+        + f" max={max(latencies, default=0.0):.1f}"
+    )
+    print(f"send lag ms: p50={_percentile(lags, 0.5):.1f} p99={_percentile(lags, 0.99):.1f} (late against the schedule)")
+
+    accepted: Dict[str, Dict[str, Any]] = {}
+    deduped: Counter = Counter()
+    deferred = set()
+    problems: List[str] = []
+    for result in results:
+        response, body = result.response, result.body
+        if result.status != 200 or not isinstance(response, dict) or not isinstance(body, dict):
+            continue
+        request_id = body["requestId"]
+        if response.get("deferred"):
+            # Spilled to the fallback sink: not in usage_daily until replay_deferred runs.
+            deferred.add(request_id)
+        elif response.get("deduped"):
+            deduped[request_id] += 1
+        elif request_id in accepted:
+            problems.append(f"{request_id}: accepted more than once")
+        else:
+            accepted[request_id] = body
+    seen = set(accepted) | set(deduped)
+    print(
+        f"dedup: {len(seen)} distinct requestIds, {len(accepted)} accepted, "
+        f"{sum(deduped.values())} deduped responses, {len(deferred)} deferred"
+    )
+    if deferred - set(accepted):
+        print(f"note: {len(deferred - set(accepted))} deferred requestIds are not verified (run replay_deferred)")
+    missing = sorted(set(deduped) - set(accepted))
+    if missing:
+        # Accepted in an earlier run with the same --run-id, or the dedup window is off.
+        print(f"note: {len(missing)} requestIds were only ever deduped")
+
+    if not args.no_verify:
+        expected: Dict[DayKey, Dict[str, float]] = defaultdict(
+            lambda: {"totalInputTokens": 0, "totalOutputTokens": 0, "totalCostUsd": 0.0, "count": 0}
+        )
+        for body in accepted.values():
+            day = _parse_timestamp(body["timestamp"]).strftime("%Y%m%d")
+            totals = expected[(body["userId"], day)]
+            for field, value in _expected_increments(body).items():
+                totals[field] += value
+        problems.extend(_verify(expected))
+        print(f"aggregates: {len(expected)} usage_daily docs checked")
+    for problem in problems[:50]:
+        print(f"MISMATCH {problem}")
+    if len(problems) > 50:
+        print(f"... {len(problems) - 50} more")
+    print("result: " + ("FAIL" if problems else "OK"))
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""Measure shared-memory table lookups/sec as worker processes are added.
+
+Usage:
+    python -m benchmarks.shared_memory_scaling [--keys 50000] [--lookups 200000] [--max-workers N]
+
+Every worker process reads the same table (lock-free seqlock reads) while
+one extra process keeps writing, like the ingest path updating totals.
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import time
+
+from app.core.shared_state import SharedHashTable
+
+_TABLE_NAME = f"usage_bench_{os.getpid()}"
+
+
+def _reader(capacity: int, keys: int, lookups: int, seed: int, results) -> None:
+    table = SharedHashTable(_TABLE_NAME, capacity, value_count=3, create=False)
+    rng = random.Random(seed)
+    names = [f"uid_{rng.randrange(keys)}:20260112" for _ in range(1024)]
+    started = time.perf_counter()
+    hits = 0
+    for index in range(lookups):
+        if table.get(names[index & 1023]) is not None:
+            hits += 1
+    results.put((lookups / (time.perf_counter() - started), hits))
+    table.close()
+
+
+def _writer(capacity: int, keys: int, stop) -> None:
+    table = SharedHashTable(_TABLE_NAME, capacity, value_count=3, create=False)
+    rng = random.Random(1)
+    while not stop.is_set():
+        key = f"uid_{rng.randrange(keys)}:20260112"
+        table.update(key, lambda current: (((current or (0.0, 0.0, 0.0))[0] + 0.001), 1.0, time.time()))
+    table.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--keys", type=int, default=50_000)
+    parser.add_argument("--lookups", type=int, default=200_000)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    capacity = args.keys * 2
+    table = SharedHashTable(_TABLE_NAME, capacity, value_count=3, create=True)
+    try:
+        for user in range(args.keys):
+            table.put(f"uid_{user}:20260112", (1.0, 100.0, time.time()))
+
+        workers = 1
+        baseline = None
+        while workers <= args.max_workers:
+            results = multiprocessing.Queue()
+            stop = multiprocessing.Event()
+            writer = multiprocessing.Process(target=_writer, args=(capacity, args.keys, stop))
+            writer.start()
+            readers = [
+                multiprocessing.Process(target=_reader, args=(capacity, args.keys, args.lookups, seed, results))
+                for seed in range(workers)
+            ]
+            for reader in readers:
+                reader.start()
+            rates = [results.get() for _ in readers]
+            for reader in readers:
+                reader.join()
+            stop.set()
+            writer.join()
+
+            total = sum(rate for rate, _ in rates)
+            baseline = baseline or total
+            hit_ratio = sum(hits for _, hits in rates) / (args.lookups * workers)
+            print(
+                f"workers={workers:>2} lookups/sec={total:>12,.0f} "
+                f"speedup={total / baseline:5.2f}x hit_ratio={hit_ratio:.3f}"
+            )
+            workers *= 2
+    finally:
+        table.close()
+        table.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Fault-injection run of the storage guard against a local Firestore stand-in.
+
+Usage:
+    python -m benchmarks.storage_faults [--clients 32] [--rate 25] [--phase-seconds 3] [--deadline-ms 1000]
+
+Client threads call a stand-in storage function through a fresh
+StorageGuard (app.core.resilience), each request under its own deadline.
+The stand-in goes through four phases: healthy (20 ms), degraded (slower
+than the limiter target), outage (hangs, then fails) and recovered. The
+same workload is then run without the guard for comparison, where every
+call waits out the stand-in.
+
+Per phase it prints ok / rejected / failed counts, caller latency p50/p99,
+peak in-flight calls and the limit and breaker state at the end of the
+phase. Exit status is 1 if, with the guard, the breaker did not open in
+the outage (or within one deadline after it), caller p99 in the outage
+exceeded the deadline, or the recovered phase ended with the breaker not
+closed.
+"""
+
+import argparse
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from app.core.resilience import (
+    AdaptiveLimiter,
+    CircuitBreaker,
+    StorageGuard,
+    StorageUnavailable,
+    deadline_scope,
+    remaining_seconds,
+)
+
+PHASES = ("healthy", "degraded", "outage", "recovered")
+
+
+class _StandIn:
+    """Storage whose latency and failures depend on the current phase."""
+
+    def __init__(self, phase_seconds: float, degraded_ms: float, outage_hang_ms: float) -> None:
+        self.phase_seconds = phase_seconds
+        self.latency = {"healthy": 0.02, "degraded": degraded_ms / 1000, "outage": outage_hang_ms / 1000, "recovered": 0.02}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.peak: Dict[str, int] = Counter()
+
+    def phase(self) -> Optional[str]:
+        index = int((time.monotonic() - self.started) / self.phase_seconds)
+        return PHASES[index] if index < len(PHASES) else None
+
+    def call(self) -> None:
+        phase = self.phase() or PHASES[-1]
+        with self._lock:
+            self.inflight += 1
+            self.peak[phase] = max(self.peak[phase], self.inflight)
+        try:
+            latency = self.latency[phase]
+            remaining = remaining_seconds()
+            # Like a Firestore call with a timeout: give up at the deadline.
+            time.sleep(latency if remaining is None else max(0.0, min(latency, remaining)))
+            if remaining is not None and remaining < latency:
+                raise TimeoutError("stand-in call timed out")
+            if phase == "outage":
+                raise ConnectionError("stand-in unavailable")
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _run(args: argparse.Namespace, guarded: bool) -> Tuple[Dict[str, Counter], Dict[str, List[float]], Dict[str, Tuple[float, str]], _StandIn]:
+    stand_in = _StandIn(args.phase_seconds, args.degraded_ms, args.outage_hang_ms)
+    guard = StorageGuard(
+        AdaptiveLimiter(initial=16, min_limit=2, max_limit=64, target_latency_ms=args.target_ms),
+        CircuitBreaker(min_calls=20, window_seconds=2, open_seconds=args.phase_seconds / 3, half_open_calls=3),
+    )
+    outcomes: Dict[str, Counter] = {phase: Counter() for phase in PHASES}
+    latencies: Dict[str, List[float]] = {phase: [] for phase in PHASES}
+    snapshots: Dict[str, Tuple[float, str]] = {}
+    lock = threading.Lock()
+
+    def _client() -> None:
+        interval = 1.0 / args.rate
+        next_at = time.monotonic()
+        while True:
+            phase = stand_in.phase()
+            if phase is None:
+                return
+            started = time.monotonic()
+            try:
+                if guarded:
+                    with deadline_scope(started + args.deadline_ms / 1000):
+                        guard.run("standin", stand_in.call)
+                else:
+                    stand_in.call()
+                outcome = "ok"
+            except StorageUnavailable as exc:
+                outcome = exc.reason if exc.__cause__ is None else "failed"
+            except (TimeoutError, ConnectionError):
+                outcome = "failed"
+            with lock:
+                outcomes[phase][outcome] += 1
+                latencies[phase].append((time.monotonic() - started) * 1000)
+            # No catch-up burst after slow calls: arrivals resume at the rate.
+            next_at = max(next_at + interval, time.monotonic())
+            time.sleep(max(0.0, next_at - time.monotonic()))
+
+    def _monitor() -> None:
+        while True:
+            phase = stand_in.phase()
+            if phase is None:
+                return
+            state = guard.breaker.state
+            snapshots[phase] = (guard.limiter.limit, state)
+            if state == CircuitBreaker.OPEN and "opened_at" not in snapshots:
+                snapshots["opened_at"] = (time.monotonic() - stand_in.started, state)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=_client, daemon=True) for _ in range(args.clients)]
+    threads.append(threading.Thread(target=_monitor, daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes, latencies, snapshots, stand_in
+
+
+def _report(title: str, guarded: bool, result) -> None:
+    outcomes, latencies, snapshots, stand_in = result
+    print(f"\n{title}")
+    print(f"{'phase':<10} {'ok':>6} {'rejected':>9} {'failed':>7} {'p50 ms':>8} {'p99 ms':>8} {'peak inflight':>14} {'limit':>6} {'breaker':>10}")
+    for phase in PHASES:
+        counts = outcomes[phase]
+        rejected = sum(count for name, count in counts.items() if name not in ("ok", "failed"))
+        limit, state = snapshots.get(phase, (0.0, "-")) if guarded else (0.0, "-")
+        print(
+            f"{phase:<10} {counts['ok']:6d} {rejected:9d} {counts['failed']:7d} "
+            f"{_percentile(latencies[phase], 0.5):8.1f} {_percentile(latencies[phase], 0.99):8.1f} "
+            f"{stand_in.peak[phase]:14d} {limit:6.1f} {state:>10}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=25.0, help="Requests per second per client")
+    parser.add_argument("--phase-seconds", type=float, default=3.0)
+    parser.add_argument("--deadline-ms", type=float, default=1000.0)
+    parser.add_argument("--target-ms", type=float, default=200.0, help="Limiter latency target")
+    parser.add_argument("--degraded-ms", type=float, default=400.0)
+    parser.add_argument("--outage-hang-ms", type=float, default=5000.0)
+    args = parser.parse_args()
+
+    guarded = _run(args, guarded=True)
+    _report("with StorageGuard", True, guarded)
+    _report("without guard", False, _run(args, guarded=False))
+
+    outcomes, latencies, snapshots, _ = guarded
+    problems = []
+    # Outage calls only fail at their deadline, so allow one deadline of detection delay.
+    outage_start, outage_end = 2 * args.phase_seconds, 3 * args.phase_seconds + args.deadline_ms / 1000
+    opened_at = snapshots.get("opened_at", (None, ""))[0]
+    if opened_at is None or not outage_start <= opened_at <= outage_end:
+        problems.append("breaker did not open during the outage")
+    else:
+        print(f"\nbreaker opened {opened_at - outage_start:.2f}s after the outage started")
+    if _percentile(latencies["outage"], 0.99) > args.deadline_ms * 1.1:
+        problems.append("outage p99 exceeded the request deadline")
+    if snapshots.get("recovered", (0.0, ""))[1] != CircuitBreaker.CLOSED:
+        problems.append("breaker not closed at the end of recovery")
+    for problem in problems:
+        print(f"FAIL {problem}")
+    print("result: " + ("FAIL" if problems else "OK"))
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
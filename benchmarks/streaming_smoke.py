@@ -0,0 +1,247 @@
+"""End-to-end check of the streamed endpoints through the full middleware stack.
+
+Usage:
+    python -m benchmarks.streaming_smoke [--rows 1200] [--page-size 500]
+
+Starts the app under uvicorn on a free localhost port, with the partition
+router replaced by an in-memory collection of `usage_daily` docs, and over
+real HTTP connections:
+
+- streams `GET /v1/usage/export` (NDJSON and CSV) to the end and checks
+  that every doc arrives exactly once;
+- opens `GET /v1/usage/stream`, publishes a committed delta through the
+  stream hub's commit listener and checks it arrives as an SSE frame;
+- disconnects, publishes two more deltas, reconnects with `Last-Event-ID`
+  and checks both are replayed.
+
+Exits 1 on the first failed check. No Firestore connection is made.
+"""
+
+import argparse
+import http.client
+import json
+import socket
+import sys
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+import uvicorn
+
+from app.core.streams import DEFAULT_STREAMS
+from app.db.partitions import get_partition_router
+from app.main import app
+
+_OPS = {">=": lambda a, b: a >= b, "<=": lambda a, b: a <= b}
+
+
+class _Snapshot:
+    def __init__(self, doc_id: Optional[str], data: Optional[Dict[str, Any]]) -> None:
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self._data) if self._data is not None else None
+
+
+class _Query:
+    """The subset of Firestore queries `app.core.export` issues."""
+
+    def __init__(self, docs: Dict[str, Dict[str, Any]]) -> None:
+        self._docs = docs
+        self._filters: List[Tuple[str, str, Any]] = []
+        self._order: List[str] = []
+        self._limit: Optional[int] = None
+        self._after: Optional[Tuple[Any, ...]] = None
+        self._at: Optional[Tuple[Any, ...]] = None
+
+    def _copy(self, **changes: Any) -> "_Query":
+        query = _Query(self._docs)
+        query.__dict__.update({**self.__dict__, **changes})
+        return query
+
+    def where(self, filter: Any) -> "_Query":
+        return self._copy(_filters=self._filters + [(filter.field_path, filter.op_string, filter.value)])
+
+    def order_by(self, field: str) -> "_Query":
+        return self._copy(_order=self._order + [field])
+
+    def limit(self, count: int) -> "_Query":
+        return self._copy(_limit=count)
+
+    def start_after(self, snapshot: _Snapshot) -> "_Query":
+        return self._copy(_after=self._key(snapshot.id, snapshot.to_dict() or {}))
+
+    def start_at(self, values: Dict[str, Any]) -> "_Query":
+        return self._copy(_at=tuple(values.get(field) for field in self._order if field != "__name__"))
+
+    def document(self, doc_id: str) -> SimpleNamespace:
+        return SimpleNamespace(get=lambda **_: _Snapshot(doc_id, self._docs.get(doc_id)))
+
+    def stream(self, **_: Any):
+        rows = sorted(
+            (self._key(doc_id, data), doc_id, data)
+            for doc_id, data in self._docs.items()
+            if all(_OPS[op](data.get(field), value) for field, op, value in self._filters)
+        )
+        remaining = self._limit
+        for key, doc_id, data in rows:
+            if self._after is not None and key <= self._after:
+                continue
+            if self._at is not None and key[: len(self._at)] < self._at:
+                continue
+            if remaining is not None:
+                if remaining <= 0:
+                    return
+                remaining -= 1
+            yield _Snapshot(doc_id, data)
+
+    def _key(self, doc_id: str, data: Dict[str, Any]) -> Tuple[Any, ...]:
+        return tuple(doc_id if field == "__name__" else data.get(field) for field in self._order)
+
+
+class _Client:
+    def __init__(self, collections: Dict[str, Dict[str, Dict[str, Any]]]) -> None:
+        self._collections = collections
+
+    def collection(self, name: str) -> _Query:
+        return _Query(self._collections.setdefault(name, {}))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _check(ok: bool, message: str) -> None:
+    print(f"{'ok  ' if ok else 'FAIL'} {message}")
+    if not ok:
+        raise SystemExit(1)
+
+
+def _export(port: int, export_format: str, page_size: int) -> bytes:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    conn.request(
+        "GET", f"/v1/usage/export?collection=daily&from=20260101&to=20260131&format={export_format}&pageSize={page_size}"
+    )
+    response = conn.getresponse()
+    _check(response.status == 200, f"export {export_format} status {response.status}")
+    body = response.read()  # raises IncompleteRead if the stream is cut short
+    conn.close()
+    return body
+
+
+def _open_stream(port: int, last_event_id: Optional[str] = None) -> Tuple[http.client.HTTPConnection, Any]:
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    headers = {"Accept": "text/event-stream"}
+    if last_event_id:
+        headers["Last-Event-ID"] = last_event_id
+    conn.request("GET", "/v1/usage/stream?userId=uid_smoke", headers=headers)
+    response = conn.getresponse()
+    _check(response.status == 200, f"stream status {response.status}")
+    return conn, response
+
+
+def _read_frame(response: Any) -> Dict[str, str]:
+    frame: Dict[str, str] = {}
+    while True:
+        line = response.fp.readline().decode("utf-8")
+        if not line:
+            raise SystemExit("FAIL stream closed mid-frame")
+        line = line.rstrip("\n")
+        if not line:
+            if frame:
+                return frame
+            continue
+        if line.startswith(":"):
+            continue
+        field, _, value = line.partition(": ")
+        frame[field] = value
+
+
+def _delta(index: int) -> Dict[str, Any]:
+    return {
+        "userId": "uid_smoke",
+        "requestId": f"req_smoke_{index}",
+        "timestamp": 1768206132 + index,
+        "action": "chat",
+        "inputTokens": 100 + index,
+        "outputTokens": 10,
+        "costUSD": 0.001,
+    }
+
+
+def _wait_for_subscriber(expected: int) -> None:
+    deadline = time.monotonic() + 5
+    while DEFAULT_STREAMS.subscribers() != expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1200)
+    parser.add_argument("--page-size", type=int, default=500)
+    args = parser.parse_args()
+
+    daily = {
+        f"uid_{index:05d}_202601{index % 28 + 1:02d}": {
+            "userId": f"uid_{index:05d}",
+            "day": f"202601{index % 28 + 1:02d}",
+            "totalInputTokens": index,
+        }
+        for index in range(args.rows)
+    }
+    router = SimpleNamespace(
+        partitions=[SimpleNamespace(name="default")],
+        clients=lambda: [("default", _Client({"usage_daily": daily}))],
+    )
+    app.dependency_overrides[get_partition_router] = lambda: router
+    app.router.on_startup.clear()
+    app.router.on_shutdown.clear()
+
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_config=None))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        lines = _export(port, "ndjson", args.page_size).decode("utf-8").splitlines()
+        ids = [json.loads(line)["id"] for line in lines]
+        _check(sorted(ids) == sorted(daily) and len(set(ids)) == len(ids), f"ndjson export streamed {len(ids)} rows")
+        csv_rows = _export(port, "csv", args.page_size).decode("utf-8").splitlines()
+        _check(len(csv_rows) == args.rows + 1, f"csv export streamed {len(csv_rows) - 1} rows")
+
+        conn, response = _open_stream(port)
+        ready = _read_frame(response)
+        _check(ready.get("event") == "ready", f"stream opened with {ready.get('event')}")
+        _wait_for_subscriber(1)
+        DEFAULT_STREAMS.observe_event(None, _delta(0))
+        frame = _read_frame(response)
+        payload = json.loads(frame.get("data", "{}"))
+        _check(frame.get("event") == "usage" and payload.get("requestId") == "req_smoke_0", "live delta delivered")
+        last_id = frame["id"]
+        conn.close()
+        _wait_for_subscriber(0)
+
+        DEFAULT_STREAMS.observe_event(None, _delta(1))
+        DEFAULT_STREAMS.observe_event(None, _delta(2))
+        conn, response = _open_stream(port, last_id)
+        ready = _read_frame(response)
+        replayed = [json.loads(_read_frame(response)["data"])["requestId"] for _ in range(2)]
+        _check(
+            ready.get("event") == "ready" and replayed == ["req_smoke_1", "req_smoke_2"],
+            f"resume replayed {replayed}",
+        )
+        conn.close()
+    finally:
+        server.should_exit = True
+        thread.join(timeout=5)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
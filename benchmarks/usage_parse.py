@@ -0,0 +1,115 @@
+"""Check provider usage parsers against fixtures and time per-event parsing.
+
+Usage:
+    python -m benchmarks.usage_parse [--iterations 200000]
+
+Every case in benchmarks/fixtures/usage_payloads.json must parse to its
+`expected` token counts (exit status 1 otherwise). A null `provider` is
+parsed as `enrich_usage_event` parses provider-less events. Cases with an
+`event` (the counts a producer sent) are run through `enrich_usage_event`
+with the payload as `rawUsage`, and `expected` is the token fields of the
+enriched event: only fields the producer left out are backfilled. Timing compares the
+compiled registry extractors with the previous `or`-chain parser, kept
+here only as a reference; cases where the old parser disagrees are listed.
+"""
+
+import argparse
+import json
+import sys
+import timeit
+from pathlib import Path
+from typing import Any, Dict
+
+from app.core.event_builder import DEFAULT_PROVIDER, enrich_usage_event
+from app.core.usage_parsers import USAGE_FIELDS, get_usage_parser
+
+FIXTURES = Path(__file__).parent / "fixtures" / "usage_payloads.json"
+
+_LEGACY_KEYS = (
+    "promptTokenCount",
+    "candidatesTokenCount",
+    "prompt_tokens",
+    "completion_tokens",
+    "inputTokens",
+    "outputTokens",
+    "total_tokens",
+    "totalTokenCount",
+    "totalTokens",
+)
+
+
+def _legacy_int(value: Any) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def legacy_parse(payload: Dict[str, Any]) -> Dict[str, int]:
+    if any(key in payload for key in _LEGACY_KEYS):
+        usage = payload
+    else:
+        usage = payload.get("usageMetadata") or payload.get("usage_metadata") or payload.get("usage") or {}
+    thoughts = _legacy_int(usage.get("thoughtsTokenCount"))
+    input_tokens = _legacy_int(
+        usage.get("promptTokenCount") or usage.get("prompt_tokens") or usage.get("inputTokens") or usage.get("input_tokens")
+    )
+    output_tokens = _legacy_int(
+        usage.get("candidatesTokenCount")
+        or usage.get("completionTokenCount")
+        or usage.get("completion_tokens")
+        or usage.get("outputTokens")
+        or usage.get("output_tokens")
+    ) + thoughts
+    total_tokens = _legacy_int(
+        usage.get("totalTokenCount") or usage.get("total_tokens") or usage.get("totalTokens") or input_tokens + output_tokens
+    )
+    return {"inputTokens": input_tokens, "outputTokens": output_tokens, "totalTokens": total_tokens}
+
+
+def _parse_case(case: Dict[str, Any]) -> Dict[str, int]:
+    if "event" not in case:
+        return get_usage_parser(case["provider"] or DEFAULT_PROVIDER).parse(case["payload"])
+    event = dict(case["event"], rawUsage=case["payload"])
+    if case["provider"]:
+        event["provider"] = case["provider"]
+    enriched = enrich_usage_event(event)
+    return {field: enriched[field] for field in USAGE_FIELDS if enriched.get(field) is not None}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200_000)
+    args = parser.parse_args()
+
+    cases = json.loads(FIXTURES.read_text())
+    failures = 0
+    legacy_mismatches = []
+    for case in cases:
+        parsed = _parse_case(case)
+        if parsed != case["expected"]:
+            failures += 1
+            print(f"FAIL {case['name']}: got {parsed}, expected {case['expected']}")
+        if "event" in case:
+            continue
+        legacy = legacy_parse(case["payload"])
+        if any(legacy[key] != case["expected"][key] for key in legacy):
+            legacy_mismatches.append(case["name"])
+    print(f"fixtures: {len(cases) - failures}/{len(cases)} passed")
+    if legacy_mismatches:
+        print("previous parser disagrees on: " + "; ".join(legacy_mismatches))
+
+    print(f"\n{'case':<52} {'registry ns':>12} {'previous ns':>12}")
+    for case in cases:
+        if "event" in case:
+            continue
+        extractor = get_usage_parser(case["provider"] or DEFAULT_PROVIDER)
+        payload = case["payload"]
+        registry_ns = timeit.timeit(lambda: extractor.parse(payload), number=args.iterations) / args.iterations * 1e9
+        legacy_ns = timeit.timeit(lambda: legacy_parse(payload), number=args.iterations) / args.iterations * 1e9
+        print(f"{case['name'][:52]:<52} {registry_ns:12.0f} {legacy_ns:12.0f}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,29 @@
+"""Gunicorn config for the multi-worker deployment mode.
+
+    gunicorn -c gunicorn.conf.py app.main:app
+
+The app is preloaded in the master and the shared-memory tables
+(USAGE_SHARED_MEMORY=true) are created before workers fork, so every
+worker sees the same FX rates, recent requestIds and per-user totals.
+Segments left by a master that crashed are replaced in on_starting.
+"""
+
+import multiprocessing
+import os
+
+from app.core.shared_state import create_shared_state, destroy_shared_state
+
+bind = os.getenv("BIND", "0.0.0.0:8080")
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+
+
+def on_starting(server):
+    create_shared_state()
+
+
+def on_exit(server):
+    destroy_shared_state()